@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# Lower value is admitted first
+PRIORITY_CLASSES: Dict[str, int] = {"interactive": 0, "batch": 1}
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounded work queue in front of the service's CPU-bound work.
+
+    At most `concurrency` requests run at once; the rest wait in a priority
+    queue (interactive before batch, arrival order within a class). A request
+    fails fast with `Overloaded` when `max_queue` requests are already
+    waiting, or once it has waited `queue_timeout` seconds (less if the
+    caller's own deadline comes sooner). `retry_after` is
+    estimated from the recent service time and the queue ahead.
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int = 64, queue_timeout: float = 5.0):
+        self.concurrency = max(1, int(concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = float(queue_timeout)
+
+        self._running = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        # Moving average of how long a slot is held
+        self._service_s = 0.0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @staticmethod
+    def priority_of(name: str) -> int:
+        try:
+            return PRIORITY_CLASSES[name]
+        except KeyError:
+            raise ValueError(
+                f"unknown priority {name!r}, expected one of {sorted(PRIORITY_CLASSES)}"
+            )
+
+    def _queued(self) -> int:
+        return sum(1 for *_, fut in self._waiters if not fut.done())
+
+    def retry_after(self) -> int:
+        per_slot = self._service_s or 1.0
+        ahead = self._queued() + 1
+        return max(1, math.ceil(per_slot * ahead / self.concurrency))
+
+    def _overloaded(self, reason: str) -> Overloaded:
+        return Overloaded(f"service overloaded: {reason}", self.retry_after())
+
+    async def _acquire(self, priority: int, timeout: Optional[float] = None) -> None:
+        if self._running < self.concurrency and not self._queued():
+            self._running += 1
+            return
+        if self._queued() >= self.max_queue:
+            self.rejected += 1
+            raise self._overloaded("queue is full")
+
+        wait = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+        if wait <= 0:
+            self.timed_out += 1
+            raise self._overloaded("request deadline exceeded")
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await asyncio.wait({fut}, timeout=wait)
+        except BaseException:
+            # Caller went away while queued; a slot handed over meanwhile goes on
+            if fut.done() and not fut.cancelled():
+                self._release()
+            fut.cancel()
+            raise
+        if not fut.done():
+            fut.cancel()
+            self.timed_out += 1
+            raise self._overloaded("queue wait deadline exceeded")
+
+    def _release(self) -> None:
+        # Hand the slot straight to the best waiter, so it cannot be overtaken
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._running -= 1
+
+    @asynccontextmanager
+    async def slot(
+        self, priority: str = "interactive", timeout: Optional[float] = None
+    ) -> AsyncIterator[None]:
+        """
+        Hold one unit of concurrency for the duration of the block, waiting
+        for it at most `timeout` seconds (the caller's remaining deadline).
+        """
+        await self._acquire(self.priority_of(priority), timeout)
+        self.admitted += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self._service_s = (
+                elapsed if not self._service_s else 0.8 * self._service_s + 0.2 * elapsed
+            )
+            self._release()
+
+    def stats(self) -> dict:
+        queued = {name: 0 for name in PRIORITY_CLASSES}
+        names = {v: k for k, v in PRIORITY_CLASSES.items()}
+        for priority, _, fut in self._waiters:
+            if not fut.done():
+                queued[names[priority]] += 1
+        return {
+            "concurrency": self.concurrency,
+            "running": self._running,
+            "queued": queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_service_s": round(self._service_s, 3),
+        }
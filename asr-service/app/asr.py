@@ -1,19 +1,58 @@
 import logging
+from typing import List, Optional, Sequence, Tuple
 
+import ctranslate2
+import numpy as np
 from faster_whisper import WhisperModel
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import get_compression_ratio, get_suppressed_tokens
+
+from app.audio import resample
 
 logger = logging.getLogger(__name__)
 
+Segments = List[dict]
+
+# Пороги качества, как у faster-whisper по умолчанию: при их нарушении клип
+# распознаётся заново обычным transcribe (с перебором температур)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOG_PROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
 
 class ASRModel:
-    def __init__(self, model_size: str = "small.en"):
+    def __init__(
+        self,
+        model_size: str = "small.en",
+        cpu_threads: int = 0,
+        num_workers: int = 1,
+        download_root: str = "/app/models",
+    ):
+        # cpu_threads — потоки одного вызова (0 — по умолчанию CTranslate2),
+        # num_workers — сколько вызовов экземпляр может выполнять параллельно
         self.model = WhisperModel(
             model_size,
             device="cpu",
             compute_type="int8",
-            download_root="/app/models", 
+            cpu_threads=cpu_threads,
+            num_workers=num_workers,
+            download_root=download_root,
         )
 
+    def warmup(self, language: str = "en") -> None:
+        """
+        Прогон на синтетическом аудио (1 с тона с шумом) по обоим путям —
+        одиночному и батчевому, чтобы первый настоящий запрос не платил за
+        ленивую инициализацию CTranslate2.
+        """
+        t = np.arange(16000, dtype=np.float32) / 16000
+        rng = np.random.default_rng(0)
+        audio = 0.1 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(16000)
+        audio = audio.astype(np.float32)
+        self.transcribe(audio, 16000, language)
+        self.transcribe_batch([(audio, language)])
+
     def transcribe(self, audio, sample_rate: int, language: str):
         """Выполняет распознавание речи, устойчиво обрабатывая разные типы входа."""
 
@@ -40,6 +79,10 @@ class ASRModel:
             logger.warning("Empty audio input received. Returning empty result.")
             return "", []
 
+        # Whisper ждёт 16 кГц
+        if isinstance(audio, np.ndarray) and sample_rate != 16000:
+            audio = resample(audio.astype(np.float32, copy=False), sample_rate, 16000)
+
         try:
             segments, info = self.model.transcribe(
                 audio,
@@ -65,3 +108,168 @@ class ASRModel:
         text_full = text_full.strip()
         logger.info("ASR done: %s", text_full)
         return text_full, all_segments
+
+    def transcribe_words(
+        self, audio: np.ndarray, language: str, prompt: str = ""
+    ) -> List[Tuple[float, float, str]]:
+        """
+        Распознаёт окно потокового буфера (float32, 16 кГц) с таймкодами слов.
+
+        `prompt` — уже зафиксированный текст перед окном. Возвращает
+        [(начало, конец, слово)] в секундах от начала окна.
+        """
+        if len(audio) == 0:
+            return []
+        segments, _ = self.model.transcribe(
+            audio,
+            beam_size=1,
+            language=language,
+            initial_prompt=prompt or None,
+            condition_on_previous_text=False,
+            word_timestamps=True,
+        )
+        return [
+            (word.start, word.end, word.word)
+            for segment in segments
+            for word in segment.words or []
+        ]
+
+    def _tokenizer(self, language: str) -> Tokenizer:
+        multilingual = self.model.model.is_multilingual
+        return Tokenizer(
+            self.model.hf_tokenizer,
+            multilingual,
+            task="transcribe",
+            language=language if multilingual else "en",
+        )
+
+    def transcribe_batch(
+        self, clips: Sequence[Tuple[np.ndarray, str]]
+    ) -> List[Tuple[str, Segments]]:
+        """
+        Распознаёт несколько клипов (float32, 16 кГц) одним батчем.
+
+        Клипы до 30 с дополняются до окна Whisper, кодируются одним вызовом
+        encode и декодируются одним generate (greedy, как beam_size=1).
+        Клипы длиннее окна и результаты, не прошедшие пороги качества,
+        распознаются по одному через `transcribe`.
+        """
+        fe = self.model.feature_extractor
+        results: List[Optional[Tuple[str, Segments]]] = [None] * len(clips)
+
+        batch_idx, features, tokenizers, durations = [], [], [], []
+        for i, (audio, language) in enumerate(clips):
+            if len(audio) == 0:
+                results[i] = ("", [])
+                continue
+            if len(audio) > fe.n_samples:
+                continue
+            mel = fe(audio)
+            content_frames = mel.shape[-1] - fe.nb_max_frames
+            # Как в generate_segments: окно дополняется нулями после содержимого
+            features.append(pad_or_trim(mel[:, :content_frames], fe.nb_max_frames))
+            tokenizers.append(self._tokenizer(language))
+            durations.append(content_frames * fe.time_per_frame)
+            batch_idx.append(i)
+
+        if batch_idx:
+            decoded = self._decode_batch(np.stack(features), tokenizers, durations)
+            for i, result in zip(batch_idx, decoded):
+                results[i] = result
+
+        for i, result in enumerate(results):
+            if result is None:
+                audio, language = clips[i]
+                results[i] = self.transcribe(audio, 16000, language)
+        logger.info("ASR batch done: %d clips, %d batched", len(clips), len(batch_idx))
+        return results
+
+    def _decode_batch(
+        self, features: np.ndarray, tokenizers: List[Tokenizer], durations: List[float]
+    ) -> List[Optional[Tuple[str, Segments]]]:
+        whisper = self.model
+        encoder_output = whisper.model.encode(
+            ctranslate2.StorageView.from_array(np.ascontiguousarray(features))
+        )
+        prompts = [whisper.get_prompt(tok, []) for tok in tokenizers]
+        generated = whisper.model.generate(
+            encoder_output,
+            prompts,
+            beam_size=1,
+            max_length=whisper.max_length,
+            return_scores=True,
+            return_no_speech_prob=True,
+            suppress_blank=True,
+            suppress_tokens=get_suppressed_tokens(tokenizers[0], [-1]),
+            max_initial_timestamp_index=int(round(1.0 / whisper.time_precision)),
+        )
+
+        decoded: List[Optional[Tuple[str, Segments]]] = []
+        for result, tok, duration in zip(generated, tokenizers, durations):
+            tokens = result.sequences_ids[0]
+            avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+            if (
+                result.no_speech_prob > NO_SPEECH_THRESHOLD
+                and avg_logprob <= LOG_PROB_THRESHOLD
+            ):
+                decoded.append(("", []))  # тишина
+                continue
+            segments = self._parse_segments(tokens, tok, duration)
+            # Незавершённое окно или низкая уверенность — клип уйдёт в transcribe
+            if segments is None or avg_logprob < LOG_PROB_THRESHOLD:
+                decoded.append(None)
+                continue
+            text = " ".join(seg["text"] for seg in segments if seg["text"])
+            if get_compression_ratio(text) > COMPRESSION_RATIO_THRESHOLD:
+                decoded.append(None)
+                continue
+            decoded.append((text, segments))
+        return decoded
+
+    def _parse_segments(
+        self, tokens: List[int], tok: Tokenizer, duration: float
+    ) -> Optional[Segments]:
+        """
+        Сегменты по токенам-меткам времени одного окна. None, если окно
+        закончилось на незавершённом сегменте (нужен следующий проход).
+        """
+        ts_begin = tok.timestamp_begin
+        precision = self.model.time_precision
+
+        def make(sliced: List[int]) -> dict:
+            start = (sliced[0] - ts_begin) * precision if sliced[0] >= ts_begin else 0.0
+            end = (sliced[-1] - ts_begin) * precision if sliced[-1] >= ts_begin else 0.0
+            return {
+                "start_ms": int(start * 1000),
+                "end_ms": int(end * 1000),
+                "text": tok.decode(sliced).strip(),
+            }
+
+        single_ending = len(tokens) >= 2 and tokens[-2] < ts_begin <= tokens[-1]
+        cuts = [
+            i
+            for i in range(1, len(tokens))
+            if tokens[i] >= ts_begin and tokens[i - 1] >= ts_begin
+        ]
+        if not cuts:
+            # Один сегмент на всё окно
+            timestamps = [t for t in tokens if t >= ts_begin]
+            if timestamps and timestamps[-1] != ts_begin:
+                duration = (timestamps[-1] - ts_begin) * precision
+            return [
+                {
+                    "start_ms": 0,
+                    "end_ms": int(duration * 1000),
+                    "text": tok.decode(tokens).strip(),
+                }
+            ]
+        if not single_ending:
+            return None
+
+        segments, last = [], 0
+        for cut in cuts + [len(tokens)]:
+            if cut > last:
+                segments.append(make(tokens[last:cut]))
+            last = cut
+        return segments
+
@@ -0,0 +1,80 @@
+from typing import AsyncIterable, Optional
+
+import numpy as np
+
+from app.resampling import StreamResampler
+
+# Вход Whisper: клипы ресемплируются целиком, задержка не важна — длинный
+# фильтр с крутым срезом (TTS обходится 16 отсчётами на фазу ради задержки)
+RESAMPLE_TAPS = 32
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(
+    chunks: AsyncIterable[bytes], max_bytes: int, expected: Optional[int] = None
+) -> memoryview:
+    """
+    Читает тело запроса по кускам в заранее выделенный буфер.
+
+    При известном Content-Length (`expected`) буфер выделяется один раз
+    нужного размера и куски копируются прямо в него; без него буфер растёт.
+    Больше `max_bytes` не читается — `BodyTooLarge`.
+    """
+    if expected is not None and expected > max_bytes:
+        raise BodyTooLarge(f"body of {expected} bytes exceeds {max_bytes}")
+    buf = bytearray(expected or 0)
+    size = 0
+    async for chunk in chunks:
+        end = size + len(chunk)
+        if end > max_bytes:
+            raise BodyTooLarge(f"body exceeds {max_bytes} bytes")
+        if end > len(buf):
+            buf.extend(bytes(end - len(buf)))
+        buf[size:end] = chunk
+        size = end
+    return memoryview(buf)[:size]
+
+
+def pcm16_to_float32(data, channels: int = 1) -> np.ndarray:
+    """
+    int16 PCM (чередующиеся каналы) -> моно float32 в [-1, 1) за один проход.
+
+    Даунмикс и масштабирование делаются сразу в float32-результат, без
+    промежуточных float64/int16 копий. Неполный последний кадр отбрасывается.
+    """
+    frame = 2 * channels
+    view = memoryview(data).cast("B")
+    pcm = np.frombuffer(view[: len(view) - len(view) % frame], dtype="<i2")
+    if channels == 1:
+        return np.multiply(pcm, np.float32(1 / 32768), dtype=np.float32)
+    frames = pcm.reshape(-1, channels)
+    out = np.add(frames[:, 0], frames[:, 1], dtype=np.float32)
+    for c in range(2, channels):
+        np.add(out, frames[:, c], out=out, dtype=np.float32)
+    out *= np.float32(1 / (32768 * channels))
+    return out
+
+
+def resample(audio: np.ndarray, src_rate: int, dst_rate: int, block_s: float = 10.0) -> np.ndarray:
+    """
+    Весь клип из `src_rate` в `dst_rate` (float32).
+
+    Идёт блоками по `block_s` секунд входа, чтобы промежуточная матрица окон
+    не росла с длиной записи; результат пишется в заранее выделенный массив.
+    """
+    if src_rate == dst_rate:
+        return audio
+    resampler = StreamResampler(src_rate, dst_rate, RESAMPLE_TAPS)
+    out = np.empty(-(-len(audio) * resampler.up // resampler.down), dtype=np.float32)
+    pos = 0
+    block = max(1, int(block_s * src_rate))
+    for start in range(0, len(audio), block):
+        piece = resampler.process(audio[start : start + block])
+        out[pos : pos + len(piece)] = piece
+        pos += len(piece)
+    tail = resampler.flush()
+    out[pos : pos + len(tail)] = tail
+    return out
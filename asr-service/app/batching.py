@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Generic, List, Optional, Sequence, Tuple, TypeVar, Union
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Собирает запросы, пришедшие почти одновременно, в один батч.
+
+    Батч закрывается, когда набралось `max_batch_size` элементов или прошло
+    `max_delay_ms` с момента прихода первого из них, и целиком передаётся в
+    `run_batch`, который возвращает результаты в том же порядке — список или
+    Future со списком (например, задание в `InferencePool`). Одиночный запрос
+    на пустом сервисе ждёт не дольше `max_delay_ms`.
+
+    Одновременно выполняется не больше `max_inflight` батчей: следующий батч
+    начинает собираться, только когда освободилось место, а запросы, пришедшие
+    тем временем, копятся и уходят в него вместе.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Sequence[T]], Union[List[R], "Future[List[R]]"]],
+        max_batch_size: int = 8,
+        max_delay_ms: float = 20.0,
+        max_inflight: int = 1,
+        name: str = "asr-batcher",
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_delay = max(0.0, float(max_delay_ms)) / 1000.0
+        self._inflight = threading.Semaphore(max(1, int(max_inflight)))
+
+        self._queue: "queue.Queue[Tuple[T, Future]]" = queue.Queue()
+        self._closed = threading.Event()
+        self.batches = 0
+        self.items = 0
+
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: T) -> "Future[R]":
+        if self._closed.is_set():
+            raise RuntimeError("batcher is closed")
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self) -> List[Tuple[T, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while not self._closed.is_set():
+            self._inflight.acquire()
+            batch = self._collect()
+            # Отменённые запросы в батч не попадают
+            batch = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                self._inflight.release()
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except BaseException as e:
+                self._finish(batch, None, e)
+                continue
+            if isinstance(results, Future):
+                results.add_done_callback(partial(self._finish_future, batch))
+            else:
+                self._finish(batch, results, None)
+
+    def _finish_future(self, batch: List[Tuple[T, Future]], done: Future) -> None:
+        error = done.exception()
+        self._finish(batch, None if error else done.result(), error)
+
+    def _finish(
+        self,
+        batch: List[Tuple[T, Future]],
+        results: Optional[List[R]],
+        error: Optional[BaseException],
+    ) -> None:
+        self._inflight.release()
+        if error is not None:
+            logger.error("Batch of %d failed", len(batch), exc_info=error)
+            for _, fut in batch:
+                fut.set_exception(error)
+            return
+        for (_, fut), result in zip(batch, results):
+            fut.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": self._queue.qsize(),
+        }
+
+    def close(self) -> None:
+        self._closed.set()
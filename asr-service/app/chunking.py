@@ -0,0 +1,45 @@
+from typing import List, Tuple
+
+import numpy as np
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from app.asr import Segments
+
+
+def plan_chunks(
+    audio: np.ndarray,
+    sample_rate: int = 16000,
+    max_chunk_s: float = 30.0,
+    min_silence_ms: int = 500,
+) -> List[Tuple[int, int]]:
+    """
+    Делит длинную запись на куски не длиннее `max_chunk_s` по паузам (Silero VAD).
+
+    Соседние фразы склеиваются, пока кусок помещается в окно Whisper, так что
+    кусков немного и каждый режется на тишине. Участки без речи отбрасываются.
+    Возвращает границы кусков в отсчётах [(начало, конец)].
+    """
+    speech = get_speech_timestamps(
+        audio,
+        VadOptions(
+            min_silence_duration_ms=min_silence_ms,
+            max_speech_duration_s=max_chunk_s,
+            speech_pad_ms=200,
+        ),
+    )
+    max_samples = int(max_chunk_s * sample_rate)
+    chunks: List[List[int]] = []
+    for span in speech:
+        if chunks and span["end"] - chunks[-1][0] <= max_samples:
+            chunks[-1][1] = span["end"]
+        else:
+            chunks.append([span["start"], span["end"]])
+    return [(start, end) for start, end in chunks]
+
+
+def shift_segments(segments: Segments, offset_ms: int) -> Segments:
+    """Таймкоды сегментов куска -> таймкоды от начала всей записи."""
+    return [
+        {**seg, "start_ms": seg["start_ms"] + offset_ms, "end_ms": seg["end_ms"] + offset_ms}
+        for seg in segments
+    ]
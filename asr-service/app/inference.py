@@ -0,0 +1,188 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Generic, List, Optional, Sequence, Set, TypeVar
+
+logger = logging.getLogger(__name__)
+
+M = TypeVar("M")
+
+
+def partition_cpus(groups: int, per_group: int = 0) -> Optional[List[Set[int]]]:
+    """
+    Делит доступные процессу ядра на `groups` непересекающихся наборов.
+
+    `per_group=0` — поровну на всех. Если ядер не хватает, наборы идут по
+    кругу (пересекаются), о чём пишется предупреждение. На платформах без
+    sched_getaffinity возвращает None.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    groups = max(1, int(groups))
+    per_group = int(per_group) or max(1, len(cpus) // groups)
+    if groups * per_group > len(cpus):
+        logger.warning(
+            "CPU affinity: %d groups x %d cores > %d available, groups will overlap",
+            groups,
+            per_group,
+            len(cpus),
+        )
+    return [
+        {cpus[(g * per_group + k) % len(cpus)] for k in range(per_group)}
+        for g in range(groups)
+    ]
+
+
+class _Job:
+    __slots__ = ("fn", "args", "future")
+
+    def __init__(self, fn: Callable, args: tuple, future: Future):
+        self.fn = fn
+        self.args = args
+        self.future = future
+
+
+class InferencePool(Generic[M]):
+    """
+    Выделенные потоки инференса, каждый со своим экземпляром модели.
+
+    Создаётся `models` экземпляров через `factory(index)`; каждый обслуживают
+    `threads_per_model` потоков, берущих задания из общей очереди. Если задан
+    `cpu_sets`, потоки экземпляра (и потоки, которые модель создаёт при
+    загрузке) привязываются к своему набору ядер, так что экземпляры не
+    конкурируют за кэши и ядра друг друга.
+
+    Конструктор ждёт загрузки всех экземпляров и пробрасывает первую ошибку.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[int], M],
+        models: int = 1,
+        threads_per_model: int = 1,
+        cpu_sets: Optional[Sequence[Set[int]]] = None,
+        name: str = "asr-infer",
+    ):
+        self.models = max(1, int(models))
+        self.threads_per_model = max(1, int(threads_per_model))
+        self.cpu_sets = list(cpu_sets) if cpu_sets else None
+
+        self._jobs: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._busy = [0] * self.models
+        self._done = [0] * self.models
+        self._threads: List[threading.Thread] = []
+
+        loaded: List[Future] = []
+        for index in range(self.models):
+            ready: Future = Future()
+            thread = threading.Thread(
+                target=self._start_model,
+                args=(index, factory, ready),
+                name=f"{name}-{index}-0",
+                daemon=True,
+            )
+            self._threads.append(thread)
+            thread.start()
+            loaded.append(ready)
+        try:
+            for ready in loaded:
+                ready.result()
+        except BaseException:
+            self.close()
+            raise
+
+    def _cores(self, index: int) -> Optional[Set[int]]:
+        if not self.cpu_sets:
+            return None
+        return self.cpu_sets[index % len(self.cpu_sets)]
+
+    def _pin(self, index: int) -> None:
+        cores = self._cores(index)
+        if cores:
+            # pid 0 — текущий поток; создаваемые им потоки наследуют маску
+            os.sched_setaffinity(0, cores)
+
+    def _start_model(self, index: int, factory: Callable[[int], M], ready: Future):
+        try:
+            self._pin(index)
+            model = factory(index)
+        except BaseException as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        logger.info(
+            "Inference model %d ready (threads=%d, cores=%s)",
+            index,
+            self.threads_per_model,
+            sorted(self._cores(index)) if self._cores(index) else "any",
+        )
+
+        prefix = threading.current_thread().name.rsplit("-", 1)[0]
+        for k in range(1, self.threads_per_model):
+            thread = threading.Thread(
+                target=self._serve,
+                args=(index, model),
+                name=f"{prefix}-{k}",
+                daemon=True,
+            )
+            with self._lock:
+                self._threads.append(thread)
+            thread.start()
+        self._serve(index, model)
+
+    def _serve(self, index: int, model: M) -> None:
+        self._pin(index)
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self._busy[index] += 1
+            try:
+                result = job.fn(model, *job.args)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                with self._lock:
+                    self._busy[index] -= 1
+                    self._done[index] += 1
+
+    @property
+    def size(self) -> int:
+        """Сколько заданий может выполняться одновременно."""
+        return self.models * self.threads_per_model
+
+    def submit(self, fn: Callable[..., object], *args) -> Future:
+        """Выполнить `fn(model, *args)` на свободном экземпляре модели."""
+        future: Future = Future()
+        self._jobs.put(_Job(fn, args, future))
+        return future
+
+    def stats(self) -> dict:
+        with self._lock:
+            workers = [
+                {
+                    "busy": self._busy[i],
+                    "done": self._done[i],
+                    "cores": sorted(self._cores(i)) if self._cores(i) else None,
+                }
+                for i in range(self.models)
+            ]
+        return {
+            "models": self.models,
+            "threads_per_model": self.threads_per_model,
+            "pending": self._jobs.qsize(),
+            "workers": workers,
+        }
+
+    def close(self) -> None:
+        for _ in range(self.size):
+            self._jobs.put(None)
@@ -1,70 +1,501 @@
+import asyncio
+import json
 import logging
+import time
+from contextlib import aclosing, suppress
+from typing import AsyncIterator, List, Optional
 
 import numpy as np
-from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi import (
+    FastAPI,
+    File,
+    Header,
+    HTTPException,
+    Query,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.requests import Request
 
+from app.admission import PRIORITY_CLASSES, AdmissionController, Overloaded
 from app.asr import ASRModel
+from app.audio import (
+    RESAMPLE_TAPS,
+    BodyTooLarge,
+    StreamResampler,
+    pcm16_to_float32,
+    read_body,
+    resample,
+)
+from app.batching import MicroBatcher
+from app.chunking import plan_chunks, shift_segments
+from app.inference import InferencePool, partition_cpus
 from app.logging_conf import setup_logging
+from app.readiness import Readiness
 from app.schemas import STTResponse
 from app.settings import settings
+from app.streaming import StreamingTranscriber, segment_message
 
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="ASR Service", version="1.0.0")
 setup_logging(settings.LOG_LEVEL)
 
-asr_model = None
+# Инференс блокирующий: он идёт в потоках пула, а не в event loop
+inference = None
+batcher = None
+
+# Whisper занимает все ядра: лишние запросы ждут в очереди, а не делят CPU
+PRIORITY_PATTERN = "^(" + "|".join(PRIORITY_CLASSES) + ")$"
+
+admission = AdmissionController(
+    concurrency=settings.ASR_MAX_CONCURRENT,
+    max_queue=settings.ASR_MAX_QUEUE,
+    queue_timeout=settings.ASR_QUEUE_TIMEOUT,
+)
+
+
+readiness = Readiness()
+_loading: Optional[asyncio.Task] = None
+
+
+def _load_instance(index: int) -> ASRModel:
+    with readiness.phase(f"model_{index}_load"):
+        model = ASRModel(
+            model_size=settings.ASR_MODEL_SIZE,
+            cpu_threads=settings.ASR_CPU_THREADS,
+            num_workers=settings.ASR_NUM_WORKERS,
+            download_root=settings.ASR_MODELS_DIR,
+        )
+    # Прогрев в том же (привязанном к ядрам) потоке, что и загрузка
+    with readiness.phase(f"model_{index}_warmup"):
+        model.warmup()
+    return model
 
 
-@app.on_event("startup")
 async def load_model():
-    global asr_model
-    logger.info("Loading ASR model: faster-whisper %s", settings.ASR_MODEL_SIZE)
-    asr_model = ASRModel(model_size=settings.ASR_MODEL_SIZE)
+    global inference, batcher
+    logger.info(
+        "Loading ASR model: faster-whisper %s x%d",
+        settings.ASR_MODEL_SIZE,
+        settings.ASR_WORKERS,
+    )
+    cpu_sets = None
+    if settings.ASR_CPU_AFFINITY:
+        # По ядру на поток CTranslate2; при ASR_CPU_THREADS=0 — поровну
+        cpu_sets = partition_cpus(
+            settings.ASR_WORKERS, settings.ASR_CPU_THREADS * settings.ASR_NUM_WORKERS
+        )
+    try:
+        with readiness.phase("pool"):
+            pool = await asyncio.to_thread(
+                InferencePool,
+                _load_instance,
+                models=settings.ASR_WORKERS,
+                threads_per_model=settings.ASR_NUM_WORKERS,
+                cpu_sets=cpu_sets,
+            )
+    except Exception as e:
+        logger.exception("ASR model loading failed")
+        readiness.fail(e)
+        return
+    if settings.ASR_BATCH_SIZE > 1:
+        batcher = MicroBatcher(
+            lambda clips: pool.submit(ASRModel.transcribe_batch, clips),
+            max_batch_size=settings.ASR_BATCH_SIZE,
+            max_delay_ms=settings.ASR_BATCH_DELAY_MS,
+            max_inflight=pool.size,
+        )
+    inference = pool
+    readiness.mark_ready()
     logger.info("ASR model loaded.")
 
 
+@app.on_event("startup")
+async def startup():
+    global _loading
+    # Порт открывается сразу, модель грузится в фоне; готовность — /readyz
+    _loading = asyncio.create_task(load_model())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _loading is not None:
+        _loading.cancel()
+    if batcher is not None:
+        batcher.close()
+    if inference is not None:
+        inference.close()
+
+
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
 
 
+@app.get("/readyz")
+async def readyz():
+    status = readiness.status()
+    return JSONResponse(status, status_code=200 if readiness.ready else 503)
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "admission": admission.stats(),
+        "batching": batcher.stats() if batcher else None,
+        "inference": inference.stats() if inference else None,
+    }
+
+
+async def transcribe_clip(audio: np.ndarray, sr: int, lang: str):
+    """Один клип не длиннее окна Whisper: через батчер, если он включён."""
+    if batcher is not None:
+        return await asyncio.wrap_future(batcher.submit((audio, lang)))
+    return await asyncio.wrap_future(
+        inference.submit(ASRModel.transcribe, audio, sr, lang)
+    )
+
+
+async def transcribe_chunks(
+    audio: np.ndarray,
+    sr: int,
+    lang: str,
+    priority: str = "interactive",
+    deadline: Optional[float] = None,
+) -> AsyncIterator[dict]:
+    """
+    Распознаёт запись любой длины: длинная делится по паузам (VAD) на куски
+    до ASR_CHUNK_S, куски распознаются параллельно на всём пуле. Результаты
+    отдаются по мере готовности (не по порядку) с таймкодами от начала записи.
+
+    Каждый кусок занимает своё место в admission: длинная запись нагружает
+    пул как столько же коротких запросов, и interactive-запросы встают между
+    её кусками. Если место не дождались — Overloaded.
+    """
+    if len(audio) <= settings.ASR_CHUNK_S * sr:
+        chunks = [(0, len(audio))]
+    else:
+        chunks = await asyncio.to_thread(
+            plan_chunks, audio, sr, settings.ASR_CHUNK_S, settings.ASR_VAD_MIN_SILENCE_MS
+        )
+    # Столько кусков в работе, сколько пул может взять (с полными батчами),
+    # но не больше мест admission: одна запись не забивает очередь целиком
+    window = asyncio.Semaphore(
+        min(inference.size * max(1, settings.ASR_BATCH_SIZE), admission.concurrency)
+    )
+
+    async def run(index: int, start: int, end: int) -> dict:
+        async with window, admission.slot(priority, timeout=remaining_s(deadline)):
+            text, segments = await transcribe_clip(audio[start:end], sr, lang)
+        offset_ms = int(start * 1000 / sr)
+        return {
+            "index": index,
+            "start_ms": offset_ms,
+            "end_ms": int(end * 1000 / sr),
+            "text": text,
+            "segments": shift_segments(segments, offset_ms),
+        }
+
+    tasks = [asyncio.create_task(run(i, *chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def merge_chunks(results: List[dict]) -> STTResponse:
+    results = sorted(results, key=lambda r: r["index"])
+    return STTResponse(
+        text=" ".join(r["text"] for r in results if r["text"]),
+        segments=[seg for r in results for seg in r["segments"]],
+    )
+
+
+def deadline_at(deadline_ms: Optional[int]) -> Optional[float]:
+    """X-Request-Deadline-Ms (остаток бюджета клиента) -> момент по time.monotonic()."""
+    return None if deadline_ms is None else time.monotonic() + deadline_ms / 1000
+
+
+def remaining_s(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else deadline - time.monotonic()
+
+
+async def ndjson_chunks(
+    audio: np.ndarray, sr: int, lang: str, priority: str, deadline: Optional[float] = None
+) -> AsyncIterator[str]:
+    """
+    Потоковый ответ: строка `chunk` на каждый готовый кусок, затем `result`
+    со склеенным STTResponse. Ошибки после начала ответа — строкой `error`.
+    """
+    results = []
+    try:
+        chunks = transcribe_chunks(audio, sr, lang, priority, deadline)
+        async with aclosing(chunks):
+            async for result in chunks:
+                results.append(result)
+                yield json.dumps({"type": "chunk", **result}) + "\n"
+        merged = merge_chunks(results)
+        yield json.dumps({"type": "result", **merged.model_dump()}) + "\n"
+    except Overloaded as e:
+        yield json.dumps(
+            {"type": "error", "error": str(e), "code": "overloaded", "retry_after": e.retry_after}
+        ) + "\n"
+    except Exception as e:
+        logger.exception("Error during streaming STT processing")
+        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+
+
+async def recognize(
+    audio: np.ndarray,
+    sr: int,
+    lang: str,
+    priority: str,
+    stream: bool,
+    deadline: Optional[float] = None,
+):
+    """
+    Общая часть /api/stt/*: аудио уже моно float32. Если к `deadline`
+    (time.monotonic()) место в очереди не освободилось — 503, как при перегрузке.
+    """
+    try:
+        duration_sec = len(audio) / sr
+        if duration_sec > settings.ASR_MAX_AUDIO_S:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Audio too long ({duration_sec:.2f}s > {settings.ASR_MAX_AUDIO_S:g}s)",
+            )
+
+        # Whisper и VAD работают на 16 кГц: 8 кГц телефонии и 48 кГц WebRTC
+        # приводятся здесь, клиентам не нужен отдельный транскодинг
+        if sr != settings.ASR_SAMPLE_RATE:
+            audio = await asyncio.to_thread(resample, audio, sr, settings.ASR_SAMPLE_RATE)
+            sr = settings.ASR_SAMPLE_RATE
+
+        if stream:
+            return StreamingResponse(
+                ndjson_chunks(audio, sr, lang, priority, deadline),
+                media_type="application/x-ndjson",
+            )
+
+        chunks = transcribe_chunks(audio, sr, lang, priority, deadline)
+        async with aclosing(chunks):
+            results = [result async for result in chunks]
+        return merge_chunks(results)
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error during STT processing")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/stt/bytes", response_model=STTResponse)
 async def stt_bytes(
     request: Request,
     sr: int = Query(default=16000, ge=8000, le=48000),
     ch: int = Query(default=1, ge=1, le=2),
     lang: str = Query(default="en"),
+    priority: str = Query(default="interactive", pattern=PRIORITY_PATTERN),
+    stream: bool = Query(default=False),
     file: UploadFile = File(...),
+    deadline_ms: Optional[int] = Header(default=None, alias="X-Request-Deadline-Ms", ge=0),
+):
+    deadline = deadline_at(deadline_ms)
+    if not inference:
+        raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+    audio_bytes = await file.read()
+    if len(audio_bytes) == 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    return await recognize(
+        pcm16_to_float32(audio_bytes, ch), sr, lang, priority, stream, deadline
+    )
+
+
+@app.post("/api/stt/raw", response_model=STTResponse)
+async def stt_raw(
+    request: Request,
+    sr: int = Query(default=16000, ge=8000, le=48000),
+    ch: int = Query(default=1, ge=1, le=2),
+    lang: str = Query(default="en"),
+    priority: str = Query(default="interactive", pattern=PRIORITY_PATTERN),
+    stream: bool = Query(default=False),
+    deadline_ms: Optional[int] = Header(default=None, alias="X-Request-Deadline-Ms", ge=0),
 ):
-    if not asr_model:
+    """
+    То же, что /api/stt/bytes, но PCM приходит телом запроса
+    (application/octet-stream), без multipart.
+    """
+    deadline = deadline_at(deadline_ms)
+    if not inference:
         raise HTTPException(status_code=503, detail="Model not loaded yet")
 
+    length = request.headers.get("content-length")
     try:
-        audio_bytes = await file.read()
-        if len(audio_bytes) == 0:
-            raise HTTPException(status_code=400, detail="Empty file")
+        body = await read_body(
+            request.stream(),
+            max_bytes=int(settings.ASR_MAX_AUDIO_S * sr * ch * 2),
+            expected=int(length) if length and length.isdigit() else None,
+        )
+    except BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"Audio too long: {e}")
+    if len(body) == 0:
+        raise HTTPException(status_code=400, detail="Empty body")
+    return await recognize(pcm16_to_float32(body, ch), sr, lang, priority, stream, deadline)
 
-        audio_np = np.frombuffer(audio_bytes, dtype=np.int16)
-        if ch == 2:
-            audio_np = audio_np.reshape(-1, 2).mean(axis=1).astype(np.int16)
 
-        duration_sec = len(audio_np) / sr
-        if duration_sec > 15:
-            raise HTTPException(
-                status_code=413, detail=f"Audio too long ({duration_sec:.2f}s > 15s)"
+class STTStream:
+    """
+    Одно соединение /ws/stt.
+
+    Клиент шлёт бинарные кадры int16 PCM по мере записи и `{"type": "end"}`
+    в конце фразы. Сервер каждые ASR_STREAM_STEP_MS перераспознаёт
+    нестабильный хвост и шлёт `partial` (заменяет предыдущий), `final` для
+    зафиксированных слов и `end` с полным текстом фразы. После `end` можно
+    начинать следующую фразу в том же соединении.
+    """
+
+    def __init__(self, ws: WebSocket, lang: str, sr: int, ch: int, priority: str):
+        self.ws = ws
+        self.lang = lang
+        self.sr = sr
+        self.ch = ch
+        self.priority = priority
+        self._resampler = self._new_resampler()
+        self.stream = StreamingTranscriber(
+            sample_rate=settings.ASR_SAMPLE_RATE,
+            step_ms=settings.ASR_STREAM_STEP_MS,
+            max_buffer_s=settings.ASR_STREAM_MAX_BUFFER_S,
+        )
+        self._decoding: Optional[asyncio.Task] = None
+        self._carry = b""  # неполный кадр из прошлого сообщения
+
+    async def send(self, message: Optional[dict]):
+        if message is not None:
+            await self.ws.send_text(json.dumps(message))
+
+    def _samples(self, data: bytes) -> np.ndarray:
+        data = self._carry + data
+        frame = 2 * self.ch
+        cut = len(data) - len(data) % frame
+        self._carry = data[cut:]
+        audio = pcm16_to_float32(data[:cut], self.ch)
+        if self._resampler is not None:
+            audio = self._resampler.process(audio)
+        return audio
+
+    def _new_resampler(self) -> Optional[StreamResampler]:
+        if self.sr == settings.ASR_SAMPLE_RATE:
+            return None
+        return StreamResampler(self.sr, settings.ASR_SAMPLE_RATE, RESAMPLE_TAPS)
+
+    async def _decode(self, final: bool = False):
+        audio, prompt, offset = self.stream.snapshot()
+        try:
+            async with admission.slot(self.priority):
+                words = await asyncio.wrap_future(
+                    inference.submit(ASRModel.transcribe_words, audio, self.lang, prompt)
+                )
+        except Overloaded as e:
+            if not final:
+                # Хвост перераспознается на следующем шаге вместе с новым аудио
+                return
+            await self.send(
+                {"error": str(e), "code": "overloaded", "retry_after": e.retry_after}
             )
+            await self.send(segment_message(self.stream.commit_all(), "final"))
+            return
+        committed, unstable = self.stream.update(words, offset, final=final)
+        await self.send(segment_message(committed, "final"))
+        if not final:
+            await self.send(segment_message(unstable, "partial"))
+
+    async def _decode_pending(self):
+        # Аудио, пришедшее во время декодирования, разбирается сразу за ним
+        while self.stream.ready:
+            await self._decode()
+
+    async def _wait_decoding(self):
+        if self._decoding is not None:
+            task, self._decoding = self._decoding, None
+            await task
+
+    async def run(self):
+        try:
+            while True:
+                message = await self.ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    self.stream.append(self._samples(message["bytes"]))
+                    if self._decoding is not None and self._decoding.done():
+                        await self._wait_decoding()
+                    if self.stream.ready and self._decoding is None:
+                        self._decoding = asyncio.create_task(self._decode_pending())
+                    continue
+
+                try:
+                    payload = json.loads(message.get("text") or "")
+                except ValueError:
+                    payload = None
+                if not isinstance(payload, dict) or payload.get("type") != "end":
+                    await self.send({"error": 'expected binary PCM or {"type": "end"}'})
+                    continue
+                await self._wait_decoding()
+                if self._resampler is not None:
+                    self.stream.append(self._resampler.flush())
+                    self._resampler = self._new_resampler()
+                await self._decode(final=True)
+                await self.send({"type": "end", "text": self.stream.text})
+                self.stream.reset()
+                self._carry = b""
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.exception("Error during streaming STT")
+            with suppress(Exception):
+                await self.send({"error": str(e)})
+        finally:
+            if self._decoding is not None:
+                self._decoding.cancel()
+        logger.info("STT stream closed")
+
+
+@app.websocket("/ws/stt")
+async def ws_stt(
+    ws: WebSocket,
+    sr: int = 16000,
+    ch: int = 1,
+    lang: str = "en",
+    priority: str = "interactive",
+):
+    await ws.accept()
+    error = None
+    if inference is None:
+        error = "Model not loaded yet"
+    elif not 8000 <= sr <= 48000:
+        error = "sr must be within 8000..48000"
+    elif ch not in (1, 2):
+        error = "ch must be 1 or 2"
+    elif priority not in PRIORITY_CLASSES:
+        error = f"unknown priority {priority!r}"
+    if error is not None:
+        await ws.send_text(json.dumps({"error": error}))
+        await ws.close(code=1008)
+        return
+    await STTStream(ws, lang=lang, sr=sr, ch=ch, priority=priority).run()
 
-        audio_float = audio_np.astype(np.float32) / 32768.0
 
-        text, segments = asr_model.transcribe(audio_float, sr, lang)
-        return STTResponse(text=text, segments=segments)
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.exception("Error during STT processing")
-        raise HTTPException(status_code=500, detail=str(e))
 if __name__ == "__main__":
     import uvicorn
 
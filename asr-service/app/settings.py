@@ -11,5 +11,37 @@ class Settings(BaseSettings):
     ASR_HOST: str
     ASR_PORT: int
 
+    # Запросы в работе одновременно (включая ждущие сборки батча);
+    # остальные ждут в очереди
+    ASR_MAX_CONCURRENT: int = 8
+    ASR_MAX_QUEUE: int = 32
+    # Сколько секунд запрос может ждать в очереди до ответа 503
+    ASR_QUEUE_TIMEOUT: float = 10.0
+
+    # Микробатчинг: клипы, пришедшие в течение окна, распознаются одним
+    # проходом энкодера/декодера (1 = без батчинга)
+    ASR_BATCH_SIZE: int = 8
+    ASR_BATCH_DELAY_MS: float = 20.0
+
+    # Пул инференса: ASR_WORKERS экземпляров модели, у каждого ASR_NUM_WORKERS
+    # потоков-обработчиков по ASR_CPU_THREADS потоков CTranslate2 (0 — по умолчанию).
+    # Пропускная способность: много однопоточных; задержка: мало многопоточных
+    ASR_WORKERS: int = 1
+    ASR_NUM_WORKERS: int = 1
+    ASR_CPU_THREADS: int = 0
+    # Привязать каждый экземпляр к своему набору ядер (Linux)
+    ASR_CPU_AFFINITY: bool = False
+
+    # Потоковое распознавание (/ws/stt): как часто перераспознавать хвост буфера
+    # и сколько секунд нестабильного аудио держать, прежде чем зафиксировать
+    ASR_STREAM_STEP_MS: int = 500
+    ASR_STREAM_MAX_BUFFER_S: float = 15.0
+
+    # Длинные записи (до ASR_MAX_AUDIO_S, дальше 413) делятся по паузам на куски
+    # до ASR_CHUNK_S, которые распознаются параллельно
+    ASR_MAX_AUDIO_S: float = 3600.0
+    ASR_CHUNK_S: float = 30.0
+    ASR_VAD_MIN_SILENCE_MS: int = 500
+
 
 settings = Settings()
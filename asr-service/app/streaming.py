@@ -0,0 +1,157 @@
+import re
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# (начало, конец в секундах от начала потока, слово)
+Word = Tuple[float, float, str]
+
+_PUNCT = re.compile(r"[^\w']+")
+
+
+def _norm(word: str) -> str:
+    return _PUNCT.sub("", word.lower())
+
+
+class StreamingTranscriber:
+    """
+    Состояние потокового распознавания одного соединения (LocalAgreement-2).
+
+    Аудио копится в буфере; каждые `step_ms` новый хвост буфера
+    распознаётся заново. Слова, на которых сошлись две последние гипотезы,
+    фиксируются: они больше не меняются, буфер обрезается по концу последнего
+    из них, а их текст уходит в prompt следующих декодирований. Остальные
+    слова гипотезы — нестабильный хвост (partial).
+
+    Само распознавание делает вызывающий код: `snapshot()` отдаёт аудио и
+    prompt, результат передаётся в `update()`.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        step_ms: float = 500.0,
+        max_buffer_s: float = 15.0,
+        prompt_chars: int = 200,
+    ):
+        self.sample_rate = int(sample_rate)
+        self.step = max(1, int(self.sample_rate * step_ms / 1000))
+        self.max_buffer = max(self.step, int(self.sample_rate * max_buffer_s))
+        self.prompt_chars = int(prompt_chars)
+        self.reset()
+
+    def reset(self) -> None:
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._offset = 0.0  # время начала буфера от начала потока
+        self._pending = 0  # отсчётов пришло после последнего snapshot
+        self.committed: List[Word] = []
+        self.hypothesis: List[Word] = []
+
+    @property
+    def buffered_s(self) -> float:
+        return len(self._buffer) / self.sample_rate
+
+    @property
+    def ready(self) -> bool:
+        """Пришло достаточно нового аудио для следующего декодирования."""
+        return self._pending >= self.step
+
+    @property
+    def text(self) -> str:
+        return " ".join(w for _, _, w in self.committed)
+
+    def append(self, samples: np.ndarray) -> None:
+        self._buffer = np.concatenate([self._buffer, samples.astype(np.float32, copy=False)])
+        self._pending += len(samples)
+
+    def prompt(self) -> str:
+        return self.text[-self.prompt_chars :] if self.prompt_chars else ""
+
+    def snapshot(self) -> Tuple[np.ndarray, str, float]:
+        """Аудио для декодирования, prompt и время начала этого аудио."""
+        self._pending = 0
+        return self._buffer, self.prompt(), self._offset
+
+    def _new_words(self, words: Sequence[Word], offset: float) -> List[Word]:
+        last_end = self.committed[-1][1] if self.committed else 0.0
+        fresh = [
+            (offset + s, offset + e, w.strip())
+            for s, e, w in words
+            if w.strip() and offset + s > last_end - 0.1
+        ]
+        # Whisper иногда повторяет конец prompt в начале окна — отбросить повтор
+        if fresh and self.committed:
+            tail = [_norm(w) for _, _, w in self.committed[-5:]]
+            head = [_norm(w) for _, _, w in fresh[:5]]
+            for n in range(min(len(tail), len(head)), 0, -1):
+                if tail[-n:] == head[:n]:
+                    return fresh[n:]
+        return fresh
+
+    def _commit(self, words: List[Word]) -> None:
+        if not words:
+            return
+        self.committed.extend(words)
+        end = words[-1][1]
+        cut = int(round((end - self._offset) * self.sample_rate))
+        cut = min(max(cut, 0), len(self._buffer))
+        self._buffer = self._buffer[cut:]
+        self._offset += cut / self.sample_rate
+
+    def update(
+        self, words: Sequence[Word], offset: float, final: bool = False
+    ) -> Tuple[List[Word], List[Word]]:
+        """
+        Учесть гипотезу для аудио, начинавшегося в `offset`.
+
+        Возвращает (только что зафиксированные слова, нестабильный хвост).
+        `final=True` фиксирует всю гипотезу (конец фразы).
+        """
+        current = self._new_words(words, offset)
+
+        agreed = 0
+        for new, old in zip(current, self.hypothesis):
+            if _norm(new[2]) != _norm(old[2]):
+                break
+            agreed += 1
+
+        # Буфер перерос лимит, а гипотеза так и не стабилизировалась
+        overflow = len(self._buffer) > self.max_buffer
+        if final or overflow:
+            agreed = len(current)
+
+        committed = current[:agreed]
+        self.hypothesis = current[agreed:]
+        self._commit(committed)
+        if overflow and len(self._buffer) > self.max_buffer:
+            # Ни одного слова в переполненном буфере — тишина или шум
+            cut = len(self._buffer) - self.max_buffer
+            self._buffer = self._buffer[cut:]
+            self._offset += cut / self.sample_rate
+        if final:
+            self._drop_buffer()
+        return committed, self.hypothesis
+
+    def _drop_buffer(self) -> None:
+        self._offset += len(self._buffer) / self.sample_rate
+        self._buffer = self._buffer[:0]
+        self._pending = 0
+
+    def commit_all(self) -> List[Word]:
+        """Зафиксировать текущую гипотезу как есть (без нового декодирования)."""
+        committed, self.hypothesis = self.hypothesis, []
+        self._commit(committed)
+        self._drop_buffer()
+        return committed
+
+
+def segment_message(words: Sequence[Word], kind: str) -> Optional[dict]:
+    """JSON-сообщение для группы слов: partial (заменяет прежний) или final."""
+    if not words and kind == "final":
+        return None
+    return {
+        "type": kind,
+        "text": " ".join(w for _, _, w in words),
+        "start_ms": int(words[0][0] * 1000) if words else None,
+        "end_ms": int(words[-1][1] * 1000) if words else None,
+    }
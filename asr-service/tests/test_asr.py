@@ -22,3 +22,574 @@ def test_asr_invalid_audio(asr_model):
     with pytest.raises(Exception):
         # имитируем поврежденный WAV (байты вместо float)
         asr_model.transcribe(io.BytesIO(b"\x00\x11\x22\x33"), sample_rate=16000, language="en")
+
+
+def test_asr_admission_priority_and_overload():
+    """Проверка: interactive обгоняет batch, переполнение и дедлайн дают Overloaded"""
+    import asyncio
+
+    from app.admission import AdmissionController, Overloaded
+
+    async def scenario():
+        admission = AdmissionController(concurrency=1, max_queue=2, queue_timeout=0.2)
+        order = []
+
+        async def job(name, priority, hold=0.05):
+            async with admission.slot(priority):
+                order.append(name)
+                await asyncio.sleep(hold)
+
+        first = asyncio.create_task(job("first", "batch"))
+        await asyncio.sleep(0.01)
+        batch = asyncio.create_task(job("batch", "batch"))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(job("interactive", "interactive"))
+        await asyncio.sleep(0.01)
+        assert admission.stats()["queued"] == {"interactive": 1, "batch": 1}
+
+        with pytest.raises(Overloaded) as full:
+            await job("rejected", "interactive")
+        assert full.value.retry_after >= 1
+        await asyncio.gather(first, batch, interactive)
+        assert order == ["first", "interactive", "batch"]
+
+        hog = asyncio.create_task(job("hog", "batch", hold=0.5))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await job("late", "interactive")
+        await hog
+
+        stats = admission.stats()
+        assert stats["running"] == 0
+        assert (stats["rejected"], stats["timed_out"]) == (1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_asr_admission_respects_caller_deadline():
+    """Проверка: в очереди ждём не дольше дедлайна клиента (X-Request-Deadline-Ms)"""
+    import asyncio
+    import time
+
+    from app.admission import AdmissionController, Overloaded
+
+    async def scenario():
+        admission = AdmissionController(concurrency=1, max_queue=4, queue_timeout=5.0)
+
+        async def hold():
+            async with admission.slot():
+                await asyncio.sleep(0.3)
+
+        hog = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        with pytest.raises(Overloaded):
+            async with admission.slot(timeout=0.05):
+                pass
+        assert time.monotonic() - started < 0.2
+        # Истёкший дедлайн — отказ сразу, без очереди
+        with pytest.raises(Overloaded):
+            async with admission.slot(timeout=0):
+                pass
+        await hog
+        # Свободный слот выдаётся и при нулевом остатке
+        async with admission.slot(timeout=0):
+            pass
+        assert admission.stats()["timed_out"] == 2
+
+    asyncio.run(scenario())
+
+
+# Общие с tts-service модули: каждый образ собирается из своего каталога,
+# поэтому они скопированы, и копии должны совпадать
+SHARED_WITH_TTS = ["admission.py", "readiness.py", "resampling.py"]
+
+
+@pytest.mark.parametrize("module", SHARED_WITH_TTS)
+def test_asr_shared_modules_match_tts_service(module):
+    """Проверка: копии общих модулей в asr-service и tts-service не разошлись"""
+    from pathlib import Path
+
+    ours = Path(__file__).resolve().parents[1] / "app" / module
+    theirs = Path(__file__).resolve().parents[2] / "tts-service" / "app" / module
+    if not theirs.exists():
+        pytest.skip("tts-service is not checked out next to asr-service")
+    assert ours.read_bytes() == theirs.read_bytes(), f"{module} differs from tts-service/app/{module}"
+
+
+def test_asr_micro_batcher_groups_requests():
+    """Проверка: одновременные запросы собираются в батч, порядок результатов сохраняется"""
+    import time
+    from concurrent.futures import wait
+
+    from app.batching import MicroBatcher
+
+    sizes = []
+
+    def run_batch(items):
+        sizes.append(len(items))
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(run_batch, max_batch_size=3, max_delay_ms=50)
+    futures = [batcher.submit(x) for x in ("a", "b", "c", "d")]
+    wait(futures, timeout=5)
+    assert [f.result() for f in futures] == ["A", "B", "C", "D"]
+    assert sizes == [3, 1]
+
+    started = time.monotonic()
+    assert batcher.submit("e").result(timeout=5) == "E"
+    assert time.monotonic() - started < 1.0
+
+    with pytest.raises(ValueError):
+        batcher.submit("bad").result(timeout=5)
+    assert batcher.stats()["batches"] == 4
+    batcher.close()
+
+
+def test_asr_transcribe_batch(asr_model):
+    """Проверка: батч возвращает результат на каждый клип в исходном порядке"""
+    import numpy as np
+
+    clips = [
+        (np.zeros(0, dtype=np.float32), "en"),
+        (np.zeros(16000, dtype=np.float32), "en"),
+        (np.zeros(8000, dtype=np.float32), "en"),
+    ]
+    results = asr_model.transcribe_batch(clips)
+    assert len(results) == 3
+    assert results[0] == ("", [])
+    for text, segments in results:
+        assert isinstance(text, str)
+        assert isinstance(segments, list)
+
+
+def test_asr_batch_falls_back_only_for_unfinished_window(monkeypatch):
+    """Проверка: незавершённое окно (_parse_segments -> None) уходит в transcribe только для своего клипа"""
+    from types import SimpleNamespace
+
+    import app.asr as asr
+    import numpy as np
+
+    class FakeExtractor:
+        n_samples, nb_max_frames, time_per_frame = 16000 * 30, 3000, 0.01
+
+        def __call__(self, audio):
+            return np.zeros((80, len(audio) // 160 + 3000), dtype=np.float32)
+
+    generated = [
+        SimpleNamespace(sequences_ids=[[i]], scores=[-0.1], no_speech_prob=0.0)
+        for i in range(3)
+    ]
+    whisper = SimpleNamespace(
+        feature_extractor=FakeExtractor(),
+        model=SimpleNamespace(encode=lambda features: features, generate=lambda *a, **k: generated),
+        get_prompt=lambda tok, previous: [],
+        max_length=448,
+        time_precision=0.02,
+    )
+    model = object.__new__(asr.ASRModel)
+    model.model = whisper
+    monkeypatch.setattr(asr, "get_suppressed_tokens", lambda *args: [])
+    monkeypatch.setattr(model, "_tokenizer", lambda language: None)
+
+    def parse(tokens, tok, duration):
+        if tokens == [1]:
+            return None
+        return [{"start_ms": 0, "end_ms": 1000, "text": f"clip {tokens[0]}"}]
+
+    fallback = []
+
+    def transcribe(audio, sample_rate, language):
+        fallback.append(len(audio))
+        return "fallback", []
+
+    monkeypatch.setattr(model, "_parse_segments", parse)
+    monkeypatch.setattr(model, "transcribe", transcribe)
+    clips = [(np.zeros(16000 * (i + 1), dtype=np.float32), "en") for i in range(3)]
+
+    results = model.transcribe_batch(clips)
+    assert [text for text, _ in results] == ["clip 0", "fallback", "clip 2"]
+    assert fallback == [32000]
+
+
+def test_asr_inference_pool_partitions_models():
+    """Проверка: задания выполняются на экземплярах пула, батчи уходят в пул параллельно"""
+    import os
+    import threading
+    import time
+
+    from app.batching import MicroBatcher
+    from app.inference import InferencePool, partition_cpus
+
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu_sets = partition_cpus(2)
+    assert len(cpu_sets) == 2 and all(cpu_sets)
+    if len(cpus) >= 2:
+        assert not cpu_sets[0] & cpu_sets[1]
+
+    loaded = []
+
+    def factory(index):
+        loaded.append((index, os.sched_getaffinity(0)))
+        return {"index": index}
+
+    pool = InferencePool(factory, models=2, threads_per_model=2, cpu_sets=cpu_sets)
+    assert sorted(i for i, _ in loaded) == [0, 1]
+    assert all(cores == cpu_sets[i] for i, cores in loaded)
+    assert pool.size == 4
+
+    barrier = threading.Barrier(4, timeout=5)
+
+    def job(model, x):
+        barrier.wait()  # все 4 потока заняты одновременно
+        return model["index"], x * 2
+
+    futures = [pool.submit(job, x) for x in range(4)]
+    results = [f.result(timeout=5) for f in futures]
+    assert [r for _, r in results] == [0, 2, 4, 6]
+    assert sorted(i for i, _ in results) == [0, 0, 1, 1]
+
+    def slow_batch(model, items):
+        time.sleep(0.2)
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(
+        lambda items: pool.submit(slow_batch, items),
+        max_batch_size=2,
+        max_delay_ms=20,
+        max_inflight=pool.size,
+    )
+    started = time.monotonic()
+    futures = [batcher.submit(x) for x in "abcdefgh"]
+    assert [f.result(timeout=5) for f in futures] == list("ABCDEFGH")
+    # 4 батча по 2 на 4 потоках идут одновременно, а не друг за другом
+    assert time.monotonic() - started < 0.6
+    assert pool.stats()["pending"] == 0
+    batcher.close()
+    pool.close()
+
+
+def test_asr_streaming_local_agreement():
+    """Проверка: фиксируются слова, на которых сошлись две гипотезы, буфер обрезается"""
+    import numpy as np
+    from app.streaming import StreamingTranscriber
+
+    stream = StreamingTranscriber(sample_rate=100, step_ms=500, max_buffer_s=5)
+    stream.append(np.zeros(100, dtype=np.float32))
+    assert stream.ready
+    audio, prompt, offset = stream.snapshot()
+    assert (len(audio), prompt, offset) == (100, "", 0.0)
+    assert not stream.ready
+
+    committed, unstable = stream.update([(0.0, 0.4, " Hello"), (0.5, 0.9, " word")], offset)
+    assert committed == [] and [w for *_, w in unstable] == ["Hello", "word"]
+
+    stream.append(np.zeros(100, dtype=np.float32))
+    audio, _, offset = stream.snapshot()
+    committed, unstable = stream.update(
+        [(0.0, 0.4, " hello,"), (0.5, 0.9, " world"), (1.2, 1.6, " again")], offset
+    )
+    assert [w for *_, w in committed] == ["hello,"]
+    assert [w for *_, w in unstable] == ["world", "again"]
+    # Зафиксированное аудио больше не распознаётся, текст уходит в prompt
+    audio, prompt, offset = stream.snapshot()
+    assert (len(audio), prompt, offset) == (160, "hello,", 0.4)
+
+    # Повтор prompt в начале окна отбрасывается, время — от начала потока
+    committed, unstable = stream.update(
+        [(0.0, 0.1, "hello"), (0.1, 0.5, " world"), (0.8, 1.2, " again.")], offset
+    )
+    assert [(round(s, 2), w) for s, _, w in committed] == [(0.5, "world"), (1.2, "again.")]
+    assert unstable == []
+    assert stream.text == "hello, world again."
+
+    stream.append(np.zeros(50, dtype=np.float32))
+    committed, _ = stream.update([(0.0, 0.2, " end")], stream.snapshot()[2], final=True)
+    assert [w for *_, w in committed] == ["end"]
+    assert stream.buffered_s == 0.0
+
+
+def test_asr_ws_stt_streams_partials(monkeypatch):
+    """Проверка: /ws/stt шлёт partial по мере поступления аудио и final/end в конце"""
+    from concurrent.futures import Future
+
+    import app.main as main
+    import numpy as np
+    from fastapi.testclient import TestClient
+
+    class FakeInference:
+        # Каждые 0.5 с окна — одно «слово», названное по уровню сигнала
+        def submit(self, fn, audio, lang, prompt):
+            future = Future()
+            words = [
+                (i / 2, i / 2 + 0.5, f" w{round(float(audio[i * 8000]) * 100)}")
+                for i in range(len(audio) // 8000)
+            ]
+            future.set_result(words)
+            return future
+
+    monkeypatch.setattr(main, "inference", FakeInference())
+    monkeypatch.setattr(main.settings, "ASR_STREAM_STEP_MS", 500)
+
+    def block(level):
+        return (np.full(8000, level * 32768 / 100, dtype=np.float32)).astype(np.int16).tobytes()
+
+    client = TestClient(main.app)
+    with client.websocket_connect("/ws/stt?sr=16000&lang=en") as ws:
+        ws.send_bytes(block(1))
+        assert ws.receive_json() == {"type": "partial", "text": "w1", "start_ms": 0, "end_ms": 500}
+        ws.send_bytes(block(2)[:5001])  # кадр, разрезанный посередине отсчёта
+        ws.send_bytes(block(2)[5001:])
+        assert ws.receive_json()["text"] == "w1" and ws.receive_json()["type"] == "partial"
+        ws.send_json({"type": "end"})
+        assert ws.receive_json() == {"type": "final", "text": "w2", "start_ms": 500, "end_ms": 1000}
+        assert ws.receive_json() == {"type": "end", "text": "w1 w2"}
+
+    with client.websocket_connect("/ws/stt?sr=96000") as ws:
+        assert "sr must be" in ws.receive_json()["error"]
+
+
+def test_asr_long_audio_chunked_on_silence(monkeypatch):
+    """Проверка: длинная запись режется по паузам, куски склеиваются с глобальными таймкодами"""
+    import json
+    from concurrent.futures import Future
+
+    import app.main as main
+    import numpy as np
+    from app.chunking import plan_chunks
+    from fastapi.testclient import TestClient
+
+    sr = 16000
+    rng = np.random.default_rng(0)
+
+    def voiced(seconds):
+        # Гармонический сигнал с «интонацией» и слогами — VAD считает его речью
+        t = np.arange(int(seconds * sr)) / sr
+        phase = 2 * np.pi * np.cumsum(140 + 30 * np.sin(2 * np.pi * 3 * t)) / sr
+        x = sum(np.sin(k * phase) / k for k in range(1, 15))
+        return (0.3 * x * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t))).astype(np.float32)
+
+    def silence(seconds):
+        return (0.001 * rng.standard_normal(int(seconds * sr))).astype(np.float32)
+
+    audio = np.concatenate([voiced(10), silence(1), voiced(12), silence(1), voiced(15)])
+    chunks = plan_chunks(audio, sr, max_chunk_s=30)
+    assert len(chunks) == 2
+    assert all(end - start <= 30 * sr for start, end in chunks)
+    # Граница между кусками — во второй паузе
+    assert 23 * sr <= chunks[0][1] <= chunks[1][0] <= 24 * sr
+
+    class FakeInference:
+        size = 2
+
+        def submit(self, fn, clip, rate, lang):
+            future = Future()
+            seconds = len(clip) / rate
+            future.set_result(
+                (f"{seconds:.0f}s", [{"start_ms": 0, "end_ms": int(seconds * 1000), "text": "x"}])
+            )
+            return future
+
+    monkeypatch.setattr(main, "inference", FakeInference())
+    monkeypatch.setattr(main, "batcher", None)
+    client = TestClient(main.app)
+    pcm = (audio * 32767).astype(np.int16).tobytes()
+
+    r = client.post("/api/stt/bytes?sr=16000", files={"file": ("a.pcm", pcm)})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["text"] == " ".join(f"{(end - start) / sr:.0f}s" for start, end in chunks)
+    assert [s["start_ms"] for s in body["segments"]] == [chunks[0][0] // 16, chunks[1][0] // 16]
+
+    r = client.post("/api/stt/bytes?sr=16000&stream=true", files={"file": ("a.pcm", pcm)})
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1]
+    assert lines[-1]["type"] == "result" and lines[-1]["text"] == body["text"]
+
+    monkeypatch.setattr(main.settings, "ASR_MAX_AUDIO_S", 20.0)
+    r = client.post("/api/stt/bytes?sr=16000", files={"file": ("a.pcm", pcm)})
+    assert r.status_code == 413
+
+
+def test_asr_long_audio_takes_slot_per_chunk(monkeypatch):
+    """Проверка: каждый кусок длинной записи занимает место в admission, interactive встаёт между ними"""
+    import asyncio
+    from types import SimpleNamespace
+
+    import app.main as main
+    import numpy as np
+    from app.admission import AdmissionController
+
+    sr = 16000
+    done, running, peak = [], 0, 0
+    events = {}
+
+    async def fake_clip(audio, rate, lang):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        if running == 2:
+            events["busy"].set()
+        await asyncio.sleep(0.02)
+        running -= 1
+        done.append("batch")
+        return "x", []
+
+    monkeypatch.setattr(main, "inference", SimpleNamespace(size=4))
+    monkeypatch.setattr(main, "transcribe_clip", fake_clip)
+    monkeypatch.setattr(main.settings, "ASR_CHUNK_S", 1.0)
+    monkeypatch.setattr(main, "plan_chunks", lambda audio, *_: [(i * sr, (i + 1) * sr) for i in range(6)])
+
+    async def scenario():
+        admission = AdmissionController(concurrency=2, max_queue=8, queue_timeout=5.0)
+        monkeypatch.setattr(main, "admission", admission)
+        events["busy"] = asyncio.Event()
+
+        async def recording():
+            chunks = main.transcribe_chunks(np.zeros(6 * sr, np.float32), sr, "en", "batch")
+            return [r async for r in chunks]
+
+        task = asyncio.create_task(recording())
+        await asyncio.wait_for(events["busy"].wait(), 1.0)
+        # Запись из 6 кусков держит оба места, а не одно
+        assert admission.stats()["running"] == 2
+        async with admission.slot("interactive"):
+            done.append("interactive")
+        results = await task
+        return admission, results
+
+    admission, results = asyncio.run(scenario())
+    assert len(results) == 6 and peak == 2
+    assert admission.stats()["admitted"] == 7
+    # Короткий запрос не ждал, пока распознается вся запись
+    assert done.index("interactive") <= 2
+
+
+def test_asr_raw_body_and_fused_conversion(monkeypatch):
+    """Проверка: /api/stt/raw принимает тело без multipart, даунмикс совпадает с эталоном"""
+    import asyncio
+    from concurrent.futures import Future
+
+    import app.main as main
+    import numpy as np
+    from app.audio import BodyTooLarge, pcm16_to_float32, read_body
+    from fastapi.testclient import TestClient
+
+    rng = np.random.default_rng(1)
+    stereo = rng.integers(-32768, 32767, size=(1000, 2), dtype=np.int16)
+    mono = pcm16_to_float32(stereo.tobytes(), channels=2)
+    assert mono.dtype == np.float32
+    np.testing.assert_allclose(mono, stereo.astype(np.float64).mean(axis=1) / 32768, atol=1e-6)
+    # Неполный кадр в конце отбрасывается
+    assert len(pcm16_to_float32(stereo.tobytes()[:-1], channels=2)) == 999
+
+    async def body(parts):
+        for part in parts:
+            yield part
+
+    parts = [b"ab", b"cde", b"f"]
+    assert bytes(asyncio.run(read_body(body(parts), 100, expected=6))) == b"abcdef"
+    assert bytes(asyncio.run(read_body(body(parts), 100))) == b"abcdef"
+    with pytest.raises(BodyTooLarge):
+        asyncio.run(read_body(body(parts), 5))
+
+    received = []
+
+    class FakeInference:
+        size = 1
+
+        def submit(self, fn, clip, rate, lang):
+            received.append(clip)
+            future = Future()
+            future.set_result(("ok", []))
+            return future
+
+    monkeypatch.setattr(main, "inference", FakeInference())
+    monkeypatch.setattr(main, "batcher", None)
+    client = TestClient(main.app)
+    r = client.post(
+        "/api/stt/raw?sr=16000&ch=2",
+        content=stereo.tobytes(),
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert r.status_code == 200 and r.json()["text"] == "ok"
+    np.testing.assert_array_equal(received[0], mono)
+
+    assert client.post("/api/stt/raw", content=b"").status_code == 400
+    monkeypatch.setattr(main.settings, "ASR_MAX_AUDIO_S", 0.01)
+    assert client.post("/api/stt/raw", content=stereo.tobytes()).status_code == 413
+
+
+def test_asr_readyz_reports_loading_phases(monkeypatch):
+    """Проверка: /readyz отвечает 503, пока модель не прогрета, и 200 с фазами после"""
+    import app.main as main
+    from app.readiness import Readiness
+    from fastapi.testclient import TestClient
+
+    readiness = Readiness()
+    monkeypatch.setattr(main, "readiness", readiness)
+    client = TestClient(main.app)
+
+    r = client.get("/readyz")
+    assert r.status_code == 503 and r.json()["status"] == "loading"
+    assert client.get("/healthz").status_code == 200
+
+    with readiness.phase("model_0_load"):
+        pass
+    readiness.mark_ready()
+    r = client.get("/readyz")
+    assert r.status_code == 200
+    assert r.json()["status"] == "ready" and "model_0_load" in r.json()["phases_s"]
+
+    failed = Readiness()
+    failed.fail(RuntimeError("no model"))
+    monkeypatch.setattr(main, "readiness", failed)
+    r = client.get("/readyz")
+    assert r.status_code == 503 and r.json()["error"] == "RuntimeError: no model"
+
+
+def test_asr_resamples_any_input_rate(monkeypatch):
+    """Проверка: 8 и 48 кГц приводятся к 16 кГц, поблочно и потоково результат одинаков"""
+    from concurrent.futures import Future
+
+    import app.main as main
+    import numpy as np
+    from app.audio import RESAMPLE_TAPS, StreamResampler, resample
+    from fastapi.testclient import TestClient
+
+    for src in (8000, 22050, 48000):
+        t = np.arange(src) / src
+        tone = np.sin(2 * np.pi * 440 * t).astype(np.float32)
+        out = resample(tone, src, 16000, block_s=0.1)
+        assert len(out) == 16000
+        ref = np.sin(2 * np.pi * 440 * np.arange(16000) / 16000)
+        # Края — переходный процесс фильтра
+        assert np.abs(out[100:-100] - ref[100:-100]).max() < 1e-3
+
+        stream = StreamResampler(src, 16000, RESAMPLE_TAPS)
+        pieces = [stream.process(tone[i : i + 333]) for i in range(0, len(tone), 333)]
+        np.testing.assert_allclose(np.concatenate(pieces + [stream.flush()]), out, atol=1e-6)
+
+    # Выше новой частоты Найквиста ничего не проходит
+    alias = np.sin(2 * np.pi * 12000 * np.arange(48000) / 48000).astype(np.float32)
+    assert np.abs(resample(alias, 48000, 16000)[100:-100]).max() < 0.01
+
+    received = []
+
+    class FakeInference:
+        size = 1
+
+        def submit(self, fn, clip, rate, lang):
+            received.append((len(clip), rate))
+            future = Future()
+            future.set_result(("ok", []))
+            return future
+
+    monkeypatch.setattr(main, "inference", FakeInference())
+    monkeypatch.setattr(main, "batcher", None)
+    client = TestClient(main.app)
+    pcm = np.zeros(8000, dtype=np.int16).tobytes()  # 1 с при 8 кГц
+    assert client.post("/api/stt/raw?sr=8000", content=pcm).status_code == 200
+    assert received == [(16000, 16000)]
@@ -0,0 +1,193 @@
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+from app.resilience import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+
+class NoReplicaAvailable(RuntimeError):
+    pass
+
+
+class CircuitOpen(NoReplicaAvailable):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_urls(urls: str, fallback: str) -> List[str]:
+    """Comma-separated replica list; the single `fallback` URL if it is empty."""
+    parsed = [u.strip() for u in urls.split(",") if u.strip()]
+    return parsed or [fallback]
+
+
+def base_url(url: str) -> str:
+    """http(s) root of an upstream endpoint URL, where /readyz and /stats live."""
+    parts = urlsplit(url)
+    scheme = {"ws": "http", "wss": "https"}.get(parts.scheme, parts.scheme)
+    return urlunsplit((scheme, parts.netloc, "", "", ""))
+
+
+class Replica:
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        self.url = url
+        self.base_url = base_url(url)
+        self.breaker = breaker
+        # Unknown until the first probe; assume it works
+        self.healthy = True
+        self.outstanding = 0
+        self.queued = 0
+
+    @property
+    def failures(self) -> int:
+        return self.breaker.failures
+
+    @property
+    def load(self) -> int:
+        """Our requests in flight plus what waits in the replica's own admission queue."""
+        return self.outstanding + self.queued
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "queued": self.queued,
+            "failures": self.failures,
+            "breaker": self.breaker.state,
+        }
+
+
+class ReplicaSet:
+    """
+    Replicas of one upstream service, picked by least outstanding requests.
+
+    Each request leases the replica with the lowest load: requests this
+    gateway has in flight there (a long TTS stream counts until it ends) plus
+    the queue depth the replica reports in `/stats`. Every `health_interval`
+    seconds each replica's `/readyz` is probed; one that is not ready is
+    ejected and gets traffic again once a probe succeeds (if every replica is
+    ejected, all are tried anyway). A replica that failed `max_failures`
+    requests in a row is cut off by its circuit breaker for `reset_s`, then
+    gets a single trial request; when all are cut off, requests fail fast
+    with `CircuitOpen`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        urls: Iterable[str],
+        health_interval: float = 5.0,
+        max_failures: int = 3,
+        reset_s: float = 10.0,
+        probe_timeout: float = 2.0,
+    ):
+        self.name = name
+        self.replicas = [Replica(url, CircuitBreaker(max_failures, reset_s)) for url in urls]
+        if not self.replicas:
+            raise ValueError(f"no {name} replicas configured")
+        self.health_interval = float(health_interval)
+        self.probe_timeout = float(probe_timeout)
+        self._rotation = itertools.count()
+        self._health_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    def pick(self, exclude: Iterable[Replica] = ()) -> Replica:
+        excluded = set(map(id, exclude))
+        candidates = [r for r in self.replicas if id(r) not in excluded]
+        if not candidates:
+            raise NoReplicaAvailable(f"no {self.name} replica available")
+        closed = [r for r in candidates if r.breaker.allows()]
+        if not closed:
+            retry_after = min(r.breaker.retry_after() for r in candidates)
+            raise CircuitOpen(f"{self.name} service is failing, circuit open", retry_after)
+        candidates = [r for r in closed if r.healthy] or closed
+        # Rotate the start, so equally loaded replicas take turns
+        shift = next(self._rotation) % len(candidates)
+        candidates = candidates[shift:] + candidates[:shift]
+        return min(candidates, key=lambda r: r.load)
+
+    @asynccontextmanager
+    async def lease(self, exclude: Iterable[Replica] = ()) -> AsyncIterator[Replica]:
+        """Pick a replica and count the request against it until the block exits."""
+        self.start()
+        replica = self.pick(exclude)
+        # Set only if this request is the half-open breaker's single trial
+        trial = replica.breaker.begin()
+        replica.outstanding += 1
+        try:
+            yield replica
+        finally:
+            replica.outstanding -= 1
+            if trial is not None:
+                # No-op if mark_ok/mark_failed already settled it
+                replica.breaker.abandon_trial(trial)
+
+    def mark_failed(self, replica: Replica) -> None:
+        """The replica could not serve a request (connection refused, timeout, 5xx...)."""
+        if replica.breaker.record_failure():
+            logger.warning(
+                "Circuit open for %s replica %s after %d failures",
+                self.name, replica.url, replica.failures,
+            )
+
+    def mark_ok(self, replica: Replica) -> None:
+        replica.breaker.record_success()
+
+    def start(self) -> None:
+        """Start health polling on the running loop (idempotent)."""
+        if self.health_interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        task = self._health_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._health_task = loop.create_task(self._health_loop())
+
+    async def _probe(self, session: aiohttp.ClientSession, replica: Replica) -> None:
+        try:
+            async with session.get(replica.base_url + "/readyz") as resp:
+                ready = resp.status == 200
+            queued = 0
+            if ready:
+                async with session.get(replica.base_url + "/stats") as resp:
+                    if resp.status == 200:
+                        admission = (await resp.json()).get("admission") or {}
+                        queued = sum((admission.get("queued") or {}).values())
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            ready, queued = False, 0
+
+        replica.queued = queued
+        if ready and not replica.healthy:
+            logger.info("Re-adding %s replica %s", self.name, replica.url)
+        elif not ready and replica.healthy:
+            logger.warning("Ejecting %s replica %s: not ready", self.name, replica.url)
+        replica.healthy = ready
+
+    async def probe_all(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=self.probe_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*(self._probe(session, r) for r in self.replicas))
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("Health probe of %s replicas failed", self.name)
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self) -> List[dict]:
+        return [r.stats() for r in self.replicas]
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
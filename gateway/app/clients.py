@@ -1,36 +1,458 @@
+import asyncio
+import json
 import logging
+import time
+import uuid
+from contextlib import aclosing, asynccontextmanager, suppress
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
 import aiohttp
 import websockets
+from app.balancer import Replica, ReplicaSet, parse_urls
+from app.resilience import DEADLINE_HEADER, Deadline, HedgePolicy, hedged
 from app.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# TTS error replies that say the replica cannot take work right now
+UNAVAILABLE_CODES = ("overloaded", "not_ready")
+
+_DONE = object()
+
+
+def _replica_set(name: str, urls: List[str]) -> ReplicaSet:
+    return ReplicaSet(
+        name,
+        urls,
+        health_interval=settings.UPSTREAM_HEALTH_INTERVAL,
+        max_failures=settings.UPSTREAM_MAX_FAILURES,
+        reset_s=settings.UPSTREAM_BREAKER_RESET_S,
+    )
+
+
+def _hedge_policy() -> HedgePolicy:
+    return HedgePolicy(
+        quantile=settings.GATEWAY_HEDGE_QUANTILE,
+        min_samples=settings.GATEWAY_HEDGE_MIN_SAMPLES,
+    )
+
+
 class ASRClient:
-    async def transcribe_bytes(self, pcm_bytes: bytes, sr: int = 16000, ch: int = 1, lang: str = "en") -> str:
-        params = {"sr": sr, "ch": ch, "lang": lang}
-        data = aiohttp.FormData()
-        data.add_field("file", pcm_bytes, filename="audio.pcm", content_type="application/octet-stream")
-
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT)) as session:
-            async with session.post(settings.ASR_URL, data=data, params=params) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    raise RuntimeError(f"ASR request failed: {resp.status} {text}")
-                js = await resp.json()
+    """
+    HTTP client for the ASR service.
+
+    One `aiohttp.ClientSession` lives as long as the application, so requests
+    reuse keep-alive connections from a bounded pool instead of paying for a
+    new TCP handshake each time. The session is created on first use.
+    Each request goes to the least loaded ASR replica; one that refuses the
+    connection is skipped and the next one is tried.
+    """
+
+    def __init__(self, replicas: Optional[ReplicaSet] = None):
+        self.replicas = replicas or _replica_set(
+            "ASR", parse_urls(settings.ASR_URLS, settings.ASR_URL)
+        )
+        self.hedging = _hedge_policy()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # A session is bound to the loop it was created on (matters for reloads and tests)
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._loop is not loop:
+            # Close the stale session instead of dropping it with its connector;
+            # sockets of an already closed loop are released when collected
+            stale, self._session = self._session, None
+            with suppress(Exception):
+                await stale.close()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=settings.HTTP_POOL_LIMIT,
+                keepalive_timeout=settings.HTTP_KEEPALIVE_S,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT),
+            )
+            self._loop = loop
+        return self._session
+
+    async def transcribe_bytes(
+        self,
+        pcm_bytes: bytes,
+        sr: int = 16000,
+        ch: int = 1,
+        lang: str = "en",
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """
+        Recognize `pcm_bytes`, answering by `deadline` (HTTP_TIMEOUT from now if
+        None). The remaining budget is sent along in `X-Request-Deadline-Ms`.
+        A request still unanswered after the usual p95 latency is duplicated
+        to another replica, and the first answer wins.
+        """
+        deadline = deadline or Deadline(settings.HTTP_TIMEOUT)
+        busy: List[Replica] = []
+        delay = self.hedging.delay() if len(self.replicas) > 1 else None
+        return await hedged(
+            lambda: self._request(pcm_bytes, {"sr": sr, "ch": ch, "lang": lang}, deadline, busy),
+            delay,
+            self.hedging,
+        )
+
+    async def _request(self, pcm_bytes: bytes, params: dict, deadline: Deadline, busy: List[Replica]) -> str:
+        """One attempt; a replica that cannot be reached is skipped for the next one."""
+        session = await self._get_session()
+        while True:
+            deadline.check()
+            async with self.replicas.lease(exclude=busy) as replica:
+                busy.append(replica)
+                # Raw body for /api/stt/raw: no multipart encoding on either side
+                headers = {
+                    "Content-Type": "application/octet-stream",
+                    DEADLINE_HEADER: str(deadline.ms()),
+                }
+                started = time.monotonic()
+                try:
+                    async with session.post(
+                        replica.url,
+                        data=pcm_bytes,
+                        params=params,
+                        headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=deadline.remaining()),
+                    ) as resp:
+                        if resp.status != 200:
+                            text = await resp.text()
+                            if resp.status >= 500:
+                                self.replicas.mark_failed(replica)
+                            raise RuntimeError(f"ASR request failed: {resp.status} {text}")
+                        js = await resp.json()
+                except aiohttp.ClientConnectorError:
+                    # Nothing was sent, so another replica can take the request
+                    self.replicas.mark_failed(replica)
+                    if len(busy) >= len(self.replicas):
+                        raise
+                    continue
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    self.replicas.mark_failed(replica)
+                    raise
+                self.replicas.mark_ok(replica)
+                self.hedging.record(time.monotonic() - started)
                 return js.get("text", "")
 
+    async def close(self):
+        await self.replicas.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session, self._loop = None, None
+
+
+class TTSConnectionPool:
+    """
+    Warm websocket connections to the TTS service, reused across requests.
+
+    A connection goes back to the pool only if its request finished cleanly
+    (the `end`, `cancelled` or an error reply was read), so the next user
+    never sees leftovers. At most `size` idle connections are kept; idle ones are pinged
+    every `ping_interval` seconds and dropped if they do not answer.
+    """
+
+    def __init__(self, url: str, size: int = 8, ping_interval: float = 20.0):
+        self.url = url
+        self.size = max(0, int(size))
+        self.ping_interval = float(ping_interval)
+        self._idle: List[Tuple[float, websockets.WebSocketClientProtocol]] = []
+        self._health_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.opened = 0
+        self.reused = 0
+
+    async def _connect(self):
+        self.opened += 1
+        return await asyncio.wait_for(
+            websockets.connect(self.url, max_size=None), settings.WS_TIMEOUT
+        )
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[websockets.WebSocketClientProtocol]:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Connections of another event loop cannot be used from this one
+            self._loop, self._idle, self._health_task = loop, [], None
+        ws = None
+        while self._idle:
+            _, candidate = self._idle.pop()
+            if candidate.open:
+                ws = candidate
+                self.reused += 1
+                break
+        if ws is None:
+            ws = await self._connect()
+        self._ensure_health_task()
+
+        clean = False
+        try:
+            yield ws
+            clean = True
+        finally:
+            if clean and ws.open and len(self._idle) < self.size:
+                self._idle.append((time.monotonic(), ws))
+            else:
+                with suppress(Exception):
+                    await ws.close()
+
+    def _ensure_health_task(self):
+        if self.ping_interval > 0 and (self._health_task is None or self._health_task.done()):
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _check(self, ws) -> bool:
+        try:
+            pong = await ws.ping()
+            await asyncio.wait_for(pong, timeout=min(self.ping_interval, 5.0))
+            return True
+        except Exception:
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            # Only connections idle for a while; the rest were just used
+            stale = [e for e in self._idle if now - e[0] >= self.ping_interval]
+            for entry in stale:
+                if entry not in self._idle:
+                    continue
+                self._idle.remove(entry)
+                if await self._check(entry[1]):
+                    self._idle.append((time.monotonic(), entry[1]))
+                else:
+                    logger.info("Dropping dead TTS connection")
+                    with suppress(Exception):
+                        await entry[1].close()
+
+    def stats(self) -> dict:
+        return {"idle": len(self._idle), "opened": self.opened, "reused": self.reused}
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        idle, self._idle = self._idle, []
+        for _, ws in idle:
+            with suppress(Exception):
+                await ws.close()
+
 
 class TTSClient:
-    async def synthesize(self, text: str) -> bytes:
-        pcm = bytearray()
-        async with websockets.connect(settings.TTS_WS_URL, max_size=None) as ws:
-            await ws.send(f'{{"text": "{text}"}}')
-            while True:
-                msg = await ws.recv()
-                if isinstance(msg, bytes):
-                    pcm.extend(msg)
+    """
+    Websocket client for the TTS service replicas, one connection pool each.
+
+    A request is sent to the replica with the fewest streams in flight, so a
+    long synthesis running on one replica does not delay short requests that
+    another replica can start right away.
+    """
+
+    def __init__(
+        self,
+        pool: Optional[TTSConnectionPool] = None,
+        replicas: Optional[ReplicaSet] = None,
+    ):
+        if pool is not None:
+            # An explicitly given pool is a single, unprobed upstream
+            self.replicas = replicas or ReplicaSet("TTS", [pool.url], health_interval=0)
+            self.pools = {pool.url: pool}
+        else:
+            self.replicas = replicas or _replica_set(
+                "TTS", parse_urls(settings.TTS_WS_URLS, settings.TTS_WS_URL)
+            )
+            self.pools = {}
+        for replica in self.replicas.replicas:
+            if replica.url not in self.pools:
+                self.pools[replica.url] = TTSConnectionPool(
+                    replica.url,
+                    size=settings.TTS_WS_POOL_SIZE,
+                    ping_interval=settings.TTS_WS_PING_INTERVAL,
+                )
+        self.hedging = _hedge_policy()
+        self._discarding: Set[asyncio.Task] = set()
+
+    async def stream(
+        self, text: str, sample_rate: Optional[int] = None, deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[bytes]:
+        """
+        Yield PCM chunks as the TTS service produces them, at `sample_rate`
+        (the service default if None).
+
+        The first chunk must arrive by `deadline` (WS_TIMEOUT from now if None),
+        later ones at most WS_TIMEOUT apart. If the first chunk takes longer
+        than the usual p95, the request is duplicated to another replica and
+        the stream that starts first is kept; the other one is cancelled.
+        """
+        deadline = deadline or Deadline(settings.WS_TIMEOUT)
+        busy: List[Replica] = []
+        delay = self.hedging.delay() if len(self.replicas) > 1 else None
+        winner, first = await self._first_chunk(
+            lambda: self._request(text, sample_rate, deadline, busy), delay
+        )
+        async with aclosing(winner):
+            if first is _DONE:
+                return
+            yield first
+            async for chunk in winner:
+                yield chunk
+
+    async def _first_chunk(self, start, delay: Optional[float]):
+        """Race `start()` streams for the first chunk, hedging after `delay`."""
+        streams = [start()]
+        tasks = [asyncio.ensure_future(anext(streams[0], _DONE))]
+        winner = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedging.hedged += 1
+                    streams.append(start())
+                    tasks.append(asyncio.ensure_future(anext(streams[1], _DONE)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        winner = tasks.index(task)
+                        if winner:
+                            self.hedging.wins += 1
+                        return streams[winner], task.result()
+            raise tasks[0].exception()
+        finally:
+            for index, task in enumerate(tasks):
+                if index != winner:
+                    # Cancelling upstream takes a round trip; the winner need not wait for it
+                    task.cancel()
+                    discard = asyncio.create_task(self._discard(task, streams[index]))
+                    self._discarding.add(discard)
+                    discard.add_done_callback(self._discarding.discard)
+
+    @staticmethod
+    async def _discard(task: asyncio.Future, stream: AsyncIterator[bytes]):
+        await asyncio.wait({task})
+        with suppress(Exception):
+            await stream.aclose()
+
+    async def _request(
+        self, text: str, sample_rate: Optional[int], deadline: Deadline, busy: List[Replica]
+    ) -> AsyncIterator[bytes]:
+        """
+        One attempt on the least loaded replica not in `busy`.
+
+        The request carries an id, so if the consumer stops early (closes or
+        cancels the stream) the service is told to cancel it and frees its
+        workers, and the connection goes back to the pool.
+        """
+        error = None
+        request_id = uuid.uuid4().hex
+        tag = bytes([len(request_id)]) + request_id.encode()
+        # Unpaced: the consumer's own backpressure decides how fast we read
+        request = {"id": request_id, "text": text, "pacing": "burst"}
+        if sample_rate:
+            request["sample_rate"] = sample_rate
+        while True:
+            deadline.check()
+            async with self.replicas.lease(exclude=busy) as replica:
+                busy.append(replica)
+                started = time.monotonic()
+                connected = False
+                interrupted = None
+                first = True
+                try:
+                    async with self.pools[replica.url].connection() as ws:
+                        connected = True
+                        request["deadline_ms"] = deadline.ms()
+                        await ws.send(json.dumps(request))
+                        try:
+                            while True:
+                                # Until audio starts the request deadline applies
+                                timeout = settings.WS_TIMEOUT
+                                if first:
+                                    timeout = min(timeout, deadline.remaining())
+                                msg = await asyncio.wait_for(ws.recv(), timeout)
+                                if isinstance(msg, bytes):
+                                    # Frames of other (earlier, cancelled) requests are skipped
+                                    if msg.startswith(tag):
+                                        if first:
+                                            first = False
+                                            self.hedging.record(time.monotonic() - started)
+                                        yield msg[len(tag):]
+                                    continue
+                                data = json.loads(msg)
+                                if data.get("id") != request_id:
+                                    continue
+                                if data.get("type") == "end":
+                                    break
+                                if "error" in data:
+                                    # The reply completes the request, so the connection stays reusable
+                                    error = data
+                                    break
+                        except (GeneratorExit, asyncio.CancelledError) as e:
+                            if not await self._cancel(ws, request_id):
+                                raise
+                            interrupted = e
+                except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                    self.replicas.mark_failed(replica)
+                    # Fail over only if the replica could not even be reached
+                    if connected or len(busy) >= len(self.replicas):
+                        raise
                     continue
-                if '"type": "end"' in msg:
-                    break
+                if interrupted is not None:
+                    raise interrupted
+                if error is not None and error.get("code") in UNAVAILABLE_CODES:
+                    self.replicas.mark_failed(replica)
+                else:
+                    self.replicas.mark_ok(replica)
+                break
+        if error is not None:
+            raise RuntimeError(f"TTS request failed: {error['error']}")
+
+    async def _cancel(self, ws, request_id: str) -> bool:
+        """Cancel a request upstream; True once the service confirmed it."""
+        try:
+            await ws.send(json.dumps({"type": "cancel", "id": request_id}))
+            async with asyncio.timeout(settings.TTS_CANCEL_TIMEOUT):
+                while True:
+                    msg = await ws.recv()
+                    if isinstance(msg, bytes):
+                        continue
+                    data = json.loads(msg)
+                    # `end` or an error: it finished before the cancel arrived
+                    if data.get("id") == request_id and (
+                        data.get("type") in ("cancelled", "end") or "error" in data
+                    ):
+                        return True
+        except Exception:
+            return False
+
+    async def synthesize(
+        self, text: str, sample_rate: Optional[int] = None, deadline: Optional[Deadline] = None
+    ) -> bytes:
+        """The whole audio of `text`; unlike `stream`, all of it must arrive by `deadline`."""
+        deadline = deadline or Deadline(settings.WS_TIMEOUT)
+        pcm = bytearray()
+        stream = self.stream(text, sample_rate=sample_rate, deadline=deadline)
+        async with asyncio.timeout(deadline.remaining()), aclosing(stream):
+            async for chunk in stream:
+                pcm.extend(chunk)
         return bytes(pcm)
+
+    def stats(self) -> List[dict]:
+        return [
+            {**replica.stats(), "connections": self.pools[replica.url].stats()}
+            for replica in self.replicas.replicas
+        ]
+
+    async def close(self):
+        await self.replicas.close()
+        for pool in self.pools.values():
+            await pool.close()
+
+
+# Application-lifetime clients; closed on shutdown (see app.main)
+asr_client = ASRClient()
+tts_client = TTSClient()
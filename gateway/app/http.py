@@ -1,31 +1,133 @@
+import asyncio
 import base64
 import logging
+import math
+import struct
+from contextlib import aclosing, contextmanager
+from typing import AsyncIterator, Iterator, Optional
+from urllib.parse import quote
 
-from app.clients import ASRClient, TTSClient
+import aiohttp
+import websockets
+from app.balancer import CircuitOpen
+from app.clients import asr_client, tts_client
+from app.resilience import DEADLINE_HEADER, Deadline
 from app.schemas import GatewayResponse
-from fastapi import APIRouter, File, Query, UploadFile
+from app.settings import settings
+from fastapi import APIRouter, File, Header, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Size fields of a WAV whose length is not known up front (streamed)
+WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def wav_header(sample_rate: int, channels: int = 1, bits: int = 16) -> bytes:
+    """44-byte PCM WAV header with 'unknown' sizes, as used for live streams."""
+    block_align = channels * bits // 8
+    return (
+        b"RIFF"
+        + struct.pack("<I", WAV_UNKNOWN_SIZE)
+        + b"WAVEfmt "
+        + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits)
+        + b"data"
+        + struct.pack("<I", WAV_UNKNOWN_SIZE)
+    )
+
+
+@contextmanager
+def upstream_errors() -> Iterator[None]:
+    """Upstream failures -> HTTP statuses."""
+    try:
+        yield
+    except CircuitOpen as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="request deadline exceeded")
+    except (RuntimeError, aiohttp.ClientError, OSError, websockets.WebSocketException) as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+async def _audio_body(
+    header: bytes, first: bytes, rest: Optional[AsyncIterator[bytes]]
+) -> AsyncIterator[bytes]:
+    if header:
+        yield header
+    if first:
+        yield first
+    if rest is None:
+        return
+    async with aclosing(rest):
+        try:
+            async for chunk in rest:
+                yield chunk
+        except (RuntimeError, asyncio.TimeoutError, OSError, websockets.WebSocketException) as e:
+            # Headers are gone already; the client sees a truncated stream
+            logger.error("TTS stream failed mid-response: %s", e)
+
+
 @router.post("/api/gateway/tts-from-audio", response_model=GatewayResponse)
 async def tts_from_audio(
     file: UploadFile = File(...),
+    deadline_ms: Optional[int] = Header(None, alias=DEADLINE_HEADER, ge=1),
     sr: int = Query(16000),
     ch: int = Query(1),
-    lang: str = Query("en")
+    lang: str = Query("en"),
+    format: str = Query("json", pattern="^(json|wav|pcm)$"),
+    out_sr: Optional[int] = Query(None, ge=4000, le=96000),
 ):
     """
-    Accept PCM bytes -> send to ASR -> TTS synthesize recognized text -> return JSON with text and base64 audio.
+    Accept PCM bytes -> send to ASR -> TTS synthesize recognized text.
+
+    `format=json` (default) returns the text and base64 audio in one JSON body.
+    `format=wav` / `format=pcm` stream 16-bit mono audio while TTS produces it
+    (WAV header first, with unknown sizes); the recognized text comes in the
+    URL-encoded `X-ASR-Text` header.
+
+    The request must be answered within `X-Request-Deadline-Ms` (default
+    GATEWAY_DEADLINE_S): 504 once it passes, 503 while the upstream's
+    circuit is open, 502 when an upstream fails.
     """
+    deadline = Deadline.from_ms(deadline_ms, settings.GATEWAY_DEADLINE_S)
     pcm_bytes = await file.read()
-    asr = ASRClient()
-    tts = TTSClient()
 
-    asr_text = await asr.transcribe_bytes(pcm_bytes, sr=sr, ch=ch, lang=lang)
+    with upstream_errors():
+        asr_text = await asr_client.transcribe_bytes(
+            pcm_bytes, sr=sr, ch=ch, lang=lang,
+            deadline=deadline.share(settings.GATEWAY_ASR_DEADLINE_SHARE),
+        )
     logger.info(f"ASR text: {asr_text!r}")
 
-    pcm_out = await tts.synthesize(asr_text)
-    b64_audio = base64.b64encode(pcm_out).decode("utf-8")
+    if format == "json":
+        pcm_out = b""
+        if asr_text:
+            with upstream_errors():
+                pcm_out = await tts_client.synthesize(asr_text, sample_rate=out_sr, deadline=deadline)
+        b64_audio = base64.b64encode(pcm_out).decode("utf-8")
+        return GatewayResponse(asr_text=asr_text, tts_audio_b64=b64_audio)
+
+    rate = out_sr or settings.TTS_SAMPLE_RATE
+    headers = {"X-ASR-Text": quote(asr_text), "X-Sample-Rate": str(rate)}
+
+    first, stream = b"", None
+    if asr_text:
+        stream = tts_client.stream(asr_text, sample_rate=out_sr, deadline=deadline)
+        # Wait for the first chunk, so a failing TTS still gets a proper error status
+        try:
+            with upstream_errors():
+                first = await anext(stream, b"")
+        except BaseException:
+            # Any failure here (also a cancelled request) must free the TTS upstream
+            await stream.aclose()
+            raise
 
-    return GatewayResponse(asr_text=asr_text, tts_audio_b64=b64_audio)
+    if format == "wav":
+        body = _audio_body(wav_header(rate), first, stream)
+        return StreamingResponse(body, media_type="audio/wav", headers=headers)
+    # Raw 16-bit little-endian mono PCM
+    body = _audio_body(b"", first, stream)
+    return StreamingResponse(body, media_type="application/octet-stream", headers=headers)
@@ -1,5 +1,6 @@
 import logging
 
+from app.clients import asr_client, tts_client
 from app.http import router as http_router
 from app.logging_conf import setup_logging
 from app.settings import settings
@@ -12,10 +13,29 @@ logger = logging.getLogger(__name__)
 app = FastAPI(title="Gateway Service", version="1.0.0")
 app.include_router(http_router)
 
+@app.on_event("startup")
+async def startup_event():
+    # Probe replicas before the first request needs one
+    asr_client.replicas.start()
+    tts_client.replicas.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await asr_client.close()
+    await tts_client.close()
+
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "asr_replicas": asr_client.replicas.stats(),
+        "tts_replicas": tts_client.stats(),
+        "hedging": {"asr": asr_client.hedging.stats(), "tts": tts_client.hedging.stats()},
+    }
+
 @app.websocket("/ws/gateway")
 async def ws_gateway(ws: WebSocket):
     await handle_ws_connection(ws)
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Remaining budget of a request, in milliseconds, as sent to upstream services
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class Deadline:
+    """Point in time by which a request must be answered."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + max(0.0, float(seconds))
+
+    @classmethod
+    def from_ms(cls, ms: Optional[float], default_s: float) -> "Deadline":
+        return cls(default_s if ms is None else ms / 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def ms(self) -> int:
+        return int(self.remaining() * 1000)
+
+    def share(self, fraction: float) -> "Deadline":
+        """A stage's part of what is left, e.g. ASR before TTS."""
+        return Deadline(self.remaining() * fraction)
+
+    def check(self) -> None:
+        if self.expired:
+            raise DeadlineExceeded("request deadline exceeded")
+
+
+class CircuitBreaker:
+    """
+    Fails fast while an upstream keeps failing.
+
+    After `failure_threshold` failures in a row the breaker opens and no
+    requests are sent for `reset_s` seconds. Then it is half-open: a single
+    trial request goes through, and its failure opens the breaker anew while
+    a success closes it. Until the trial is answered (or abandoned) other
+    requests are refused as if it were open.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_s: float = 10.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_s = float(reset_s)
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        # Token of the half-open trial request in flight, if any
+        self._trial: Optional[int] = None
+        self._trials = 0
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        if time.monotonic() < self._open_until:
+            return "open"
+        return "half_open"
+
+    def allows(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and self._trial is None)
+
+    def begin(self) -> Optional[int]:
+        """A request is sent upstream; a token if it is the half-open trial, else None."""
+        if self.state != "half_open":
+            return None
+        self._trials += 1
+        self._trial = self._trials
+        return self._trial
+
+    def abandon_trial(self, trial: int) -> None:
+        """The trial ended without a verdict (cancelled, client error): allow another."""
+        if self._trial == trial:
+            self._trial = None
+
+    def retry_after(self) -> float:
+        return max(0.0, self._open_until - time.monotonic())
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._trial = None
+
+    def record_failure(self) -> bool:
+        """Count a failure; True if this opened the breaker."""
+        self._trial = None
+        self.failures += 1
+        if self.failures < self.failure_threshold:
+            return False
+        self._open_until = time.monotonic() + self.reset_s
+        self.opened += 1
+        return True
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate request to a second replica.
+
+    Keeps the latencies of the last `window` successful requests; a request
+    still unanswered after their `quantile` (p95 by default) is hedged. Until
+    `min_samples` are known, and with `quantile=0`, nothing is hedged.
+    """
+
+    def __init__(self, quantile: float = 0.95, min_samples: int = 20, window: int = 200):
+        self.quantile = float(quantile)
+        self.min_samples = max(1, int(min_samples))
+        self._samples: deque = deque(maxlen=max(self.min_samples, int(window)))
+        self.hedged = 0
+        self.wins = 0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        if self.quantile <= 0 or len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            "delay_ms": round(delay * 1000, 1) if delay is not None else None,
+            "hedged": self.hedged,
+            "wins": self.wins,
+        }
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float], policy: HedgePolicy) -> T:
+    """
+    Await `call()`; if it has not finished after `delay` seconds, start a second
+    `call()` and return whichever succeeds first (the other is cancelled).
+    Raises the first error only if both fail.
+    """
+    tasks: List[asyncio.Task] = [asyncio.ensure_future(call())]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                policy.hedged += 1
+                tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.index):
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        policy.wins += 1
+                    return task.result()
+        raise tasks[0].exception()
+    finally:
+        for task in tasks:
+            task.cancel()
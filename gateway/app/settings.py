@@ -10,9 +10,50 @@ class Settings(BaseSettings):
 
     ASR_URL: str
     TTS_WS_URL: str
+    # Comma-separated replica lists; empty means just ASR_URL / TTS_WS_URL
+    ASR_URLS: str = ""
+    TTS_WS_URLS: str = ""
+    # Replicas are probed (/readyz, /stats) this often; 0 disables probing
+    UPSTREAM_HEALTH_INTERVAL: float = 5.0
+    # Consecutive failures that open a replica's circuit breaker, and how
+    # long it then stays open before requests are tried again
+    UPSTREAM_MAX_FAILURES: int = 3
+    UPSTREAM_BREAKER_RESET_S: float = 10.0
+    # End-to-end budget of a request (unless the client sends X-Request-Deadline-Ms)
+    # and the part of it ASR may use before TTS
+    GATEWAY_DEADLINE_S: float = 30.0
+    GATEWAY_ASR_DEADLINE_SHARE: float = 0.5
+    # Requests slower than this latency quantile are duplicated to another
+    # replica (0 = never); needs MIN_SAMPLES latencies first
+    GATEWAY_HEDGE_QUANTILE: float = 0.95
+    GATEWAY_HEDGE_MIN_SAMPLES: int = 20
 
     HTTP_TIMEOUT: float
     WS_TIMEOUT: float
 
+    # Shared keep-alive HTTP pool to the ASR service
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_KEEPALIVE_S: float = 30.0
+    # Warm websocket connections kept open to the TTS service
+    TTS_WS_POOL_SIZE: int = 8
+    TTS_WS_PING_INTERVAL: float = 20.0
+    # How long an interrupted TTS request may take to confirm its cancel
+    # before its connection is dropped instead of reused
+    TTS_CANCEL_TIMEOUT: float = 2.0
+    # TTS chunks buffered per client websocket before upstream reads pause
+    GATEWAY_RELAY_MAX_CHUNKS: int = 16
+    # Voice websocket endpointing: an utterance ends after this much trailing
+    # silence (0 = only on `__flush__`); frames below THRESHOLD_DB never count as speech
+    GATEWAY_VAD_SILENCE_MS: int = 600
+    GATEWAY_VAD_THRESHOLD_DB: float = -45.0
+    # Longer utterances are cut, so per-connection memory stays bounded
+    GATEWAY_VAD_MAX_UTTERANCE_S: float = 20.0
+    # Speech needed to cut off the answer being played (barge-in); 0 = only `__interrupt__`
+    GATEWAY_BARGE_IN_MS: int = 200
+    # Utterances recognized ahead of the one being answered
+    GATEWAY_VAD_MAX_PENDING: int = 4
+    # Rate of TTS audio when the request does not ask for another one
+    TTS_SAMPLE_RATE: int = 22050
+
 
 settings = Settings()
@@ -0,0 +1,157 @@
+from collections import deque
+from typing import List
+
+import numpy as np
+
+
+def frame_levels(frames: np.ndarray) -> np.ndarray:
+    """Level of each row of int16 samples, in dBFS."""
+    power = np.square(frames, dtype=np.float32).mean(axis=1) / np.float32(32768.0**2)
+    return 10.0 * np.log10(power + np.float32(1e-12))
+
+
+class Endpointer:
+    """
+    Energy-based voice activity detection that cuts 16-bit mono PCM into utterances.
+
+    A frame is speech when it is louder than `threshold_db` and `margin_db`
+    above the running noise floor, which adapts to stationary background
+    noise even when that is louder than the threshold. An utterance starts at the first speech
+    frame (with `pre_roll_ms` of audio before it) and ends after `silence_ms`
+    of trailing silence; blips shorter than `min_speech_ms` are dropped.
+    Utterances are cut at `max_utterance_s`, and silence between them is not
+    kept, so memory stays bounded however long the stream is. With
+    `silence_ms=0` nothing is detected: all audio is buffered until `flush()`
+    (still cut at `max_utterance_s`).
+    """
+
+    # Per-frame smoothing of the noise floor towards the frame level
+    NOISE_TRACK = 0.05
+    NOISE_RISE = 0.01
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        silence_ms: int = 600,
+        threshold_db: float = -45.0,
+        margin_db: float = 10.0,
+        min_speech_ms: int = 200,
+        pre_roll_ms: int = 300,
+        max_utterance_s: float = 20.0,
+        frame_ms: int = 20,
+    ):
+        self.frame_ms = frame_ms
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self.frame_bytes = 2 * self.frame_samples
+        self.silence_frames = silence_ms // frame_ms
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.max_bytes = int(max_utterance_s * sample_rate) * 2
+        self.noise_db = threshold_db - margin_db
+        self._pending = bytearray()
+        self._pre_roll: deque = deque(maxlen=max(0, pre_roll_ms // frame_ms))
+        self._utterance = bytearray()
+        self._in_speech = False
+        self._speech = 0
+        self._silence = 0
+
+    @property
+    def auto(self) -> bool:
+        return self.silence_frames > 0
+
+    @property
+    def speech_ms(self) -> int:
+        """Speech heard so far in the utterance being captured."""
+        return self._speech * self.frame_ms if self._in_speech else 0
+
+    @property
+    def buffered_bytes(self) -> int:
+        return len(self._pending) + len(self._utterance) + sum(map(len, self._pre_roll))
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add PCM; returns the utterances that ended within it."""
+        self._pending.extend(data)
+        n = len(self._pending) // self.frame_bytes
+        if n == 0:
+            return []
+        raw = bytes(self._pending[: n * self.frame_bytes])
+        del self._pending[: n * self.frame_bytes]
+
+        if not self.auto:
+            return self._append_manual(raw)
+
+        frames = np.frombuffer(raw, dtype="<i2").reshape(n, self.frame_samples)
+        done = []
+        for i, level in enumerate(frame_levels(frames).tolist()):
+            frame = raw[i * self.frame_bytes : (i + 1) * self.frame_bytes]
+            utterance = self._step(frame, level)
+            if utterance:
+                done.append(utterance)
+        return done
+
+    def _append_manual(self, raw: bytes) -> List[bytes]:
+        done = []
+        while raw:
+            room = self.max_bytes - len(self._utterance)
+            self._utterance.extend(raw[:room])
+            raw = raw[room:]
+            if len(self._utterance) >= self.max_bytes:
+                done.append(self._take())
+        return done
+
+    def _is_speech(self, level: float) -> bool:
+        speech = level > max(self.threshold_db, self.noise_db + self.margin_db)
+        # The floor follows quieter frames quickly but also creeps up under loud
+        # ones: a steady noise above the threshold (a fan switching on) stops
+        # counting as speech within a couple of seconds, while the pauses
+        # between words keep pulling the floor back down during real speech
+        rate = self.NOISE_RISE if speech else self.NOISE_TRACK
+        self.noise_db += rate * (level - self.noise_db)
+        return speech
+
+    def _step(self, frame: bytes, level: float):
+        speech = self._is_speech(level)
+        if not self._in_speech:
+            if not speech:
+                self._pre_roll.append(frame)
+                return None
+            self._in_speech = True
+            self._utterance.extend(b"".join(self._pre_roll))
+            self._pre_roll.clear()
+            self._speech = self._silence = 0
+
+        self._utterance.extend(frame)
+        if speech:
+            self._speech += 1
+            self._silence = 0
+        else:
+            self._silence += 1
+
+        if self._silence >= self.silence_frames:
+            # Keep as much trailing silence as there is pre-roll
+            keep = len(self._utterance) - (self._silence - self._pre_roll.maxlen) * self.frame_bytes
+            del self._utterance[max(0, keep):]
+            if self._speech < self.min_speech_frames:
+                self._take()
+                return None
+            return self._take()
+        if len(self._utterance) >= self.max_bytes:
+            return self._take()
+        return None
+
+    def _take(self) -> bytes:
+        utterance = bytes(self._utterance)
+        self._utterance.clear()
+        self._in_speech = False
+        self._speech = self._silence = 0
+        return utterance
+
+    def flush(self) -> bytes:
+        """Whatever was captured of the current utterance (b"" outside speech)."""
+        tail = bytes(self._pending)
+        self._pending.clear()
+        self._pre_roll.clear()
+        if not self.auto or self._in_speech:
+            return self._take() + tail
+        return b""
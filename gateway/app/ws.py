@@ -1,44 +1,224 @@
+import asyncio
 import json
 import logging
+import time
+from contextlib import aclosing, suppress
+from typing import AsyncIterator, Optional
 
-from app.clients import ASRClient, TTSClient
+import aiohttp
+from app.clients import asr_client, tts_client
+from app.resilience import Deadline
+from app.settings import settings
+from app.vad import Endpointer
 from fastapi import WebSocket, WebSocketDisconnect
 
 logger = logging.getLogger(__name__)
 
-async def handle_ws_connection(ws: WebSocket):
+_END = object()
+
+
+async def relay_audio(ws: WebSocket, chunks: AsyncIterator[bytes], max_buffered: int) -> int:
     """
-    WebSocket duplex pipeline:
-    - Client sends binary PCM chunks
-    - Gateway feeds them to ASR (end of phrase -> result)
-    - Gateway streams synthesized TTS PCM back
+    Forward `chunks` to the client as they arrive; returns the number of bytes sent.
+
+    At most `max_buffered` chunks wait between upstream and the client. When
+    the client reads slower than TTS produces, the queue fills up and we stop
+    reading upstream, so the backpressure reaches the TTS service instead of
+    piling audio up in the gateway.
     """
-    await ws.accept()
-    buffer = bytearray()
-    asr = ASRClient()
-    tts = TTSClient()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_buffered))
 
+    async def pump():
+        try:
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    await queue.put(chunk)
+            await queue.put(_END)
+        except Exception as e:
+            await queue.put(e)
+
+    pumping = asyncio.create_task(pump())
+    sent = 0
     try:
         while True:
-            msg = await ws.receive()
-            if "bytes" in msg and msg["bytes"]:
-                buffer.extend(msg["bytes"])
+            item = await queue.get()
+            if item is _END:
+                return sent
+            if isinstance(item, Exception):
+                raise item
+            await ws.send_bytes(item)
+            sent += len(item)
+    finally:
+        pumping.cancel()
+
+
+def _describe(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError) and not str(error):
+        return "request deadline exceeded"
+    return str(error)
+
+
+class VoiceSession:
+    """
+    One /ws/gateway connection.
+
+    Reading the client and answering run at the same time: utterances cut by
+    the endpointer (or `__flush__`) are recognized as soon as they end and
+    answered in order, each as `asr_text`, TTS audio and `end`. When the user
+    starts speaking again (`GATEWAY_BARGE_IN_MS` of speech) or sends
+    `__interrupt__` while an answer is playing, relaying stops right away, the
+    upstream TTS request is cancelled and the client gets
+    `{"type": "interrupted", "latency_ms": ...}` before that answer's `end`.
+    The latency is from noticing the interruption to the last audio frame.
+    """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.endpointer = Endpointer(
+            silence_ms=settings.GATEWAY_VAD_SILENCE_MS,
+            threshold_db=settings.GATEWAY_VAD_THRESHOLD_DB,
+            max_utterance_s=settings.GATEWAY_VAD_MAX_UTTERANCE_S,
+        )
+        # Recognitions in flight; a full queue stops reading from the client
+        self.utterances: asyncio.Queue = asyncio.Queue(
+            maxsize=max(1, settings.GATEWAY_VAD_MAX_PENDING)
+        )
+        self._playing: Optional[asyncio.Task] = None
+        self._interrupted_at: Optional[float] = None
+
+    async def submit(self, pcm: bytes):
+        # The utterance's budget starts when it ends; ASR gets its share of it
+        deadline = Deadline(settings.GATEWAY_DEADLINE_S)
+        recognition = asyncio.create_task(
+            asr_client.transcribe_bytes(
+                pcm, deadline=deadline.share(settings.GATEWAY_ASR_DEADLINE_SHARE)
+            )
+        )
+        await self.utterances.put((recognition, deadline))
+
+    def interrupt(self) -> bool:
+        """Stop the answer being played, if any."""
+        if self._playing is None or self._playing.done():
+            return False
+        if self._interrupted_at is None:
+            self._interrupted_at = time.perf_counter()
+            self._playing.cancel()
+        return True
+
+    async def _respond(self):
+        while True:
+            item = await self.utterances.get()
+            if item is _END:
+                return
+            recognition, deadline = item
+            try:
+                text = await recognition
+            except Exception as e:
+                if not isinstance(e, (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError)):
+                    logger.error("ASR request failed: %r", e, exc_info=e)
+                await self.ws.send_text(json.dumps({"error": _describe(e)}))
+                await self.ws.send_text(json.dumps({"type": "end"}))
                 continue
-            if "text" in msg:
-                data = msg["text"].strip()
-                if data == "__flush__":
-                    # flush buffer: send to ASR, then TTS, then stream result
-                    text = await asr.transcribe_bytes(bytes(buffer))
-                    logger.info(f"ASR result: {text!r}")
-                    await ws.send_text(json.dumps({"asr_text": text}))
-
-                    pcm_out = await tts.synthesize(text)
-                    await ws.send_bytes(pcm_out)
-                    await ws.send_text(json.dumps({"type": "end"}))
-                    buffer.clear()
-                elif data == "__close__":
-                    break
-                else:
-                    await ws.send_text(json.dumps({"error": "unknown command"}))
-    except WebSocketDisconnect:
-        logger.info("Client disconnected.")
+            logger.info(f"ASR result: {text!r}")
+            await self.ws.send_text(json.dumps({"asr_text": text}))
+            await self._play(text, deadline)
+            await self.ws.send_text(json.dumps({"type": "end"}))
+
+    async def _play(self, text: str, deadline: Deadline):
+        self._interrupted_at = None
+        self._playing = asyncio.create_task(
+            relay_audio(
+                self.ws,
+                tts_client.stream(text, deadline=deadline),
+                settings.GATEWAY_RELAY_MAX_CHUNKS,
+            )
+        )
+        try:
+            # wait() rather than await: cancelling the relay must not cancel us
+            await asyncio.wait({self._playing})
+        finally:
+            playing, self._playing = self._playing, None
+            playing.cancel()
+
+        if playing.cancelled():
+            latency_ms = (time.perf_counter() - self._interrupted_at) * 1000
+            logger.info("Answer interrupted, relay stopped after %.1f ms", latency_ms)
+            await self.ws.send_text(
+                json.dumps({"type": "interrupted", "latency_ms": round(latency_ms, 1)})
+            )
+        elif playing.exception() is not None:
+            # Whatever broke this answer (e.g. the TTS replica dropped the
+            # connection), the session goes on with the next utterance
+            error = playing.exception()
+            if not isinstance(error, (RuntimeError, asyncio.TimeoutError)):
+                logger.error("TTS stream failed: %r", error, exc_info=error)
+            await self.ws.send_text(json.dumps({"error": _describe(error)}))
+
+    async def run(self):
+        responder = asyncio.create_task(self._respond())
+        reader = asyncio.create_task(self._read())
+        try:
+            await asyncio.wait({reader, responder}, return_when=asyncio.FIRST_COMPLETED)
+            if reader.done() and reader.result():
+                # Answer what was already spoken before leaving
+                await asyncio.wait({responder})
+            if responder.done() and not responder.cancelled() and responder.exception():
+                # Nobody answers this client any more: close instead of hanging
+                logger.error("Voice session failed", exc_info=responder.exception())
+                with suppress(Exception):
+                    await self.ws.close(code=1011)
+        finally:
+            reader.cancel()
+            responder.cancel()
+            while not self.utterances.empty():
+                pending = self.utterances.get_nowait()
+                if pending is not _END:
+                    pending[0].cancel()
+
+    async def _read(self) -> bool:
+        """Read the client until it leaves; True if it asked to close (`__close__`)."""
+        try:
+            while True:
+                msg = await self.ws.receive()
+                if msg["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(msg.get("code", 1000))
+                if "bytes" in msg and msg["bytes"]:
+                    ended = self.endpointer.feed(msg["bytes"])
+                    if settings.GATEWAY_BARGE_IN_MS > 0 and (
+                        ended or self.endpointer.speech_ms >= settings.GATEWAY_BARGE_IN_MS
+                    ):
+                        self.interrupt()
+                    for utterance in ended:
+                        await self.submit(utterance)
+                    continue
+                if "text" in msg:
+                    data = msg["text"].strip()
+                    if data == "__flush__":
+                        # b"" if the endpointer already cut the utterance itself
+                        tail = self.endpointer.flush()
+                        if tail:
+                            await self.submit(tail)
+                    elif data == "__interrupt__":
+                        self.interrupt()
+                    elif data == "__close__":
+                        await self.utterances.put(_END)
+                        return True
+                    else:
+                        await self.ws.send_text(json.dumps({"error": "unknown command"}))
+        except WebSocketDisconnect:
+            logger.info("Client disconnected.")
+            return False
+
+
+async def handle_ws_connection(ws: WebSocket):
+    """
+    WebSocket duplex pipeline:
+    - Client sends binary 16 kHz mono PCM chunks
+    - Gateway cuts them into utterances by trailing silence (or on `__flush__`)
+    - Each utterance goes to ASR as soon as it ends, while the next one is
+      still being captured
+    - Gateway streams synthesized TTS PCM back, one utterance after another,
+      and stops it when the user talks over it (see `VoiceSession`)
+    """
+    await ws.accept()
+    await VoiceSession(ws).run()
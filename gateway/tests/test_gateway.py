@@ -36,3 +36,889 @@ async def test_gateway_invalid_audio():
         files={"file": ("", b"")}  # пустой файл
     )
     assert response.status_code >= 400
+
+
+@pytest.mark.asyncio
+async def test_gateway_tts_connections_reused():
+    """Соединения с TTS переиспользуются; после ответа с ошибкой — тоже, мёртвые заменяются"""
+    import json
+
+    import websockets
+    from app.clients import TTSClient, TTSConnectionPool
+
+    handshakes = 0
+
+    async def fake_tts(ws):
+        nonlocal handshakes
+        handshakes += 1
+        async for message in ws:
+            request = json.loads(message)
+            rid, text = request["id"], request["text"]
+            if text == "bad":
+                await ws.send(json.dumps({"error": "empty text", "id": rid}))
+                continue
+            await ws.send(bytes([len(rid)]) + rid.encode() + text.encode())
+            await ws.send(json.dumps({"type": "end", "id": rid}))
+
+    async with websockets.serve(fake_tts, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        pool = TTSConnectionPool(f"ws://127.0.0.1:{port}", size=2, ping_interval=0)
+        client = TTSClient(pool)
+        try:
+            assert await client.synthesize("one") == b"one"
+            assert await client.synthesize("two") == b"two"
+            with pytest.raises(RuntimeError):
+                await client.synthesize("bad")
+            assert await client.synthesize("three") == b"three"
+            assert handshakes == 1
+            assert pool.stats() == {"idle": 1, "opened": 1, "reused": 3}
+
+            # Соединение, закрытое сервером, в работу не попадает
+            await pool._idle[0][1].close()
+            assert await client.synthesize("four") == b"four"
+            assert handshakes == 2
+        finally:
+            await client.close()
+
+
+@pytest.mark.asyncio
+async def test_gateway_relays_tts_chunks_with_backpressure():
+    """Аудио уходит клиенту по мере синтеза, а буфер между TTS и медленным клиентом ограничен"""
+    import asyncio
+
+    from app.ws import relay_audio
+
+    produced = 0
+    finished = False
+
+    async def upstream():
+        nonlocal produced, finished
+        for i in range(20):
+            produced += 1
+            yield bytes([i]) * 10
+        finished = True
+
+    class SlowClient:
+        def __init__(self):
+            self.frames = []
+            self.ahead = []
+
+        async def send_bytes(self, data):
+            # Сколько чанков прочитано из TTS, но ещё не отправлено
+            self.ahead.append(produced - len(self.frames))
+            self.frames.append((data, finished))
+            await asyncio.sleep(0.001)
+
+    client = SlowClient()
+    sent = await relay_audio(client, upstream(), max_buffered=3)
+    assert sent == 200
+    assert [data[0] for data, _ in client.frames] == list(range(20))
+    # Первый чанк ушёл задолго до конца синтеза
+    assert client.frames[0][1] is False
+    assert max(client.ahead) <= 3 + 2
+
+    async def failing():
+        yield b"x"
+        raise RuntimeError("TTS request failed: boom")
+
+    with pytest.raises(RuntimeError):
+        await relay_audio(SlowClient(), failing(), max_buffered=3)
+
+
+def test_gateway_streams_wav_with_text_header(monkeypatch):
+    """Проверка: format=wav отдаёт заголовок WAV, затем аудио по мере синтеза; текст — в X-ASR-Text"""
+    import io
+    import wave
+    from urllib.parse import unquote
+
+    import app.http as http
+
+    requested = []
+
+    async def fake_transcribe(pcm, sr, ch, lang, deadline=None):
+        return "привет, world"
+
+    async def fake_stream(text, sample_rate=None, deadline=None):
+        requested.append(sample_rate)
+        for i in range(3):
+            yield bytes([i, 0]) * 100
+
+    monkeypatch.setattr(http.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(http.tts_client, "stream", fake_stream)
+    client = TestClient(app)
+
+    r = client.post(
+        "/api/gateway/tts-from-audio?format=wav&out_sr=16000",
+        files={"file": ("a.pcm", b"\x00\x00" * 10)},
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "audio/wav"
+    assert unquote(r.headers["x-asr-text"]) == "привет, world"
+    assert requested == [16000]
+    assert r.content[:4] == b"RIFF" and r.content[40:44] == b"\xff\xff\xff\xff"
+    with wave.open(io.BytesIO(r.content[:44])) as wav:
+        assert (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) == (16000, 1, 2)
+    assert r.content[44:] == b"".join(bytes([i, 0]) * 100 for i in range(3))
+
+    r = client.post("/api/gateway/tts-from-audio?format=pcm", files={"file": ("a.pcm", b"\x00\x00")})
+    assert r.headers["x-sample-rate"] == "22050"
+    assert len(r.content) == 600
+
+
+def test_gateway_closes_tts_stream_when_first_chunk_fails(monkeypatch):
+    """Проверка: любая ошибка до первого чанка закрывает поток TTS, а не только HTTPException"""
+    import app.http as http
+
+    closed = []
+
+    async def fake_transcribe(pcm, sr, ch, lang, deadline=None):
+        return "text"
+
+    class FailingStream:
+        """Поток, который освобождает upstream только при явном aclose()"""
+
+        def __init__(self, text):
+            self.text = text
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise ValueError("unexpected")
+
+        async def aclose(self):
+            closed.append(self.text)
+
+    def failing_stream(text, sample_rate=None, deadline=None):
+        return FailingStream(text)
+
+    monkeypatch.setattr(http.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(http.tts_client, "stream", failing_stream)
+
+    with pytest.raises(ValueError):
+        TestClient(app).post("/api/gateway/tts-from-audio?format=pcm", files={"file": ("a.pcm", b"\x00\x00")})
+    assert closed == ["text"]
+
+
+def test_gateway_maps_tts_websocket_errors_to_502(monkeypatch):
+    """Проверка: ошибка websocket-соединения с TTS — 502 до начала ответа, обрезанный поток после"""
+    import app.http as http
+    import websockets
+
+    async def fake_transcribe(pcm, sr, ch, lang, deadline=None):
+        return "text"
+
+    async def rejected(text, sample_rate=None, deadline=None):
+        raise websockets.InvalidStatusCode(503, None)
+        yield b""
+
+    async def dropped(text, sample_rate=None, deadline=None):
+        yield b"\x01\x00" * 10
+        raise websockets.ConnectionClosedError(None, None)
+
+    monkeypatch.setattr(http.asr_client, "transcribe_bytes", fake_transcribe)
+    client = TestClient(app)
+    url = "/api/gateway/tts-from-audio?format=pcm"
+
+    monkeypatch.setattr(http.tts_client, "stream", rejected)
+    r = client.post(url, files={"file": ("a.pcm", b"\x00\x00")})
+    assert r.status_code == 502
+
+    monkeypatch.setattr(http.tts_client, "stream", dropped)
+    r = client.post(url, files={"file": ("a.pcm", b"\x00\x00")})
+    assert r.status_code == 200 and r.content == b"\x01\x00" * 10
+
+
+@pytest.mark.asyncio
+async def test_gateway_tts_routes_around_long_streams():
+    """Проверка: пока на одной реплике TTS идёт длинный поток, короткий запрос уходит на свободную"""
+    import asyncio
+    import json
+
+    import websockets
+    from app.balancer import ReplicaSet
+    from app.clients import TTSClient
+
+    served = []
+
+    def fake_tts(name):
+        async def handler(ws):
+            async for message in ws:
+                request = json.loads(message)
+                if request.get("type") == "cancel":
+                    continue
+                rid, text = request["id"], request["text"]
+                served.append((name, text))
+                for _ in range(50 if text == "long" else 1):
+                    await ws.send(bytes([len(rid)]) + rid.encode() + name.encode())
+                    await asyncio.sleep(0.01)
+                await ws.send(json.dumps({"type": "end", "id": rid}))
+        return handler
+
+    async with websockets.serve(fake_tts("a"), "127.0.0.1", 0) as a, \
+            websockets.serve(fake_tts("b"), "127.0.0.1", 0) as b:
+        urls = [f"ws://127.0.0.1:{s.sockets[0].getsockname()[1]}" for s in (a, b)]
+        client = TTSClient(replicas=ReplicaSet("TTS", urls, health_interval=0))
+        try:
+            long_stream = client.stream("long")
+            first = await anext(long_stream)
+            busy = urls[0] if first == b"a" else urls[1]
+            assert [r["outstanding"] for r in client.stats() if r["url"] == busy] == [1]
+
+            for _ in range(3):
+                assert await client.synthesize("short") != first
+            await long_stream.aclose()
+            assert all(r["outstanding"] == 0 for r in client.stats())
+        finally:
+            await client.close()
+
+
+@pytest.mark.asyncio
+async def test_gateway_asr_replicas_ejected_and_readded():
+    """Проверка: неготовая реплика ASR выводится по /readyz и возвращается, упавшая — обходится"""
+    import socket
+
+    from aiohttp import web
+    from app.balancer import ReplicaSet
+    from app.clients import ASRClient
+
+    state = {"ready": False}
+
+    async def readyz(request):
+        return web.json_response({}, status=200 if state["ready"] else 503)
+
+    async def always_ready(request):
+        return web.json_response({})
+
+    async def stats(request):
+        return web.json_response({"admission": {"queued": {"interactive": 2, "batch": 1}}})
+
+    def recognize(name):
+        async def handler(request):
+            await request.read()
+            return web.json_response({"text": name})
+        return handler
+
+    async def start(name):
+        app_ = web.Application()
+        app_.add_routes([
+            web.get("/readyz", readyz if name == "a" else always_ready),
+            web.get("/stats", stats),
+            web.post("/api/stt/raw", recognize(name)),
+        ])
+        runner = web.AppRunner(app_)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/api/stt/raw"
+
+    runner_a, url_a = await start("a")
+    runner_b, url_b = await start("b")
+    # Порт, на котором никто не слушает
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead = f"http://127.0.0.1:{s.getsockname()[1]}/api/stt/raw"
+
+    replicas = ReplicaSet("ASR", [url_a, url_b, dead], health_interval=0, max_failures=1)
+    client = ASRClient(replicas)
+    try:
+        await replicas.probe_all()
+        a, b, d = replicas.replicas
+        assert (a.healthy, b.healthy, d.healthy) == (False, True, False)
+        assert b.queued == 3
+        assert {await client.transcribe_bytes(b"\x00\x00") for _ in range(4)} == {"b"}
+
+        state["ready"] = True
+        await replicas.probe_all()
+        assert a.healthy
+        assert {await client.transcribe_bytes(b"\x00\x00") for _ in range(4)} == {"a", "b"}
+
+        # Ни одна реплика не готова: пробуются все, мёртвая пропускается
+        a.healthy = b.healthy = d.healthy = False
+        texts = {await client.transcribe_bytes(b"\x00\x00") for _ in range(6)}
+        assert texts <= {"a", "b"} and d.failures >= 1
+    finally:
+        await client.close()
+        await runner_a.cleanup()
+        await runner_b.cleanup()
+
+
+
+def test_gateway_asr_session_closed_on_loop_change():
+    """Проверка: при смене event loop прежняя сессия ASR закрывается, а не бросается"""
+    import asyncio
+
+    from app.balancer import ReplicaSet
+    from app.clients import ASRClient
+
+    client = ASRClient(ReplicaSet("ASR", ["http://127.0.0.1:1/api/stt/raw"], health_interval=0))
+    first = asyncio.run(client._get_session())
+    second = asyncio.run(client._get_session())
+    assert first is not second
+    assert first.closed and not second.closed
+    asyncio.run(client.close())
+    assert second.closed
+
+def _speech_pcm(layout, sr=16000):
+    """PCM16 из чередования тишины (шум) и «речи» (тон): [(есть_речь, секунды), ...]"""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    parts = []
+    for speech, seconds in layout:
+        n = int(seconds * sr)
+        noise = rng.normal(0, 30, n)
+        tone = 8000 * np.sin(2 * np.pi * 220 * np.arange(n) / sr) if speech else 0
+        parts.append(noise + tone)
+    return np.concatenate(parts).astype("<i2").tobytes()
+
+
+def test_gateway_endpointer_cuts_utterances_on_silence():
+    """Проверка: VAD режет поток на фразы по паузам, короткие щелчки отбрасывает, память ограничена"""
+    from app.vad import Endpointer
+
+    pcm = _speech_pcm([(0, 0.5), (1, 1.0), (0, 0.8), (1, 0.05), (0, 0.8), (1, 0.7), (0, 0.8)])
+    ep = Endpointer(silence_ms=500, max_utterance_s=5)
+    utterances = []
+    # Куски произвольного размера, не кратные кадру
+    for i in range(0, len(pcm), 1234):
+        utterances += ep.feed(pcm[i : i + 1234])
+    assert len(utterances) == 2
+    # Речь + предзахват + немного хвостовой тишины
+    assert [round(len(u) / 32000, 1) for u in utterances] == [1.6, 1.3]
+    assert ep.flush() == b""
+
+    # Минута речи без пауз (только короткие провалы между слогами) режется по max_utterance_s,
+    # буфер не растёт
+    long = _speech_pcm([(1, 0.24), (0, 0.06)] * 200)
+    cut = []
+    for i in range(0, len(long), 32000):
+        cut += ep.feed(long[i : i + 32000])
+        assert ep.buffered_bytes <= 5 * 32000
+    assert len(cut) == 12 and all(len(u) == 5 * 32000 for u in cut)
+
+
+def test_gateway_endpointer_adapts_to_loud_noise():
+    """Проверка: постоянный шум громче порога (вентилятор на -35 dBFS) перестаёт считаться речью"""
+    import numpy as np
+    from app.vad import Endpointer
+
+    sr = 16000
+    rng = np.random.default_rng(1)
+    fan_rms = 32768 * 10 ** (-35 / 20)
+
+    def fan(seconds, speech=False):
+        n = int(seconds * sr)
+        tone = 8000 * np.sin(2 * np.pi * 220 * np.arange(n) / sr) if speech else 0
+        return (rng.normal(0, fan_rms, n) + tone).astype("<i2").tobytes()
+
+    ep = Endpointer(silence_ms=500)
+    quiet = _speech_pcm([(0, 0.5)])
+    assert ep.feed(quiet) == []
+    # Вентилятор включился: сначала он похож на речь, но порог подстраивается
+    transient = ep.feed(fan(4.0))
+    assert len(transient) <= 1
+    assert ep.speech_ms == 0 and ep.flush() == b""
+
+    # Речь поверх шума по-прежнему находится и режется по паузе
+    utterances = ep.feed(fan(0.8, speech=True) + fan(1.5))
+    assert len(utterances) == 1
+    assert 0.8 <= len(utterances[0]) / 32000 <= 1.8
+    assert ep.speech_ms == 0
+
+
+def test_gateway_ws_auto_endpointing(monkeypatch):
+    """Проверка: без __flush__ каждая фраза сама уходит в ASR, ответы приходят по порядку"""
+    import asyncio
+    import json
+
+    import app.ws as ws_module
+
+    recognized = []
+
+    async def fake_transcribe(pcm, sr=16000, ch=1, lang="en", deadline=None):
+        recognized.append(len(pcm))
+        n = len(recognized)
+        # Первая фраза распознаётся дольше второй, порядок ответов всё равно сохраняется
+        await asyncio.sleep(0.2 if n == 1 else 0)
+        return f"utterance {n}"
+
+    async def fake_stream(text, sample_rate=None, deadline=None):
+        yield text.encode()
+
+    monkeypatch.setattr(ws_module.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(ws_module.tts_client, "stream", fake_stream)
+    monkeypatch.setattr(ws_module.settings, "GATEWAY_BARGE_IN_MS", 0)
+    pcm = _speech_pcm([(0, 0.3), (1, 0.6), (0, 1.0), (1, 0.4), (0, 1.0)])
+
+    with TestClient(app).websocket_connect("/ws/gateway") as ws:
+        for i in range(0, len(pcm), 640):
+            ws.send_bytes(pcm[i : i + 640])
+        replies = []
+        for _ in range(6):
+            msg = ws.receive()
+            replies.append(msg.get("bytes") or json.loads(msg["text"]))
+        ws.send_text("__close__")
+
+    assert len(recognized) == 2
+    assert replies == [
+        {"asr_text": "utterance 1"}, b"utterance 1", {"type": "end"},
+        {"asr_text": "utterance 2"}, b"utterance 2", {"type": "end"},
+    ]
+
+
+def test_gateway_ws_flush_after_auto_cut(monkeypatch):
+    """Проверка: __flush__ после того, как VAD сам отрезал фразу, не шлёт в ASR пустой буфер"""
+    import json
+
+    import app.ws as ws_module
+
+    recognized = []
+
+    async def fake_transcribe(pcm, sr=16000, ch=1, lang="en", deadline=None):
+        recognized.append(len(pcm))
+        return "hello"
+
+    async def fake_stream(text, sample_rate=None, deadline=None):
+        yield text.encode()
+
+    monkeypatch.setattr(ws_module.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(ws_module.tts_client, "stream", fake_stream)
+    monkeypatch.setattr(ws_module.settings, "GATEWAY_BARGE_IN_MS", 0)
+    pcm = _speech_pcm([(0, 0.3), (1, 0.6), (0, 1.0)])
+
+    with TestClient(app).websocket_connect("/ws/gateway") as ws:
+        ws.send_bytes(pcm)
+        ws.send_text("__flush__")
+        replies = []
+        for _ in range(3):
+            msg = ws.receive()
+            replies.append(msg.get("bytes") or json.loads(msg["text"]))
+        ws.send_text("__close__")
+
+    assert replies == [{"asr_text": "hello"}, b"hello", {"type": "end"}]
+    # Второго (пустого) запроса в ASR не было
+    assert len(recognized) == 1 and recognized[0] > 0
+
+
+@pytest.mark.asyncio
+async def test_gateway_tts_cancel_frees_upstream():
+    """Проверка: прерванный поток отменяется на стороне TTS, соединение остаётся в пуле"""
+    import asyncio
+    import json
+
+    import websockets
+    from app.clients import TTSClient, TTSConnectionPool
+
+    cancelled = []
+    acked = asyncio.Event()
+
+    async def fake_tts(ws):
+        jobs = {}
+
+        async def synthesize(rid, text):
+            tag = bytes([len(rid)]) + rid.encode()
+            for _ in range(1000):
+                await ws.send(tag + text.encode())
+                await asyncio.sleep(0.005)
+            await ws.send(json.dumps({"type": "end", "id": rid}))
+
+        try:
+            async for message in ws:
+                request = json.loads(message)
+                rid = request["id"]
+                if request.get("type") == "cancel":
+                    jobs.pop(rid).cancel()
+                    cancelled.append(rid)
+                    await ws.send(json.dumps({"type": "cancelled", "id": rid}))
+                    acked.set()
+                else:
+                    jobs[rid] = asyncio.create_task(synthesize(rid, request["text"]))
+        finally:
+            for job in jobs.values():
+                job.cancel()
+
+    async with websockets.serve(fake_tts, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        pool = TTSConnectionPool(f"ws://127.0.0.1:{port}", size=2, ping_interval=0)
+        client = TTSClient(pool)
+        try:
+            stream = client.stream("one")
+            assert await anext(stream) == b"one"
+            await stream.aclose()
+            await asyncio.wait_for(acked.wait(), 1.0)
+            assert len(cancelled) == 1
+
+            # Отмена задачи-потребителя работает так же
+            started = asyncio.Event()
+            acked.clear()
+
+            async def consume():
+                async for _ in client.stream("two"):
+                    started.set()
+
+            task = asyncio.create_task(consume())
+            await asyncio.wait_for(started.wait(), 1.0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.wait_for(acked.wait(), 1.0)
+            assert len(cancelled) == 2
+
+            # Хвост отменённого запроса следующему не достаётся
+            stream = client.stream("three")
+            assert await anext(stream) == b"three"
+            await stream.aclose()
+            assert pool.stats()["opened"] == 1
+        finally:
+            await client.close()
+
+
+def test_gateway_barge_in_stops_playback(monkeypatch):
+    """Проверка: речь пользователя или __interrupt__ обрывает ответ в пределах одного чанка"""
+    import asyncio
+    import json
+
+    import app.ws as ws_module
+
+    closed = []
+
+    async def fake_transcribe(pcm, sr=16000, ch=1, lang="en", deadline=None):
+        return "answer"
+
+    async def endless_stream(text, sample_rate=None, deadline=None):
+        try:
+            while True:
+                yield b"\x01\x00" * 400
+                await asyncio.sleep(0.05)
+        finally:
+            closed.append(text)
+
+    monkeypatch.setattr(ws_module.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(ws_module.tts_client, "stream", endless_stream)
+    speech = _speech_pcm([(1, 0.4)])
+
+    def answer_until_end(ws):
+        frames, interrupted = [], None
+        while True:
+            msg = ws.receive()
+            if "bytes" in msg and msg["bytes"]:
+                frames.append(msg["bytes"])
+                continue
+            data = json.loads(msg["text"])
+            if data.get("type") == "end":
+                return frames, interrupted
+            if data.get("type") == "interrupted":
+                interrupted = data
+
+    with TestClient(app).websocket_connect("/ws/gateway") as ws:
+        for trigger in ("__interrupt__", speech):
+            # Фраза ещё не закончилась паузой — её отдаёт __flush__
+            ws.send_bytes(speech)
+            ws.send_text("__flush__")
+            assert json.loads(ws.receive()["text"]) == {"asr_text": "answer"}
+            assert ws.receive()["bytes"]
+            if isinstance(trigger, str):
+                ws.send_text(trigger)
+            else:
+                ws.send_bytes(trigger)
+            frames, interrupted = answer_until_end(ws)
+            # Не больше одного чанка после прерывания, задержка меньше интервала чанков
+            assert len(frames) <= 1
+            assert interrupted is not None and interrupted["latency_ms"] < 50
+        ws.send_text("__close__")
+
+    assert closed == ["answer", "answer"]
+
+
+def test_gateway_ws_survives_tts_connection_drop(monkeypatch):
+    """Проверка: обрыв соединения с TTS посреди ответа — ошибка и end, следующая фраза отвечается"""
+    import json
+
+    import app.ws as ws_module
+    import websockets
+
+    calls = []
+
+    async def fake_transcribe(pcm, sr=16000, ch=1, lang="en", deadline=None):
+        calls.append(len(pcm))
+        return f"utterance {len(calls)}"
+
+    async def dropping_stream(text, sample_rate=None, deadline=None):
+        yield text.encode()
+        if text == "utterance 1":
+            raise websockets.ConnectionClosedError(None, None)
+
+    monkeypatch.setattr(ws_module.asr_client, "transcribe_bytes", fake_transcribe)
+    monkeypatch.setattr(ws_module.tts_client, "stream", dropping_stream)
+    # Без VAD: фразы режутся только по __flush__
+    monkeypatch.setattr(ws_module.settings, "GATEWAY_VAD_SILENCE_MS", 0)
+
+    def answer(ws):
+        replies = []
+        while True:
+            msg = ws.receive()
+            replies.append(msg.get("bytes") or json.loads(msg["text"]))
+            if replies[-1] == {"type": "end"}:
+                return replies
+
+    with TestClient(app).websocket_connect("/ws/gateway") as ws:
+        ws.send_bytes(b"\x00\x00" * 1600)
+        ws.send_text("__flush__")
+        first = answer(ws)
+        assert first[:2] == [{"asr_text": "utterance 1"}, b"utterance 1"]
+        assert "error" in first[2] and first[3] == {"type": "end"}
+
+        ws.send_bytes(b"\x00\x00" * 1600)
+        ws.send_text("__flush__")
+        assert answer(ws) == [{"asr_text": "utterance 2"}, b"utterance 2", {"type": "end"}]
+        ws.send_text("__close__")
+    assert calls == [3200, 3200]
+
+
+def test_gateway_ws_closes_when_responder_fails(monkeypatch):
+    """Проверка: если отвечающая задача упала, сокет закрывается, а не висит"""
+    import app.ws as ws_module
+    from starlette.websockets import WebSocketDisconnect
+
+    async def broken_respond(self):
+        raise ValueError("responder bug")
+
+    monkeypatch.setattr(ws_module.VoiceSession, "_respond", broken_respond)
+    with TestClient(app).websocket_connect("/ws/gateway") as ws:
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+    assert closed.value.code == 1011
+
+
+def test_gateway_circuit_breaker_fails_fast(monkeypatch):
+    """Проверка: после серии отказов цепь размыкается — 503 с Retry-After без обращения к ASR"""
+    import asyncio
+    import time
+
+    import app.http as http
+    from app.balancer import CircuitOpen, ReplicaSet
+    from app.clients import ASRClient
+
+    replicas = ReplicaSet("ASR", ["http://127.0.0.1:1/api/stt/raw"], health_interval=0,
+                          max_failures=2, reset_s=0.2)
+    replica = replicas.replicas[0]
+    replicas.mark_failed(replica)
+    assert replica.breaker.state == "closed"
+    replicas.mark_failed(replica)
+    assert replica.breaker.state == "open"
+    with pytest.raises(CircuitOpen) as opened:
+        replicas.pick()
+    assert 0 < opened.value.retry_after <= 0.2
+
+    client = ASRClient(replicas)
+    monkeypatch.setattr(http, "asr_client", client)
+    started = time.monotonic()
+    r = TestClient(app).post("/api/gateway/tts-from-audio", files={"file": ("a.pcm", b"\x00\x00")})
+    asyncio.run(client.close())
+    assert r.status_code == 503 and r.headers["retry-after"] == "1"
+    assert time.monotonic() - started < 0.2
+
+    # Через reset_s — полуоткрыта: пробный запрос пропускается, успех замыкает цепь
+    time.sleep(0.25)
+    assert replica.breaker.state == "half_open" and replicas.pick() is replica
+    replicas.mark_ok(replica)
+    assert replica.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_gateway_circuit_breaker_half_open_single_trial():
+    """Проверка: полуоткрытая цепь пропускает ровно один пробный запрос; отказ снова размыкает её"""
+    import asyncio
+
+    from app.balancer import CircuitOpen, ReplicaSet
+
+    replicas = ReplicaSet("TTS", ["ws://127.0.0.1:1"], health_interval=0, max_failures=1, reset_s=0.05)
+    replica = replicas.replicas[0]
+    breaker = replica.breaker
+    replicas.mark_failed(replica)
+    assert breaker.state == "open"
+
+    await asyncio.sleep(0.06)
+    assert breaker.state == "half_open"
+    async with replicas.lease() as trial:
+        assert trial is replica
+        # Пока пробный запрос в работе, остальные получают CircuitOpen
+        for _ in range(3):
+            with pytest.raises(CircuitOpen):
+                replicas.pick()
+        replicas.mark_failed(replica)
+    assert breaker.state == "open" and breaker.opened == 2
+
+    # Брошенная проба (отмена, ошибка клиента) освобождает место для следующей
+    await asyncio.sleep(0.06)
+    async with replicas.lease():
+        assert not breaker.allows()
+    assert breaker.state == "half_open" and breaker.allows()
+
+    async with replicas.lease():
+        replicas.mark_ok(replica)
+    assert breaker.state == "closed"
+    for _ in range(3):
+        assert replicas.pick() is replica
+
+    # Запрос, начатый до размыкания, завершается во время пробы — проба остаётся единственной
+    older = replicas.lease()
+    await older.__aenter__()
+    replicas.mark_failed(replica)
+    await asyncio.sleep(0.06)
+    trial = replicas.lease()
+    await trial.__aenter__()
+    await older.__aexit__(None, None, None)
+    assert breaker.state == "half_open" and not breaker.allows()
+    with pytest.raises(CircuitOpen):
+        replicas.pick()
+    await trial.__aexit__(None, None, None)
+    assert breaker.allows()
+
+
+async def _until(predicate):
+    """Ждать, пока условие не станет истинным (оборачивается в asyncio.wait_for)"""
+    import asyncio
+
+    while not predicate():
+        await asyncio.sleep(0.001)
+
+
+@pytest.mark.asyncio
+async def test_gateway_asr_hedges_slow_replica():
+    """Проверка: запрос дольше p95 дублируется на другую реплику, дедлайн уходит в заголовке"""
+    import asyncio
+    import time
+
+    from aiohttp import web
+    from app.balancer import ReplicaSet
+    from app.clients import ASRClient
+    from app.resilience import Deadline
+
+    deadlines = []
+    received = asyncio.Event()
+
+    def recognize(name, delay):
+        async def handler(request):
+            deadlines.append(int(request.headers["X-Request-Deadline-Ms"]))
+            received.set()
+            await asyncio.sleep(delay)
+            return web.json_response({"text": name})
+        return handler
+
+    runners, urls = [], []
+    for name, delay in (("slow", 2.0), ("fast", 0.0)):
+        app_ = web.Application()
+        app_.add_routes([web.post("/api/stt/raw", recognize(name, delay))])
+        runner = web.AppRunner(app_)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        runners.append(runner)
+        urls.append(f"http://127.0.0.1:{runner.addresses[0][1]}/api/stt/raw")
+
+    replicas = ReplicaSet("ASR", urls, health_interval=0)
+    client = ASRClient(replicas)
+    only_slow = ASRClient(ReplicaSet("ASR", urls[:1], health_interval=0))
+    # Обычная задержка — 50 мс
+    client.hedging.min_samples = 3
+    for _ in range(3):
+        client.hedging.record(0.05)
+    slow = replicas.replicas[0]
+    try:
+        # Первой выбирается медленная реплика: у быстрой «занято»
+        replicas.replicas[1].outstanding += 1
+        try:
+            task = asyncio.create_task(client.transcribe_bytes(b"\x00\x00", deadline=Deadline(5)))
+            await asyncio.wait_for(received.wait(), 1.0)
+        finally:
+            replicas.replicas[1].outstanding -= 1
+        started = time.monotonic()
+        assert await task == "fast"
+        assert time.monotonic() - started < 1.0
+        assert client.hedging.stats()["hedged"] == 1 and client.hedging.stats()["wins"] == 1
+        assert 4000 < deadlines[0] <= 5000
+        # Проигравший запрос отменён и не считается отказом реплики
+        await asyncio.wait_for(_until(lambda: slow.outstanding == 0), 1.0)
+        assert slow.failures == 0
+
+        # Дедлайн короче ответа — TimeoutError, а не бесконечное ожидание
+        with pytest.raises(asyncio.TimeoutError):
+            await only_slow.transcribe_bytes(b"\x00\x00", deadline=Deadline(0.1))
+    finally:
+        await only_slow.close()
+        await client.close()
+        for runner in runners:
+            await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_gateway_tts_hedges_first_chunk():
+    """Проверка: если первый чанк TTS запаздывает, запрос дублируется; проигравший отменяется"""
+    import asyncio
+    import json
+
+    import websockets
+    from app.balancer import ReplicaSet
+    from app.clients import TTSClient
+    from app.resilience import Deadline
+
+    cancelled, requests = [], []
+    received, acked = asyncio.Event(), asyncio.Event()
+
+    def fake_tts(name, first_delay):
+        async def handler(ws):
+            jobs = {}
+
+            async def synthesize(rid):
+                await asyncio.sleep(first_delay)
+                await ws.send(bytes([len(rid)]) + rid.encode() + name.encode())
+                await ws.send(json.dumps({"type": "end", "id": rid}))
+
+            try:
+                async for message in ws:
+                    request = json.loads(message)
+                    if request.get("type") == "cancel":
+                        jobs.pop(request["id"]).cancel()
+                        cancelled.append(name)
+                        await ws.send(json.dumps({"type": "cancelled", "id": request["id"]}))
+                        acked.set()
+                        continue
+                    requests.append((name, request["deadline_ms"]))
+                    received.set()
+                    jobs[request["id"]] = asyncio.create_task(synthesize(request["id"]))
+            finally:
+                for job in jobs.values():
+                    job.cancel()
+        return handler
+
+    async with websockets.serve(fake_tts("slow", 2.0), "127.0.0.1", 0) as a, \
+            websockets.serve(fake_tts("fast", 0.0), "127.0.0.1", 0) as b:
+        urls = [f"ws://127.0.0.1:{s.sockets[0].getsockname()[1]}" for s in (a, b)]
+        replicas = ReplicaSet("TTS", urls, health_interval=0)
+        client = TTSClient(replicas=replicas)
+        only_slow = TTSClient(replicas=ReplicaSet("TTS", urls[:1], health_interval=0))
+        client.hedging.min_samples = 1
+        client.hedging.record(0.05)
+        try:
+            # Первой выбирается медленная реплика: у быстрой «занято»
+            replicas.replicas[1].outstanding += 1
+            try:
+                task = asyncio.create_task(client.synthesize("hi", deadline=Deadline(5)))
+                await asyncio.wait_for(received.wait(), 1.0)
+            finally:
+                replicas.replicas[1].outstanding -= 1
+            assert await asyncio.wait_for(task, 1.0) == b"fast"
+            assert [name for name, _ in requests] == ["slow", "fast"]
+            assert all(0 < ms <= 5000 for _, ms in requests)
+            # Проигравший отменяется в фоне — ждём подтверждения от TTS
+            await asyncio.wait_for(acked.wait(), 1.0)
+            assert cancelled == ["slow"]
+            assert client.hedging.stats()["wins"] == 1
+
+            # Одна реплика и поздний первый чанк: ошибка по дедлайну
+            with pytest.raises(asyncio.TimeoutError):
+                await only_slow.synthesize("hi", deadline=Deadline(0.1))
+        finally:
+            await only_slow.close()
+            await client.close()
@@ -1,4 +1,19 @@
-from typing import Iterable
+from typing import Iterable, Optional
+
+import numpy as np
+from app.resampling import StreamResampler
+
+ENCODINGS = ("pcm16", "float32", "mulaw", "alaw")
+
+_BYTES_PER_SAMPLE = {"pcm16": 2, "float32": 4, "mulaw": 1, "alaw": 1}
+
+# Верхние границы сегментов G.711 (как в референсной реализации g711.c)
+_SEG_ULAW_END = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+_SEG_ALAW_END = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+
+# Ресемплинг идёт по чанкам потока: короткий фильтр — меньше задержка
+# (ASR берёт 32 отсчёта на фазу, ему задержка не важна)
+RESAMPLE_TAPS = 16
 
 
 def chunk_pcm_bytes(pcm_bytes: bytes, chunk_size_bytes: int) -> Iterable[bytes]:
@@ -7,3 +22,133 @@ def chunk_pcm_bytes(pcm_bytes: bytes, chunk_size_bytes: int) -> Iterable[bytes]:
     """
     for i in range(0, len(pcm_bytes), chunk_size_bytes):
         yield pcm_bytes[i : i + chunk_size_bytes]
+
+
+class AudioFormat:
+    """
+    Формат выходного аудио, согласуемый клиентом в JSON-запросе.
+
+    `sample_rate=None` означает частоту по умолчанию (TTS_SAMPLE_RATE).
+    """
+
+    def __init__(
+        self,
+        sample_rate: Optional[int] = None,
+        encoding: str = "pcm16",
+        chunk_ms: int = 80,
+    ):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"unknown encoding {encoding!r}")
+        if sample_rate is not None and not 4000 <= int(sample_rate) <= 96000:
+            raise ValueError("sample_rate must be within 4000..96000")
+        if not 5 <= int(chunk_ms) <= 5000:
+            raise ValueError("chunk_ms must be within 5..5000")
+        self.sample_rate = int(sample_rate) if sample_rate is not None else None
+        self.encoding = encoding
+        self.chunk_ms = int(chunk_ms)
+
+    @classmethod
+    def from_request(cls, payload: dict, default_chunk_ms: int = 80) -> "AudioFormat":
+        """Формат из необязательных полей `sample_rate`, `encoding`, `chunk_ms`."""
+        rate = payload.get("sample_rate")
+        return cls(
+            sample_rate=int(rate) if rate else None,
+            encoding=str(payload.get("encoding") or "pcm16"),
+            chunk_ms=int(payload.get("chunk_ms") or default_chunk_ms),
+        )
+
+    @staticmethod
+    def requested(payload: dict) -> bool:
+        return any(k in payload for k in ("sample_rate", "encoding", "chunk_ms"))
+
+    @property
+    def bytes_per_sample(self) -> int:
+        return _BYTES_PER_SAMPLE[self.encoding]
+
+    def chunk_bytes(self, sample_rate: int) -> int:
+        samples = max(1, int(sample_rate * self.chunk_ms / 1000))
+        return samples * self.bytes_per_sample
+
+    def describe(self, sample_rate: int) -> dict:
+        return {
+            "sample_rate": sample_rate,
+            "encoding": self.encoding,
+            "channels": 1,
+            "chunk_ms": self.chunk_ms,
+        }
+
+
+def pcm16_to_mulaw(x: np.ndarray) -> np.ndarray:
+    """G.711 µ-law из int16, векторно."""
+    pcm = x.astype(np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    pcm = np.minimum(np.abs(pcm), 8159) + 0x21
+    seg = np.searchsorted(_SEG_ULAW_END, pcm)
+    uval = (seg << 4) | ((pcm >> (seg + 1)) & 0x0F)
+    uval = np.where(seg >= 8, 0x7F, uval)
+    return ((uval ^ mask) & 0xFF).astype(np.uint8)
+
+
+def pcm16_to_alaw(x: np.ndarray) -> np.ndarray:
+    """G.711 A-law из int16, векторно."""
+    pcm = x.astype(np.int32) >> 3
+    negative = pcm < 0
+    mask = np.where(negative, 0x55, 0xD5)
+    pcm = np.where(negative, -pcm - 1, pcm)
+    seg = np.searchsorted(_SEG_ALAW_END, pcm)
+    shift = np.maximum(seg, 1)
+    aval = (seg << 4) | ((pcm >> shift) & 0x0F)
+    aval = np.where(seg >= 8, 0x7F, aval)
+    return ((aval ^ mask) & 0xFF).astype(np.uint8)
+
+
+class AudioEncoder:
+    """
+    Переводит 16-bit mono PCM с частотой голоса в запрошенный формат:
+    ресемплинг (если частоты различаются) и кодирование.
+    """
+
+    def __init__(self, src_rate: int, dst_rate: int, encoding: str = "pcm16"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"unknown encoding {encoding!r}")
+        self.src_rate = int(src_rate)
+        self.dst_rate = int(dst_rate)
+        self.encoding = encoding
+        self._resampler = (
+            StreamResampler(self.src_rate, self.dst_rate, RESAMPLE_TAPS)
+            if self.src_rate != self.dst_rate
+            else None
+        )
+        self._odd = b""  # половина отсчёта, пришедшая в конце предыдущего куска
+
+    @property
+    def passthrough(self) -> bool:
+        """True, если вход можно отдавать как есть."""
+        return self._resampler is None and self.encoding == "pcm16"
+
+    def _encode(self, samples: np.ndarray) -> bytes:
+        if self.encoding == "float32":
+            return (samples.astype(np.float32) / 32768.0).astype("<f4").tobytes()
+        pcm = np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+        if self.encoding == "mulaw":
+            return pcm16_to_mulaw(pcm).tobytes()
+        if self.encoding == "alaw":
+            return pcm16_to_alaw(pcm).tobytes()
+        return pcm.astype("<i2").tobytes()
+
+    def encode(self, pcm) -> bytes:
+        data = memoryview(pcm).cast("B")
+        if self._odd:
+            data = self._odd + bytes(data)
+        cut = len(data) - len(data) % 2
+        self._odd = bytes(data[cut:])
+        samples = np.frombuffer(data[:cut], dtype="<i2")
+        if self._resampler is not None:
+            samples = self._resampler.process(samples)
+        return self._encode(samples)
+
+    def flush(self) -> bytes:
+        if self._resampler is None:
+            return b""
+        return self._encode(self._resampler.flush())
+
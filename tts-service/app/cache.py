@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+AudioBuffer = Union[bytes, memoryview]
+
+
+class AudioCache:
+    """
+    Content-addressed cache of synthesized audio.
+
+    Two tiers:
+    - memory: LRU of `bytes`, bounded by `memory_bytes`;
+    - disk (optional): one file per entry under `cache_dir`, bounded by
+      `disk_bytes` and served through mmap, so a hit is a memoryview over the
+      page cache with no read() copies.
+
+    Entries are immutable, so a key always maps to the same audio and files
+    can be shared by several replicas mounting the same directory.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = 64 * 1024 * 1024,
+        cache_dir: Optional[str] = None,
+        disk_bytes: int = 1024 * 1024 * 1024,
+    ):
+        self.memory_bytes = int(memory_bytes)
+        self.disk_bytes = int(disk_bytes)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_used = sum(size for _, size, _ in self._disk_entries())
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(voice: str, text: str, fmt: str) -> str:
+        normalized = " ".join(text.split())
+        raw = json.dumps([voice, fmt, normalized], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pcm"
+
+    def contains(self, key: str) -> bool:
+        """Membership test that does not touch LRU order or hit/miss counters."""
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.cache_dir is not None and self._path(key).exists()
+
+    def get(self, key: str) -> Optional[AudioBuffer]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return data
+
+        view = self._get_disk(key)
+        with self._lock:
+            if view is None:
+                self.misses += 1
+            else:
+                self.hits_disk += 1
+        return view
+
+    def _get_disk(self, key: str) -> Optional[memoryview]:
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Bump mtime so disk eviction drops the least recently used files first
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            logger.warning("Failed to map cache entry %s", path, exc_info=True)
+            return None
+        return memoryview(mapped)
+
+    def put(self, key: str, data: bytes) -> None:
+        if not data:
+            return
+        data = bytes(data)
+
+        with self._lock:
+            if len(data) <= self.memory_bytes and key not in self._memory:
+                self._memory[key] = data
+                self._memory_used += len(data)
+                while self._memory_used > self.memory_bytes:
+                    _, evicted = self._memory.popitem(last=False)
+                    self._memory_used -= len(evicted)
+                    self.evictions += 1
+
+        if self.cache_dir is not None:
+            self._put_disk(key, data)
+
+    def _put_disk(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        if path.exists():
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            # Atomic publish: readers never see a half-written entry
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning("Failed to write cache entry %s", path, exc_info=True)
+            return
+
+        with self._lock:
+            self._disk_used += len(data)
+            over_budget = self._disk_used > self.disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _disk_entries(self):
+        for path in self.cache_dir.glob("*/*.pcm"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            yield st.st_mtime, st.st_size, path
+
+    def _evict_disk(self) -> None:
+        """Drop least recently used files until the store fits in `disk_bytes`."""
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.disk_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_used = total
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_bytes": self._disk_used,
+            }
+
+
+def read_phrases(path: str) -> Iterable[str]:
+    """Phrases for cache pre-warming: one per line, blank lines and `#` comments skipped."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
@@ -0,0 +1,353 @@
+import json
+import logging
+import os
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import numpy as np
+from app.pool import (
+    PRIORITY_FIRST,
+    LeasePool,
+    PiperProcess,
+    PiperWorkerError,
+    PiperWorkerPool,
+)
+from app.text import split_sentences
+
+logger = logging.getLogger(__name__)
+
+# Engines yield any contiguous buffer of 16-bit mono PCM
+PCMBuffer = Union[bytes, np.ndarray]
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def looks_like_text(b: bytes, threshold: float = 0.6) -> bool:
+    """
+    Return True if `b` contains a high fraction of printable ASCII characters.
+    Helps detect when stdout contains text logs instead of raw PCM.
+    """
+    if not b:
+        return False
+    s = np.frombuffer(b, dtype=np.uint8, count=min(len(b), 200))
+    printable = np.count_nonzero((s >= 32) & (s <= 126))
+    return printable >= threshold * len(s)
+
+
+class SynthesisEngine(ABC):
+    """
+    Backend that turns text into 16-bit mono PCM for one voice.
+
+    `lease()` hands out a session with a `synthesize(text)` generator for the
+    exclusive use of one request; `size` sessions can run concurrently.
+    `session.cancel()` may be called from another thread and makes the
+    generator stop at the next sentence boundary. Subclasses must implement
+    `sample_rate` and `lease()`.
+    """
+
+    name = "base"
+    # Whether the engine needs the voice's .onnx/.onnx.json files
+    requires_model = True
+
+    size: int = 1
+
+    @property
+    @abstractmethod
+    def sample_rate(self) -> int:
+        ...
+
+    @abstractmethod
+    def lease(self, timeout: Optional[float] = None, priority: int = PRIORITY_FIRST):
+        """Context manager yielding a session; waits up to `timeout` for a free one."""
+
+    def memory_bytes(self) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {"engine": self.name, "size": self.size}
+
+    def close(self) -> None:
+        pass
+
+
+class PipeSession:
+    """Session over one leased Piper process; checks that the pipe carries PCM."""
+
+    def __init__(self, worker: PiperProcess):
+        self.worker = worker
+
+    def cancel(self) -> None:
+        self.worker.cancel()
+
+    def synthesize(self, text: str) -> Iterator[bytes]:
+        # Frames are length-prefixed and the worker's fd 1 points at stderr, so
+        # logs cannot interleave with audio: looking at the first frame of an
+        # utterance is enough to catch a worker that is not sending PCM at all
+        checked = False
+        for audio in self.worker.synthesize(text):
+            if not checked:
+                checked = True
+                if len(audio) % 2 or looks_like_text(audio):
+                    self.worker.kill()
+                    self.worker.broken = True
+                    raise PiperWorkerError(
+                        "Piper stdout contained text instead of PCM.",
+                        code="invalid_audio",
+                        pid=self.worker.pid,
+                    )
+            yield audio
+
+
+class SubprocessEngine(SynthesisEngine):
+    """Warm Piper worker processes talking over pipes (see `app.pool`)."""
+
+    name = "subprocess"
+
+    def __init__(
+        self,
+        model_path: Path,
+        size: int = 1,
+        start_timeout: float = 60.0,
+        healthcheck_interval: float = 15.0,
+    ):
+        self.pool = PiperWorkerPool(
+            model_path,
+            size=size,
+            start_timeout=start_timeout,
+            healthcheck_interval=healthcheck_interval,
+        )
+        self.size = self.pool.size
+
+    @property
+    def sample_rate(self) -> int:
+        return self.pool.sample_rate
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None, priority: int = PRIORITY_FIRST):
+        with self.pool.lease(timeout=timeout, priority=priority) as worker:
+            yield PipeSession(worker)
+
+    def memory_bytes(self) -> int:
+        """Resident memory of the worker processes (model file size if unknown)."""
+        total = 0
+        for worker in self.pool._workers:
+            try:
+                with open(f"/proc/{worker.pid}/statm") as f:
+                    total += int(f.read().split()[1]) * _PAGE_SIZE
+            except (OSError, ValueError, IndexError, TypeError):
+                total += self.pool.model_path.stat().st_size
+        return total
+
+    def stats(self) -> dict:
+        return {"engine": self.name, **self.pool.stats()}
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class _SessionPool(LeasePool):
+    resource_name = "synthesis session"
+
+    def __init__(self, sessions):
+        super().__init__()
+        for session in sessions:
+            self._put(session)
+
+    def _prepare(self, session) -> None:
+        session.reset()
+
+
+class _InProcessSession:
+    """Session whose generator checks a cancel flag between sentences."""
+
+    def __init__(self):
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def reset(self) -> None:
+        self._cancel.clear()
+
+
+class OnnxSession(_InProcessSession):
+    def __init__(self, voice):
+        super().__init__()
+        self.voice = voice
+
+    def _infer(self, phoneme_ids) -> np.ndarray:
+        from piper.util import audio_float_to_int16
+
+        config = self.voice.config
+        ids = np.expand_dims(np.array(phoneme_ids, dtype=np.int64), 0)
+        inputs = {
+            "input": ids,
+            "input_lengths": np.array([ids.shape[1]], dtype=np.int64),
+            "scales": np.array(
+                [config.noise_scale, config.length_scale, config.noise_w],
+                dtype=np.float32,
+            ),
+        }
+        if config.num_speakers > 1:
+            inputs["sid"] = np.array([0], dtype=np.int64)
+
+        audio = self.voice.session.run(None, inputs)[0].squeeze()
+        return audio_float_to_int16(audio)
+
+    def synthesize(self, text: str) -> Iterator[np.ndarray]:
+        for phonemes in self.voice.phonemize(text):
+            if self.cancelled:
+                return
+            yield self._infer(self.voice.phonemes_to_ids(phonemes))
+
+
+class OnnxEngine(SynthesisEngine):
+    """
+    Runs the Piper voice in-process with onnxruntime.
+
+    One InferenceSession is shared by `size` concurrent sessions (ORT's run()
+    is thread-safe), and audio comes back as numpy arrays with no pipe, no
+    framing and no copies into bytes.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path: Path, size: int = 1, intra_op_threads: int = 0):
+        import onnxruntime
+        from piper.config import PiperConfig
+        from piper.voice import PiperVoice
+
+        self.model_path = Path(model_path)
+        with open(f"{self.model_path}.json", "r", encoding="utf-8") as f:
+            config = PiperConfig.from_dict(json.load(f))
+
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = int(intra_op_threads)
+        session = onnxruntime.InferenceSession(
+            str(self.model_path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.voice = PiperVoice(session=session, config=config)
+        self.size = max(1, int(size))
+        self._sessions = _SessionPool(OnnxSession(self.voice) for _ in range(self.size))
+
+    @property
+    def sample_rate(self) -> int:
+        return self.voice.config.sample_rate
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None, priority: int = PRIORITY_FIRST):
+        with self._sessions.lease(timeout=timeout, priority=priority) as session:
+            yield session
+
+    def memory_bytes(self) -> int:
+        return self.model_path.stat().st_size
+
+    def stats(self) -> dict:
+        return {"engine": self.name, "size": self.size, **self._sessions.lease_stats()}
+
+    def close(self) -> None:
+        self._sessions.close()
+
+
+class FakeSession(_InProcessSession):
+    def __init__(self, sample_rate: int, speed: float, ms_per_char: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.ms_per_char = ms_per_char
+
+    def synthesize(self, text: str) -> Iterator[np.ndarray]:
+        for sentence in split_sentences(text):
+            if self.cancelled:
+                return
+            n = int(self.sample_rate * self.ms_per_char * len(sentence) / 1000)
+            # Same sentence -> same tone, so output is reproducible across runs
+            freq = 200 + zlib.crc32(sentence.encode("utf-8")) % 400
+            t = np.arange(n, dtype=np.float32) / self.sample_rate
+            audio = (np.sin(2 * np.pi * freq * t) * 8000).astype(np.int16)
+            # "Synthesis" time; a cancel cuts it short like a real engine would
+            if self.speed > 0 and self._cancel.wait(n / self.sample_rate / self.speed):
+                return
+            yield audio
+
+
+class FakeEngine(SynthesisEngine):
+    """
+    Deterministic synthetic PCM (one tone per sentence) produced `speed` times
+    faster than real time (0 = instantly). Needs no models or Piper install,
+    for load-testing the streaming and transport layers.
+    """
+
+    name = "fake"
+    requires_model = False
+
+    def __init__(
+        self,
+        size: int = 1,
+        sample_rate: int = 22050,
+        speed: float = 0.0,
+        ms_per_char: float = 60.0,
+    ):
+        self.size = max(1, int(size))
+        self._sample_rate = int(sample_rate)
+        self._sessions = _SessionPool(
+            FakeSession(self._sample_rate, float(speed), float(ms_per_char))
+            for _ in range(self.size)
+        )
+
+    @property
+    def sample_rate(self) -> int:
+        return self._sample_rate
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None, priority: int = PRIORITY_FIRST):
+        with self._sessions.lease(timeout=timeout, priority=priority) as session:
+            yield session
+
+    def stats(self) -> dict:
+        return {"engine": self.name, "size": self.size, **self._sessions.lease_stats()}
+
+    def close(self) -> None:
+        self._sessions.close()
+
+
+ENGINES = {
+    SubprocessEngine.name: SubprocessEngine,
+    OnnxEngine.name: OnnxEngine,
+    FakeEngine.name: FakeEngine,
+}
+
+
+def create_engine(
+    kind: str,
+    model_path: Path,
+    size: int = 1,
+    start_timeout: float = 60.0,
+    healthcheck_interval: float = 15.0,
+    onnx_threads: int = 0,
+    fake_sample_rate: int = 22050,
+    fake_speed: float = 0.0,
+) -> SynthesisEngine:
+    if kind == SubprocessEngine.name:
+        return SubprocessEngine(
+            model_path,
+            size=size,
+            start_timeout=start_timeout,
+            healthcheck_interval=healthcheck_interval,
+        )
+    if kind == OnnxEngine.name:
+        return OnnxEngine(model_path, size=size, intra_op_threads=onnx_threads)
+    if kind == FakeEngine.name:
+        return FakeEngine(size=size, sample_rate=fake_sample_rate, speed=fake_speed)
+    raise ValueError(f"unknown TTS engine {kind!r}, expected one of {sorted(ENGINES)}")
@@ -1,10 +1,24 @@
+import asyncio
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, suppress
+from functools import partial
+from typing import Dict, Optional, Tuple
 
+from app.admission import AdmissionController, Overloaded
+from app.audio import AudioFormat
+from app.cache import AudioCache, read_phrases
 from app.logging_conf import setup_logging
+from app.pacing import Pacer
+from app.pool import PiperWorkerError
+from app.readiness import Readiness
 from app.settings import settings
+from app.streaming import CancelScope, iterate_in_thread
 from app.tts import TTSModel
+from app.voices import UnknownVoiceError
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
 
 setup_logging(settings.LOG_LEVEL)
 logger = logging.getLogger(__name__)
@@ -13,49 +27,313 @@ app = FastAPI(title="TTS Service (Piper)", version="1.0.0")
 
 tts_model = None
 
-@app.on_event("startup")
-async def startup_event():
+# Synthesis is blocking (pipe reads, pacing sleeps), so every stream runs in
+# its own thread and never stalls the event loop for other clients.
+stream_executor = ThreadPoolExecutor(
+    max_workers=settings.TTS_STREAM_THREADS, thread_name_prefix="tts-stream"
+)
+
+# Caps syntheses across all connections; the rest queue by priority or get
+# an "overloaded" error with retry_after instead of slowing everyone down
+admission = AdmissionController(
+    concurrency=settings.TTS_MAX_CONCURRENT,
+    max_queue=settings.TTS_MAX_QUEUE,
+    queue_timeout=settings.TTS_QUEUE_TIMEOUT,
+)
+
+readiness = Readiness()
+_loading: Optional[asyncio.Task] = None
+
+
+def _load_model():
+    cache = None
+    if settings.TTS_CACHE_MEMORY_MB > 0 or settings.TTS_CACHE_DIR:
+        with readiness.phase("cache"):
+            cache = AudioCache(
+                memory_bytes=settings.TTS_CACHE_MEMORY_MB * 1024 * 1024,
+                cache_dir=settings.TTS_CACHE_DIR or None,
+                disk_bytes=settings.TTS_CACHE_DISK_MB * 1024 * 1024,
+            )
+    with readiness.phase("load"):
+        model = TTSModel(
+            models_dir=settings.TTS_MODELS_DIR,
+            voice=settings.TTS_VOICE,
+            sample_rate=settings.TTS_SAMPLE_RATE,
+            chunk_ms=settings.TTS_CHUNK_MS,
+            workers=settings.TTS_WORKERS,
+            worker_start_timeout=settings.TTS_WORKER_START_TIMEOUT,
+            healthcheck_interval=settings.TTS_HEALTHCHECK_INTERVAL,
+            parallel_segments=settings.TTS_PARALLEL_SEGMENTS,
+            cache=cache,
+            voice_memory_budget_mb=settings.TTS_VOICE_MEMORY_MB,
+            engine=settings.TTS_ENGINE,
+            onnx_threads=settings.TTS_ONNX_THREADS,
+            fake_speed=settings.TTS_FAKE_SPEED,
+        )
+    try:
+        with readiness.phase("warmup"):
+            model.warmup()
+    except BaseException:
+        model.close()
+        raise
+    return model
+
+
+async def load_model():
     global tts_model
     logger.info("Loading Piper TTS model...")
-    tts_model = TTSModel(
-        models_dir=settings.TTS_MODELS_DIR,
-        voice=settings.TTS_VOICE,
-        sample_rate=settings.TTS_SAMPLE_RATE,
-        chunk_ms=settings.TTS_CHUNK_MS,
-    )
+    try:
+        model = await asyncio.to_thread(_load_model)
+    except Exception as e:
+        logger.exception("Piper TTS model loading failed")
+        readiness.fail(e)
+        return
+    tts_model = model
+    readiness.mark_ready()
     logger.info("Piper TTS ready.")
 
+    if model.cache is not None and settings.TTS_CACHE_PREWARM_FILE:
+        asyncio.create_task(prewarm_cache(settings.TTS_CACHE_PREWARM_FILE))
+
+
+@app.on_event("startup")
+async def startup_event():
+    global _loading
+    # The port opens right away; the model loads in the background (see /readyz)
+    _loading = asyncio.create_task(load_model())
+
+
+async def prewarm_cache(path: str):
+    try:
+        phrases = list(read_phrases(path))
+        added = await asyncio.to_thread(tts_model.prewarm, phrases)
+        logger.info("TTS cache pre-warmed: %d new of %d phrases", added, len(phrases))
+    except Exception:
+        logger.exception("TTS cache pre-warm failed")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _loading is not None:
+        _loading.cancel()
+    stream_executor.shutdown(wait=False, cancel_futures=True)
+    if tts_model is not None:
+        tts_model.close()
+
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
 
+@app.get("/readyz")
+async def readyz():
+    status = readiness.status()
+    return JSONResponse(status, status_code=200 if readiness.ready else 503)
+
+@app.get("/stats")
+async def stats():
+    if tts_model is None:
+        return {}
+    return {
+        "admission": admission.stats(),
+        "voices": tts_model.voices.stats(),
+        "cache": tts_model.cache.stats() if tts_model.cache else None,
+    }
+
+@app.get("/voices")
+async def voices():
+    if tts_model is None:
+        return {"default": settings.TTS_VOICE, "available": []}
+    return {
+        "default": tts_model.voice,
+        "available": tts_model.voices.available(),
+    }
+
+def _tag(request_id: str) -> bytes:
+    """Prefix of a multiplexed binary frame: <id length:uint8><id utf-8>."""
+    raw = request_id.encode("utf-8")
+    return bytes([len(raw)]) + raw
+
+
+class TTSConnection:
+    """
+    One /ws/tts connection.
+
+    Requests without an `id` are served one at a time, as bare PCM frames.
+    An optional `deadline_ms` bounds how long a request may wait for a slot.
+    Requests with an `id` run concurrently: their binary frames are prefixed
+    with the id (see `_tag`), their text messages carry it, and
+    `{"type": "cancel", "id": ...}` stops the synthesis and frees its workers.
+    """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self._send_lock = asyncio.Lock()
+        self._inflight: Dict[str, Tuple[asyncio.Task, CancelScope]] = {}
+
+    async def send_json(self, message: dict, request_id: Optional[str] = None):
+        if request_id is not None:
+            message = {**message, "id": request_id}
+        async with self._send_lock:
+            await self.ws.send_text(json.dumps(message))
+
+    async def send_audio(self, chunk, tag: bytes = b""):
+        async with self._send_lock:
+            await self.ws.send_bytes(tag + chunk if tag else chunk)
+
+    async def run(self):
+        try:
+            while True:
+                data = await self.ws.receive_text()
+                try:
+                    payload = json.loads(data)
+                    if not isinstance(payload, dict):
+                        raise ValueError("not an object")
+                except Exception:
+                    await self.send_json({"error": "invalid json"})
+                    continue
+
+                request_id = payload.get("id")
+                if request_id is not None:
+                    request_id = str(request_id)
+                    if not 0 < len(request_id.encode("utf-8")) <= 255:
+                        await self.send_json({"error": "id must be 1..255 bytes"})
+                        continue
+
+                if payload.get("type") == "cancel":
+                    await self.cancel(request_id)
+                elif request_id is None:
+                    await self.handle(payload, None, CancelScope())
+                elif request_id in self._inflight:
+                    await self.send_json({"error": "duplicate id"}, request_id)
+                elif len(self._inflight) >= settings.TTS_MAX_REQUESTS_PER_CONNECTION:
+                    await self.send_json({"error": "too many requests"}, request_id)
+                else:
+                    scope = CancelScope()
+                    task = asyncio.create_task(self.handle(payload, request_id, scope))
+                    self._inflight[request_id] = (task, scope)
+                    task.add_done_callback(partial(self._forget, request_id))
+        except WebSocketDisconnect:
+            logger.info("Client disconnected")
+        finally:
+            for task, scope in list(self._inflight.values()):
+                scope.cancel()
+                task.cancel()
+
+    def _forget(self, request_id: str, task: asyncio.Task):
+        self._inflight.pop(request_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            # Only a dead socket gets here; run() sees it on the next receive
+            logger.debug("TTS request %s aborted: %r", request_id, task.exception())
+
+    async def cancel(self, request_id: Optional[str]):
+        entry = self._inflight.get(request_id) if request_id is not None else None
+        if entry is None:
+            await self.send_json({"error": "unknown id"}, request_id)
+            return
+        task, scope = entry
+        # Stop the workers first: the task may be waiting for their next frame
+        scope.cancel()
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+        await self.send_json({"type": "cancelled"}, request_id)
+
+    async def handle(
+        self, payload: dict, request_id: Optional[str], scope: CancelScope
+    ):
+        if tts_model is None:
+            await self.send_json(
+                {"error": "model not loaded yet", "code": "not_ready"}, request_id
+            )
+            return
+
+        text = str(payload.get("text", "")).strip()
+        if not text:
+            await self.send_json({"error": "empty text"}, request_id)
+            return
+
+        try:
+            pacer = Pacer.from_request(
+                payload,
+                default_mode=settings.TTS_DEFAULT_PACING,
+                default_lead_ms=settings.TTS_LEAD_MS,
+            )
+        except (TypeError, ValueError) as e:
+            await self.send_json({"error": f"invalid pacing: {e}"}, request_id)
+            return
+
+        try:
+            fmt = AudioFormat.from_request(
+                payload, default_chunk_ms=settings.TTS_CHUNK_MS
+            )
+        except (TypeError, ValueError) as e:
+            await self.send_json({"error": f"invalid format: {e}"}, request_id)
+            return
+
+        try:
+            voice = tts_model.voices.resolve(payload.get("voice"))
+        except UnknownVoiceError as e:
+            await self.send_json({"error": str(e)}, request_id)
+            return
+
+        priority = str(payload.get("priority") or "interactive")
+        try:
+            admission.priority_of(priority)
+        except ValueError as e:
+            await self.send_json({"error": str(e)}, request_id)
+            return
+
+        # Remaining budget of the caller: no point queueing for longer than that
+        deadline_ms = payload.get("deadline_ms")
+        if deadline_ms is not None and (
+            isinstance(deadline_ms, bool)
+            or not isinstance(deadline_ms, (int, float))
+            or deadline_ms < 0
+        ):
+            await self.send_json({"error": "invalid deadline_ms"}, request_id)
+            return
+
+        logger.info("Generating speech for text len=%d", len(text))
+        tag = _tag(request_id) if request_id is not None else b""
+        try:
+            timeout = deadline_ms / 1000 if deadline_ms is not None else None
+            async with admission.slot(priority, timeout=timeout):
+                # Clients that negotiate a format are told what they will get;
+                # legacy clients keep receiving bare PCM frames
+                if AudioFormat.requested(payload):
+                    start = fmt.describe(tts_model.output_rate(fmt))
+                    await self.send_json({"type": "start", **start}, request_id)
+
+                stream = iterate_in_thread(
+                    lambda: tts_model.stream_text(
+                        text, pacer=pacer, voice=voice, fmt=fmt, scope=scope
+                    ),
+                    executor=stream_executor,
+                    maxsize=settings.TTS_STREAM_QUEUE_CHUNKS,
+                )
+                async with aclosing(stream):
+                    async for chunk in stream:
+                        await self.send_audio(chunk, tag)
+            await self.send_json({"type": "end"}, request_id)
+        except Overloaded as e:
+            await self.send_json(
+                {"error": str(e), "code": "overloaded", "retry_after": e.retry_after},
+                request_id,
+            )
+        except (WebSocketDisconnect, asyncio.CancelledError):
+            scope.cancel()
+            raise
+        except PiperWorkerError as e:
+            # Details (stderr, exit code) are logged by the pool, not sent out
+            await self.send_json(e.as_dict(), request_id)
+        except Exception as e:
+            logger.exception("TTS streaming error")
+            await self.send_json({"error": str(e)}, request_id)
+
+
 @app.websocket("/ws/tts")
 async def ws_tts_endpoint(ws: WebSocket):
     await ws.accept()
-    try:
-        while True:
-            data = await ws.receive_text()
-            try:
-                payload = json.loads(data)
-                text = payload.get("text", "").strip()
-            except Exception:
-                await ws.send_text(json.dumps({"error": "invalid json"}))
-                continue
-
-            if not text:
-                await ws.send_text(json.dumps({"error": "empty text"}))
-                continue
-
-            logger.info("Generating speech for text len=%d", len(text))
-            try:
-                for chunk in tts_model.stream_text(text):
-                    await ws.send_bytes(chunk)
-                await ws.send_text(json.dumps({"type": "end"}))
-            except Exception as e:
-                logger.exception("TTS streaming error")
-                await ws.send_text(json.dumps({"error": str(e)}))
-    except WebSocketDisconnect:
-        logger.info("Client disconnected")
+    await TTSConnection(ws).run()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,73 @@
+import time
+from typing import Optional
+
+PACING_MODES = ("burst", "realtime", "lead")
+
+
+class Pacer:
+    """
+    Decides when the next audio chunk may be sent, given chunk durations.
+
+    - burst: no throttling, chunks go out as fast as they are synthesized;
+    - realtime: chunks follow the audio clock, `speed` times faster than
+      real time (speed=1.0 is real time);
+    - lead: the first `lead_ms` of audio are sent at once to fill the client's
+      jitter buffer, the rest is paced like realtime.
+
+    Deadlines are computed from the start of the stream and the amount of
+    audio already sent, not by sleeping a fixed period per chunk, so time
+    spent in synthesis or in the network does not accumulate as drift.
+    """
+
+    def __init__(
+        self,
+        mode: str = "realtime",
+        speed: float = 1.0,
+        lead_ms: int = 0,
+        clock=time.monotonic,
+    ):
+        if mode not in PACING_MODES:
+            raise ValueError(f"unknown pacing mode {mode!r}")
+        if speed <= 0:
+            raise ValueError("pacing speed must be positive")
+        self.mode = mode
+        self.speed = float(speed)
+        self.lead_s = max(0, int(lead_ms)) / 1000.0 if mode == "lead" else 0.0
+        self._clock = clock
+        self._start: Optional[float] = None
+        self._sent_s = 0.0
+
+    @classmethod
+    def from_request(
+        cls,
+        payload: dict,
+        default_mode: str = "realtime",
+        default_lead_ms: int = 0,
+    ) -> "Pacer":
+        """Build a pacer from the optional `pacing`, `speed`, `lead_ms` request fields."""
+        return cls(
+            mode=str(payload.get("pacing") or default_mode),
+            speed=float(payload.get("speed") or 1.0),
+            lead_ms=int(payload.get("lead_ms", default_lead_ms)),
+        )
+
+    def delay(self, duration_s: float) -> float:
+        """
+        Seconds to wait before sending a chunk of `duration_s` seconds of audio;
+        accounts the chunk as sent.
+        """
+        if self.mode == "burst":
+            return 0.0
+
+        now = self._clock()
+        if self._start is None:
+            self._start = now
+
+        due = self._start + (self._sent_s - self.lead_s) / self.speed
+        self._sent_s += duration_s
+        return max(0.0, due - now)
+
+    def wait(self, duration_s: float) -> None:
+        pause = self.delay(duration_s)
+        if pause > 0:
+            time.sleep(pause)
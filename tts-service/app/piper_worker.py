@@ -0,0 +1,145 @@
+"""
+Long-lived Piper worker process.
+
+Loads a voice once and then synthesizes one request per stdin line. Audio is
+written to stdout as length-prefixed frames, so several utterances can share
+the same pipe and the parent always knows where one ends and the next begins:
+
+    header: <kind:uint8><length:uint32 LE>, followed by `length` payload bytes
+
+A ``{"op": "cancel"}`` line stops the utterance in progress at the next
+sentence boundary; it still ends with FRAME_END. A cancel that arrives after
+the utterance finished is ignored.
+
+Run as ``python -m app.piper_worker --model /path/to/voice.onnx``.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+from typing import BinaryIO, Tuple
+
+FRAME_HEADER = struct.Struct("<BI")
+
+FRAME_AUDIO = 0  # raw 16-bit mono PCM
+FRAME_END = 1  # utterance finished
+FRAME_ERROR = 2  # utterance failed, payload is a utf-8 message
+FRAME_READY = 3  # voice loaded, payload is JSON with voice info
+
+logger = logging.getLogger("piper_worker")
+
+
+def write_frame(out: BinaryIO, kind: int, payload: bytes = b"") -> None:
+    out.write(FRAME_HEADER.pack(kind, len(payload)))
+    if payload:
+        out.write(payload)
+    out.flush()
+
+
+def read_frame(stream: BinaryIO) -> Tuple[int, bytes]:
+    """
+    Read one frame from `stream`. Raises EOFError if the worker went away.
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError("Piper worker closed its stdout")
+    kind, length = FRAME_HEADER.unpack(header)
+    payload = stream.read(length) if length else b""
+    if len(payload) < length:
+        raise EOFError("Piper worker closed its stdout mid-frame")
+    return kind, payload
+
+
+class _Requests:
+    """
+    Reads stdin in a thread so a cancel can arrive while synthesis runs.
+
+    Requests are numbered in arrival order; a cancel applies to every request
+    read before it, which is exactly the one in progress (the parent sends
+    the next request only after the current one ended).
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._last_seq = 0
+        self._cancelled_upto = 0
+        threading.Thread(target=self._read, args=(stream,), daemon=True).start()
+
+    def _read(self, stream: BinaryIO) -> None:
+        for line in stream:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if isinstance(request, dict) and request.get("op") == "cancel":
+                with self._lock:
+                    self._cancelled_upto = self._last_seq
+                continue
+            with self._lock:
+                self._last_seq += 1
+                self._queue.put((self._last_seq, request))
+        self._queue.put((None, None))
+
+    def get(self):
+        return self._queue.get()
+
+    def is_cancelled(self, seq: int) -> bool:
+        with self._lock:
+            return self._cancelled_upto >= seq
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help="Path to Onnx voice model")
+    parser.add_argument("--config", help="Path to voice config (default: model + .json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    # Keep a private handle on the real stdout and point fd 1 at stderr, so a
+    # stray print() from a library can never corrupt the frame stream.
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    from piper.voice import PiperVoice
+
+    voice = PiperVoice.load(args.model, config_path=args.config)
+    write_frame(
+        out,
+        FRAME_READY,
+        json.dumps({"sample_rate": voice.config.sample_rate}).encode("utf-8"),
+    )
+
+    requests = _Requests(sys.stdin.buffer)
+    while True:
+        seq, request = requests.get()
+        if seq is None:
+            break
+        if not isinstance(request, dict):
+            write_frame(out, FRAME_ERROR, b"invalid request")
+            continue
+
+        if request.get("op") == "ping":
+            write_frame(out, FRAME_END)
+            continue
+
+        text = str(request.get("text", "")).strip()
+        try:
+            if text:
+                for audio_bytes in voice.synthesize_stream_raw(text):
+                    if requests.is_cancelled(seq):
+                        break
+                    write_frame(out, FRAME_AUDIO, audio_bytes)
+            write_frame(out, FRAME_END)
+        except Exception as e:
+            logger.exception("Synthesis failed")
+            write_frame(out, FRAME_ERROR, str(e).encode("utf-8", errors="replace"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+import heapq
+import itertools
+import json
+import logging
+import subprocess
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from app.piper_worker import (
+    FRAME_AUDIO,
+    FRAME_END,
+    FRAME_ERROR,
+    FRAME_READY,
+    read_frame,
+)
+
+logger = logging.getLogger(__name__)
+
+# Directory that contains the `app` package, used as cwd for `python -m app.piper_worker`
+SERVICE_ROOT = Path(__file__).resolve().parent.parent
+
+
+# Lease priorities: lower is served first when several requests wait for a worker
+PRIORITY_FIRST = 0  # first (or only) segment of an utterance, the one the listener waits for
+PRIORITY_FOLLOWING = 1  # later segments rendered ahead of playback
+
+
+# Lines of worker stderr kept for error reports
+STDERR_TAIL_LINES = 200
+
+
+class PiperWorkerError(RuntimeError):
+    """
+    A Piper worker failed. `code` tells a failed request (`synthesis_failed`,
+    the process is fine) from a lost or misbehaving process.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        code: str = "worker_failed",
+        pid: Optional[int] = None,
+        returncode: Optional[int] = None,
+    ):
+        super().__init__(message)
+        self.code = code
+        self.pid = pid
+        self.returncode = returncode
+
+    def as_dict(self) -> dict:
+        return {"error": str(self), "code": self.code}
+
+
+class PiperProcess:
+    """
+    One warm Piper process speaking the frame protocol from `app.piper_worker`.
+
+    Not thread-safe: a process is used by a single request at a time, which the
+    pool guarantees by leasing it out exclusively. The one exception is
+    `cancel()`, which may be called from any thread.
+    """
+
+    def __init__(self, model_path: Path, start_timeout: float = 60.0):
+        self.model_path = Path(model_path)
+        self.start_timeout = float(start_timeout)
+        self.proc: Optional[subprocess.Popen] = None
+        self.sample_rate: Optional[int] = None
+        self.broken = False
+        # True while an utterance has frames left unread on stdout
+        self._pending = False
+        # Set by cancel(); the pool resets it when the worker is leased again
+        self.cancelled = False
+        # Serializes stdin writes between the leaseholder and cancel()
+        self._stdin_lock = threading.RLock()
+        self._stderr: deque = deque(maxlen=STDERR_TAIL_LINES)
+        self._stderr_thread: Optional[threading.Thread] = None
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.proc.pid if self.proc else None
+
+    def start(self) -> None:
+        cmd = [
+            sys.executable,
+            "-m",
+            "app.piper_worker",
+            "--model",
+            str(self.model_path),
+        ]
+        logger.debug("Starting Piper worker: %s", " ".join(cmd))
+
+        self.proc = subprocess.Popen(
+            cmd,
+            cwd=str(SERVICE_ROOT),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Drained all the time: a chatty worker must never block on a full pipe
+        self._stderr = deque(maxlen=STDERR_TAIL_LINES)
+        self._stderr_thread = threading.Thread(
+            target=self._drain_stderr,
+            args=(self.proc.stderr, self._stderr, self.proc.pid),
+            name=f"piper-stderr-{self.proc.pid}",
+            daemon=True,
+        )
+        self._stderr_thread.start()
+
+        # Loading the voice can hang (e.g. broken onnxruntime install); kill on timeout
+        watchdog = threading.Timer(self.start_timeout, self.proc.kill)
+        watchdog.start()
+        try:
+            kind, payload = read_frame(self.proc.stdout)
+        except EOFError:
+            raise self._failure("Piper worker exited during startup", "startup_failed")
+        finally:
+            watchdog.cancel()
+
+        # The READY header is the one place the stream is validated: after it,
+        # every frame is length-prefixed and nothing else can reach the pipe
+        try:
+            if kind != FRAME_READY:
+                raise ValueError(f"unexpected frame {kind}")
+            self.sample_rate = int(json.loads(payload)["sample_rate"])
+        except (ValueError, KeyError, TypeError) as e:
+            self.kill()
+            raise self._failure(f"Invalid Piper worker handshake: {e}", "protocol_error")
+
+        self.broken = False
+        self._pending = False
+        logger.info("Piper worker pid=%d ready (model=%s)", self.pid, self.model_path)
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None and not self.broken
+
+    def _send(self, request: dict) -> None:
+        try:
+            with self._stdin_lock:
+                self.proc.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+                self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            self.broken = True
+            raise self._failure(f"Piper worker is gone: {e}", "worker_died")
+
+    def _read(self):
+        try:
+            return read_frame(self.proc.stdout)
+        except EOFError:
+            self.broken = True
+            raise self._failure("Piper worker died mid-utterance", "worker_died")
+
+    def ping(self) -> bool:
+        """Round-trip a no-op request; False if the process does not answer."""
+        if not self.is_alive():
+            return False
+        try:
+            self._send({"op": "ping"})
+            kind, _ = self._read()
+        except PiperWorkerError:
+            return False
+        return kind == FRAME_END
+
+    def synthesize(self, text: str) -> Iterator[bytes]:
+        """
+        Yield raw PCM frames for `text` until the worker reports end of utterance.
+        """
+        with self._stdin_lock:
+            if self.cancelled:
+                return
+            self._send({"text": text})
+            self._pending = True
+        while True:
+            kind, payload = self._read()
+            if kind == FRAME_AUDIO:
+                yield payload
+            elif kind == FRAME_END:
+                self._pending = False
+                return
+            elif kind == FRAME_ERROR:
+                self._pending = False
+                raise PiperWorkerError(
+                    payload.decode("utf-8", errors="ignore"),
+                    code="synthesis_failed",
+                    pid=self.pid,
+                )
+            else:
+                self.broken = True
+                raise self._failure(
+                    f"Unexpected frame {kind} from Piper worker", "protocol_error"
+                )
+
+    def cancel(self) -> None:
+        """
+        Ask the worker to stop the current utterance at the next sentence
+        boundary. It still ends with FRAME_END, so `drain()` stays short.
+        """
+        with self._stdin_lock:
+            self.cancelled = True
+            if not self._pending or not self.is_alive():
+                return
+            try:
+                self._send({"op": "cancel"})
+            except PiperWorkerError:
+                pass  # already marked broken, the pool restarts it
+
+    def drain(self) -> None:
+        """
+        Discard what is left of an utterance the caller stopped reading early,
+        so the next request starts on a frame boundary.
+        """
+        while self._pending:
+            kind, _ = self._read()
+            if kind in (FRAME_END, FRAME_ERROR):
+                self._pending = False
+
+    @staticmethod
+    def _drain_stderr(stream, tail: deque, pid: int) -> None:
+        try:
+            for line in iter(stream.readline, b""):
+                text = line.decode("utf-8", errors="replace").rstrip()
+                tail.append(text)
+                logger.debug("piper[%d]: %s", pid, text)
+        except (OSError, ValueError):
+            pass  # pipe closed under us on shutdown
+
+    def stderr_tail(self, lines: int = 20) -> str:
+        return "\n".join(list(self._stderr)[-lines:])
+
+    def _failure(self, message: str, code: str) -> PiperWorkerError:
+        """Build an error for a process-level failure and log what the worker said."""
+        returncode = None
+        if self.proc is not None:
+            try:
+                # EOF usually means the process is exiting; get its status
+                returncode = self.proc.wait(timeout=0.5)
+            except subprocess.TimeoutExpired:
+                pass
+        if returncode is not None and self._stderr_thread is not None:
+            # Let the reader catch up with the worker's last words
+            self._stderr_thread.join(timeout=0.5)
+        logger.error(
+            "%s (pid=%s, returncode=%s, code=%s)\n%s",
+            message,
+            self.pid,
+            returncode,
+            code,
+            self.stderr_tail(),
+        )
+        return PiperWorkerError(message, code=code, pid=self.pid, returncode=returncode)
+
+    def kill(self) -> None:
+        if self.proc is None:
+            return
+        try:
+            self.proc.kill()
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except Exception:
+            pass
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            self.proc.wait()
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class LeasePool:
+    """
+    Exclusive leasing of interchangeable resources (worker processes,
+    inference sessions...).
+
+    When everything is leased, waiters are served by priority and then in
+    arrival order. Subclasses hook into `_prepare` (before a lease) and
+    `_recycle` (after it) to repair or reset a resource.
+    """
+
+    resource_name = "worker"
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle: deque = deque()
+        self._waiters: list = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._closed = threading.Event()
+
+    def _put(self, item) -> None:
+        with self._cond:
+            self._idle.append(item)
+            self._cond.notify_all()
+
+    def _take(self, priority: int, timeout: Optional[float]):
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            try:
+                ready = self._cond.wait_for(
+                    lambda: self._idle and self._waiters[0] == entry, timeout
+                )
+                if not ready:
+                    raise PoolTimeout(f"No {self.resource_name} available")
+                heapq.heappop(self._waiters)
+                # LIFO: the most recently used resource has the warmest caches
+                return self._idle.pop()
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                self._cond.notify_all()
+
+    def _prepare(self, item) -> None:
+        pass
+
+    def _recycle(self, item) -> None:
+        pass
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None, priority: int = PRIORITY_FIRST):
+        if self._closed.is_set():
+            raise PoolTimeout(f"{self.resource_name} pool is closed")
+        item = self._take(priority, timeout)
+
+        try:
+            self._prepare(item)
+        except Exception:
+            self._put(item)
+            raise
+
+        try:
+            yield item
+        finally:
+            try:
+                self._recycle(item)
+            finally:
+                self._put(item)
+
+    def lease_stats(self) -> dict:
+        with self._cond:
+            return {"idle": len(self._idle), "waiting": len(self._waiters)}
+
+    def close(self) -> None:
+        self._closed.set()
+
+
+class PiperWorkerPool(LeasePool):
+    """
+    Fixed-size pool of warm Piper processes for one voice.
+
+    Workers are leased exclusively via `lease()`. A worker that crashed or
+    was left mid-utterance is drained or restarted before it goes back to the
+    pool, and a background thread pings idle workers to catch silent deaths.
+    """
+
+    resource_name = "Piper worker"
+
+    def __init__(
+        self,
+        model_path: Path,
+        size: int = 1,
+        start_timeout: float = 60.0,
+        healthcheck_interval: float = 15.0,
+    ):
+        super().__init__()
+        self.model_path = Path(model_path)
+        self.size = max(1, int(size))
+        self.start_timeout = float(start_timeout)
+        self.healthcheck_interval = float(healthcheck_interval)
+
+        self._workers: List[PiperProcess] = []
+        self.restarts = 0
+
+        self._start_all()
+
+        self._health_thread = threading.Thread(
+            target=self._health_loop, name="piper-healthcheck", daemon=True
+        )
+        self._health_thread.start()
+
+    def _start_all(self) -> None:
+        workers = [
+            PiperProcess(self.model_path, self.start_timeout) for _ in range(self.size)
+        ]
+        errors: List[Exception] = []
+
+        def start(w: PiperProcess):
+            try:
+                w.start()
+            except Exception as e:
+                errors.append(e)
+
+        # Voices load in parallel, so pool startup costs one model load, not N
+        threads = [threading.Thread(target=start, args=(w,)) for w in workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            for w in workers:
+                w.close()
+            raise errors[0]
+
+        self._workers = workers
+        for w in workers:
+            self._put(w)
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        return self._workers[0].sample_rate if self._workers else None
+
+    def _restart(self, worker: PiperProcess) -> None:
+        logger.warning("Restarting Piper worker pid=%s", worker.pid)
+        worker.kill()
+        worker.close()
+        worker.start()
+        self.restarts += 1
+
+    def _prepare(self, w: PiperProcess) -> None:
+        w.cancelled = False
+        if not w.is_alive():
+            self._restart(w)
+
+    def _recycle(self, w: PiperProcess) -> None:
+        try:
+            if w.is_alive():
+                # If abandoned mid-utterance, no point synthesizing the rest
+                w.cancel()
+                w.drain()
+            if not w.is_alive():
+                self._restart(w)
+        except Exception:
+            # Dead workers go back too; they are restarted on next lease or health check
+            logger.exception("Failed to recycle Piper worker pid=%s", w.pid)
+            w.broken = True
+
+    def _health_loop(self) -> None:
+        while not self._closed.wait(self.healthcheck_interval):
+            for w in self._workers:
+                # One worker at a time and only while nobody waits for a lease,
+                # so a sweep never holds back requests
+                with self._cond:
+                    if self._waiters or w not in self._idle:
+                        continue
+                    self._idle.remove(w)
+                try:
+                    if not w.ping():
+                        self._restart(w)
+                except Exception:
+                    logger.exception("Piper worker health check failed")
+                finally:
+                    self._put(w)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            **self.lease_stats(),
+            "alive": sum(1 for w in self._workers if w.is_alive()),
+            "restarts": self.restarts,
+        }
+
+    def close(self) -> None:
+        super().close()
+        for w in self._workers:
+            w.close()
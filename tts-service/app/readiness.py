@@ -0,0 +1,63 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """
+    Startup state of a model service, for `/readyz`.
+
+    The port opens before the model is loaded; loading runs in the background
+    and records how long each phase took. The service is ready only once
+    `mark_ready()` is called, i.e. after a warmup inference, so the first real
+    request does not pay for lazy initialization.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._phases: Dict[str, float] = {}
+        self._ready_s: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready_s is not None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time one startup phase; safe to use from several threads."""
+        started = time.monotonic()
+        yield
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._phases[name] = round(elapsed, 3)
+        logger.info("Startup phase %s took %.2fs", name, elapsed)
+
+    def mark_ready(self) -> None:
+        self._ready_s = round(time.monotonic() - self._started, 3)
+        logger.info("Service ready after %.2fs", self._ready_s)
+
+    def fail(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def status(self) -> dict:
+        if self.ready:
+            state = "ready"
+        elif self.error is not None:
+            state = "failed"
+        else:
+            state = "loading"
+        with self._lock:
+            phases = dict(self._phases)
+        return {
+            "status": state,
+            "error": self.error,
+            "phases_s": phases,
+            "ready_after_s": self._ready_s,
+            "uptime_s": round(time.monotonic() - self._started, 3),
+        }
@@ -0,0 +1,88 @@
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+
+
+@lru_cache(maxsize=32)
+def _polyphase_filter(up: int, down: int, taps: int) -> np.ndarray:
+    """
+    Банк полифазных фильтров (up, taps) для ресемплинга в up/down раз:
+    windowed-sinc ФНЧ с частотой среза ниже обеих частот Найквиста.
+    Считается один раз на пару частот.
+    """
+    length = taps * up
+    center = (length - 1) // 2
+    cutoff = 0.5 / max(up, down) * 0.95  # в циклах на отсчёт повышенной частоты
+    n = np.arange(length) - center
+    # Окно симметрично относительно целого центра (при чётной длине последний отсчёт 0)
+    window = np.zeros(length)
+    window[: 2 * center + 1] = np.kaiser(2 * center + 1, 8.0)
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * window * up
+    # h[p + k*up] -> bank[p, k]
+    return np.ascontiguousarray(h.reshape(taps, up).T, dtype=np.float32)
+
+
+class StreamResampler:
+    """
+    Потоковый полифазный ресемплер float32-сигнала.
+
+    Каждый выходной отсчёт — скалярное произведение одной фазы фильтра на окно
+    входа; все отсчёты блока считаются одним векторизованным einsum. Между
+    вызовами `process` хранится только хвост входа длиной в фильтр, так что
+    результат не зависит от того, как вход нарезан на куски.
+
+    `taps` — длина фильтра на фазу: больше — круче срез, но больше задержка
+    и вычислений; каждый сервис выбирает своё значение.
+    """
+
+    def __init__(self, src_rate: int, dst_rate: int, taps: int):
+        g = gcd(int(src_rate), int(dst_rate))
+        self.up = int(dst_rate) // g
+        self.down = int(src_rate) // g
+        self.taps = taps
+        self._bank = _polyphase_filter(self.up, self.down, taps)
+        self._center = (taps * self.up - 1) // 2
+        # Индекс входа, соответствующий _buf[0]; слева — нулевая история
+        self._buf = np.zeros(taps - 1, dtype=np.float32)
+        self._base = -(taps - 1)
+        self._consumed = 0
+        self._produced = 0
+
+    def _emit(self, n_end: int) -> np.ndarray:
+        if n_end <= self._produced:
+            return np.zeros(0, dtype=np.float32)
+        n = np.arange(self._produced, n_end, dtype=np.int64)
+        t = n * self.down + self._center
+        m0 = t // self.up
+        phase = t - m0 * self.up
+        idx = (m0 - self._base)[:, None] - np.arange(self.taps)[None, :]
+        out = np.einsum("nk,nk->n", self._bank[phase], self._buf[idx])
+        self._produced = n_end
+
+        # Оставить только то, что понадобится следующим отсчётам
+        next_m0 = (n_end * self.down + self._center) // self.up
+        drop = next_m0 - self.taps + 1 - self._base
+        if drop > 0:
+            self._buf = self._buf[drop:]
+            self._base += drop
+        return out.astype(np.float32, copy=False)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        self._buf = np.concatenate([self._buf, x.astype(np.float32, copy=False)])
+        self._consumed += len(x)
+        # Отсчёт n готов, когда его последний входной отсчёт уже пришёл
+        limit = self._consumed * self.up - 1 - self._center
+        n_end = limit // self.down + 1 if limit >= 0 else 0
+        return self._emit(n_end)
+
+    def flush(self) -> np.ndarray:
+        """Досчитать хвост: вход дополняется нулями до полной длины выхода."""
+        total = -(-self._consumed * self.up // self.down)
+        if total <= self._produced:
+            return np.zeros(0, dtype=np.float32)
+        last_m0 = ((total - 1) * self.down + self._center) // self.up
+        pad = last_m0 - (self._base + len(self._buf) - 1)
+        if pad > 0:
+            self._buf = np.concatenate([self._buf, np.zeros(pad, dtype=np.float32)])
+        return self._emit(total)
@@ -13,5 +13,38 @@ class Settings(BaseSettings):
     TTS_CHUNK_MS: int
     TTS_MODELS_DIR: str
 
+    # subprocess | onnx | fake (synthetic tones, no model needed; for load tests)
+    TTS_ENGINE: str = "subprocess"
+    # Warm Piper processes (or in-process sessions) per loaded voice
+    TTS_WORKERS: int = 2
+    # Idle voices are unloaded once loaded voices use more than this (0 = no limit)
+    TTS_VOICE_MEMORY_MB: int = 0
+    TTS_WORKER_START_TIMEOUT: float = 60.0
+    TTS_HEALTHCHECK_INTERVAL: float = 15.0
+    TTS_ONNX_THREADS: int = 0  # onnxruntime intra-op threads, 0 = its default
+    TTS_FAKE_SPEED: float = 0.0  # fake engine: x real time, 0 = instant
+    # Sentences of one request rendered concurrently (1 = whole text on one worker)
+    TTS_PARALLEL_SEGMENTS: int = 4
+
+    TTS_STREAM_THREADS: int = 32
+    TTS_STREAM_QUEUE_CHUNKS: int = 16
+    # Concurrent requests (with an "id") per websocket connection
+    TTS_MAX_REQUESTS_PER_CONNECTION: int = 8
+
+    # Syntheses running at once across all connections; others wait in a
+    # priority queue (interactive before batch) for up to TTS_QUEUE_TIMEOUT s
+    TTS_MAX_CONCURRENT: int = 8
+    TTS_MAX_QUEUE: int = 64
+    TTS_QUEUE_TIMEOUT: float = 5.0
+
+    TTS_CACHE_MEMORY_MB: int = 64
+    TTS_CACHE_DIR: str = ""  # empty disables the on-disk tier
+    TTS_CACHE_DISK_MB: int = 1024
+    TTS_CACHE_PREWARM_FILE: str = ""
+
+    # burst | realtime | lead, overridable per request with "pacing"
+    TTS_DEFAULT_PACING: str = "realtime"
+    TTS_LEAD_MS: int = 0
+
 
 settings = Settings()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Executor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Iterator, List, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class CancelScope:
+    """
+    Cancellation of one request, shared between the event loop and the
+    threads synthesizing for it.
+
+    Whatever is working for the request (e.g. a leased Piper worker) registers
+    a callback with `on_cancel`, so `cancel()` stops it right away instead of
+    waiting for it to notice.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cancel callback failed")
+
+    @contextmanager
+    def on_cancel(self, callback: Callable[[], None]) -> Iterator[None]:
+        """Call `callback` on cancel while the block runs (at once if already cancelled)."""
+        with self._lock:
+            self._callbacks.append(callback)
+            cancelled = self._cancelled
+        if cancelled:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._callbacks.remove(callback)
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+async def iterate_in_thread(
+    factory: Callable[[], Iterator[T]],
+    executor: Executor | None = None,
+    maxsize: int = 16,
+) -> AsyncIterator[T]:
+    """
+    Run a blocking iterator in `executor` and hand its items to the event loop
+    through a bounded asyncio.Queue.
+
+    When the consumer falls behind, the queue fills up and the producer thread
+    blocks, so a slow client throttles synthesis instead of growing memory.
+    Closing the async iterator stops the producer and closes the underlying
+    iterator in its own thread (which returns the Piper worker to the pool).
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        fut = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                fut.result(timeout=0.5)
+                return True
+            except FuturesTimeout:
+                if stop.is_set():
+                    fut.cancel()
+                    return False
+
+    def produce() -> None:
+        try:
+            it = factory()
+        except BaseException as e:
+            put(_Failure(e))
+            return
+        try:
+            for item in it:
+                if stop.is_set() or not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            if not stop.is_set():
+                put(_Failure(e))
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    logger.exception("Failed to close producer iterator")
+
+    loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,45 @@
+import re
+from typing import List
+
+# Sentence end: terminal punctuation (optionally closed by a quote/bracket) followed by whitespace
+_SENTENCE_END = re.compile(r"(?:(?<=[.!?…])|(?<=[.!?…][\"'”»)\]]))\s+")
+# Clause boundary inside a long sentence
+_CLAUSE_END = re.compile(r"(?<=[,;:—–])\s+")
+
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    """Split an over-long sentence at clause boundaries, packing clauses up to `max_chars`."""
+    if len(sentence) <= max_chars:
+        return [sentence]
+
+    parts: List[str] = []
+    current = ""
+    for clause in _CLAUSE_END.split(sentence):
+        if current and len(current) + 1 + len(clause) > max_chars:
+            parts.append(current)
+            current = clause
+        else:
+            current = f"{current} {clause}" if current else clause
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_sentences(
+    text: str, max_chars: int = 200, first_max_chars: int = 80
+) -> List[str]:
+    """
+    Split text into sentence-sized segments for independent synthesis.
+
+    Sentences longer than `max_chars` are broken at clause punctuation. The
+    first segment uses the tighter `first_max_chars` limit so the audio the
+    listener hears first is ready as early as possible.
+    """
+    segments: List[str] = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        limit = first_max_chars if not segments else max_chars
+        segments.extend(_split_long(sentence, limit))
+    return segments
@@ -1,31 +1,41 @@
+import importlib.util
 import logging
-import subprocess
+import queue
 import threading
-import time
-from pathlib import Path
-from shutil import which
-from typing import Iterator
+from collections import deque
+from concurrent.futures import Future
+from contextlib import ExitStack
+from functools import partial
+from typing import Deque, Iterable, Iterator, Optional
 
-logger = logging.getLogger(__name__)
+from app.audio import AudioEncoder, AudioFormat
+from app.cache import AudioBuffer, AudioCache
+from app.engines import ENGINES, PCMBuffer, SynthesisEngine, create_engine
+from app.pacing import Pacer
+from app.pool import PRIORITY_FIRST, PRIORITY_FOLLOWING
+from app.streaming import CancelScope
+from app.text import split_sentences
+from app.voices import Voice, VoiceRegistry
 
+logger = logging.getLogger(__name__)
 
-def looks_like_text(b: bytes, threshold: float = 0.6) -> bool:
-    """
-    Return True if `b` contains a high fraction of printable ASCII characters.
-    Helps detect when stdout contains text logs instead of raw PCM.
-    """
-    if not b:
-        return False
-    s = b[:200]
-    printable = sum(1 for ch in s if 32 <= ch <= 126)
-    ratio = printable / len(s)
-    return ratio >= threshold
+_DONE = object()
 
 
 class TTSModel:
     """
     Piper streaming wrapper.
 
+    Synthesis runs on a pluggable engine (see `app.engines`): by default a pool
+    of warm Piper worker processes, so a request only pays for inference, not
+    for process spawn and model load.
+    Any voice in `models_dir` can be requested; voices other than the default
+    are loaded on first use and unloaded when idle and over the memory budget
+    (see `app.voices`). Long texts are split into sentences that render in
+    parallel on several sessions and are streamed back in order. With an
+    `AudioCache`, repeated texts are served from the cache without touching
+    Piper at all. Output rate, encoding and chunk size can be negotiated per
+    request (see `app.audio.AudioFormat`).
     """
 
     def __init__(
@@ -34,111 +44,349 @@ class TTSModel:
         voice: str = "en-us-lessac-medium.onnx",
         sample_rate: int = 22050,
         chunk_ms: int = 80,
+        workers: int = 1,
+        worker_start_timeout: float = 60.0,
+        healthcheck_interval: float = 15.0,
+        acquire_timeout: Optional[float] = None,
+        parallel_segments: int = 1,
+        cache: Optional[AudioCache] = None,
+        voice_memory_budget_mb: int = 0,
+        engine: str = "subprocess",
+        onnx_threads: int = 0,
+        fake_speed: float = 0.0,
     ):
         self.models_dir = str(models_dir)
         self.voice = voice
         self.sample_rate = int(sample_rate)
         self.chunk_ms = int(chunk_ms)
         self.chunk_bytes = int(self.sample_rate * 2 * self.chunk_ms / 1000)  # 16-bit mono
+        # Output unless the request negotiates another one; voices whose native
+        # rate differs from `sample_rate` are resampled to it
+        self.default_format = AudioFormat(self.sample_rate, "pcm16", self.chunk_ms)
+
+        self.acquire_timeout = acquire_timeout
+        self.parallel_segments = max(1, int(parallel_segments))
+        self.cache = cache
+
+        if engine not in ENGINES:
+            raise ValueError(f"unknown TTS engine {engine!r}")
+        requires_model = ENGINES[engine].requires_model
 
         # Check for piper presence — raise clear error if missing
-        if not which("piper"):
+        if requires_model and importlib.util.find_spec("piper") is None:
             raise RuntimeError(
-                "Piper binary not found in PATH. Install Piper or add it to PATH before using TTSModel."
+                "Piper (piper-tts) is not installed. Install it before using TTSModel."
             )
 
-        self.model_path = Path(self.models_dir) / self.voice
-        if not self.model_path.exists():
+        self.voices = VoiceRegistry(
+            self.models_dir,
+            default_voice=self.voice,
+            engine_factory=partial(
+                create_engine,
+                engine,
+                size=workers,
+                start_timeout=worker_start_timeout,
+                healthcheck_interval=healthcheck_interval,
+                onnx_threads=onnx_threads,
+                fake_sample_rate=self.sample_rate,
+                fake_speed=fake_speed,
+            ),
+            memory_budget_bytes=voice_memory_budget_mb * 1024 * 1024,
+            require_model_files=requires_model,
+        )
+        self.voice = self.voices.default_voice
+
+        self.model_path = self.voices.model_path(self.voice)
+        if requires_model and not self.model_path.exists():
             raise FileNotFoundError(f"Piper model not found at {self.model_path}")
 
+        # The default voice is loaded eagerly so the first request finds it warm
+        self.voices.get(self.voice)
+
         logger.info(
-            "Initialized Piper TTSModel: model=%s sample_rate=%d chunk_ms=%d",
+            "Initialized Piper TTSModel: model=%s engine=%s sample_rate=%d "
+            "chunk_ms=%d workers=%d",
             self.model_path,
+            engine,
             self.sample_rate,
             self.chunk_ms,
+            self.engine.size,
         )
 
-    def stream_text(self, text: str) -> Iterator[bytes]:
+    @property
+    def engine(self) -> SynthesisEngine:
+        """Synthesis engine of the default voice."""
+        return self.voices.get(self.voice).engine
+
+    def _encoder(self, voice: Voice, fmt: AudioFormat) -> AudioEncoder:
+        return AudioEncoder(
+            src_rate=voice.engine.sample_rate or self.sample_rate,
+            dst_rate=self.output_rate(fmt),
+            encoding=fmt.encoding,
+        )
+
+    def output_rate(self, fmt: Optional[AudioFormat] = None) -> int:
+        """Sample rate actually sent for `fmt`."""
+        fmt = fmt or self.default_format
+        return fmt.sample_rate or self.sample_rate
+
+    def _render_segment(
+        self, voice: Voice, text: str, scope: CancelScope, stop: CancelScope
+    ) -> bytes:
+        if scope.cancelled or stop.cancelled:
+            return b""
+        with voice.engine.lease(
+            timeout=self.acquire_timeout, priority=PRIORITY_FOLLOWING
+        ) as session, scope.on_cancel(session.cancel), stop.on_cancel(session.cancel):
+            return b"".join(session.synthesize(text))
+
+    def _pump_first(
+        self,
+        voice: Voice,
+        text: str,
+        scope: CancelScope,
+        stop: CancelScope,
+        out: "queue.Queue",
+        leased: threading.Event,
+    ) -> None:
+        """
+        Render the first sentence into `out` piece by piece as the session
+        produces it. The consumer may be paced to real time; the session is
+        released as soon as synthesis ends, not when playback does.
         """
-        Stream raw PCM from Piper stdout while Piper synthesizes.
+        try:
+            with voice.engine.lease(
+                timeout=self.acquire_timeout, priority=PRIORITY_FIRST
+            ) as session, scope.on_cancel(session.cancel), stop.on_cancel(session.cancel):
+                leased.set()
+                for piece in session.synthesize(text):
+                    out.put(piece)
+        except BaseException as e:
+            out.put(e)
+        finally:
+            leased.set()
+            out.put(_DONE)
 
+    def _segment_audio(
+        self, voice: Voice, text: str, scope: Optional[CancelScope] = None
+    ) -> Iterator[PCMBuffer]:
         """
-        cmd = [
-            "piper",
-            "--model",
-            str(self.model_path),
-            "--output_raw",
-        ]
-
-        logger.debug("Starting Piper process: %s", " ".join(cmd))
-
-        proc = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=0,
-        )
+        Yield PCM for `text` in order, rendering up to `parallel_segments`
+        sentences at once.
+
+        The first sentence streams from its session through a buffer and is
+        leased with the highest priority; the following ones are rendered on
+        other sessions meanwhile and are usually complete by the time playback
+        reaches them. No session waits for the consumer, so paced playback
+        does not hold Piper workers. Cancelling `scope`, or closing the
+        generator early, stops every session working on `text`.
+        """
+        scope = scope or CancelScope()
+        segments = split_sentences(text) if self.parallel_segments > 1 else [text]
+        if not segments:
+            return
 
-        # feed text (with newline) in background thread
-        def feed():
-            try:
-                inp = (text + "\n").encode("utf-8")
-                proc.stdin.write(inp)
-                proc.stdin.flush()
-                proc.stdin.close()
-            except Exception:
-                logger.exception("Failed to feed text to Piper stdin")
+        # Stops every session of this call if the consumer goes away early
+        stop = CancelScope()
+        pending: Deque[Future] = deque()
+        rest = iter(segments[1:])
 
-        threading.Thread(target=feed, daemon=True).start()
+        def refill():
+            while len(pending) < self.parallel_segments - 1:
+                segment = next(rest, None)
+                if segment is None:
+                    return
+                pending.append(
+                    voice.executor.submit(self._render_segment, voice, segment, scope, stop)
+                )
 
+        first: queue.Queue = queue.Queue()
+        leased = threading.Event()
+        threading.Thread(
+            target=self._pump_first,
+            args=(voice, segments[0], scope, stop, first, leased),
+            name="tts-first-segment",
+            daemon=True,
+        ).start()
         try:
+            # The first sentence gets its session before the others compete for one
+            leased.wait()
+            refill()
             while True:
-                chunk = proc.stdout.read(self.chunk_bytes)
-                if not chunk:
+                item = first.get()
+                if item is _DONE:
                     break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
 
-                if looks_like_text(chunk):
-                    stderr = b""
-                    try:
-                        stderr = proc.stderr.read() or b""
-                    except Exception:
-                        pass
-                    logger.error(
-                        "Detected non-audio data in Piper stdout. stderr: %s",
-                        stderr.decode("utf-8", errors="ignore"),
-                    )
-                    try:
-                        proc.kill()
-                    except Exception:
-                        pass
-                    raise RuntimeError("Piper stdout contained text instead of PCM.")
+            while pending and not scope.cancelled:
+                audio = pending.popleft().result()
+                refill()
+                yield audio
+        finally:
+            stop.cancel()
+            for future in pending:
+                future.cancel()
+
+    def _cache_key(self, voice: Voice, text: str) -> str:
+        fmt = f"{voice.engine.name}/pcm16/{voice.engine.sample_rate}"
+        return AudioCache.make_key(voice.name, text, fmt)
+
+    @staticmethod
+    def _encoded(
+        encoder: AudioEncoder, audio: Iterable[PCMBuffer]
+    ) -> Iterator[PCMBuffer]:
+        if encoder.passthrough:
+            yield from audio
+            return
+        for piece in audio:
+            out = encoder.encode(piece)
+            if out:
+                yield out
+        tail = encoder.flush()
+        if tail:
+            yield tail
 
+    @staticmethod
+    def _chunk(
+        audio: Iterable[PCMBuffer],
+        chunk_bytes: int,
+        bytes_per_second: int,
+        pacer: Optional[Pacer],
+    ) -> Iterator[bytes]:
+        buf = bytearray()
+        for piece in audio:
+            buf += memoryview(piece)
+            while len(buf) >= chunk_bytes:
+                chunk = bytes(buf[:chunk_bytes])
+                del buf[:chunk_bytes]
+                if pacer is not None:
+                    pacer.wait(len(chunk) / bytes_per_second)
                 yield chunk
-                time.sleep(self.chunk_ms / 1000.0)
-        finally:
-            # cleanup
-            try:
-                proc.stdin.close()
-            except Exception:
-                pass
-            try:
-                proc.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                try:
-                    proc.kill()
-                except Exception:
+
+        if buf:
+            if pacer is not None:
+                pacer.wait(len(buf) / bytes_per_second)
+            yield bytes(buf)
+
+    @staticmethod
+    def _slice(
+        audio: AudioBuffer,
+        chunk_bytes: int,
+        bytes_per_second: int,
+        pacer: Optional[Pacer],
+    ) -> Iterator[AudioBuffer]:
+        # Slices of a memoryview share the cached buffer: no copies on a hit
+        view = memoryview(audio)
+        for i in range(0, len(view), chunk_bytes):
+            chunk = view[i : i + chunk_bytes]
+            if pacer is not None:
+                pacer.wait(len(chunk) / bytes_per_second)
+            yield chunk
+
+    @staticmethod
+    def _tee(audio: Iterable[PCMBuffer], collected: bytearray) -> Iterator[PCMBuffer]:
+        for piece in audio:
+            collected += memoryview(piece)
+            yield piece
+
+    def stream_text(
+        self,
+        text: str,
+        pacer: Optional[Pacer] = None,
+        voice: Optional[str] = None,
+        fmt: Optional[AudioFormat] = None,
+        scope: Optional[CancelScope] = None,
+    ) -> Iterator[AudioBuffer]:
+        """
+        Stream audio from the voice's engine while it synthesizes.
+
+        `voice` is a model file name from `models_dir` (default voice if None).
+        `fmt` selects output rate, encoding and chunk size (`default_format` if
+        None). Output is unthrottled unless a `pacer` is given. Cancelling
+        `scope` (from any thread) frees the engine sessions at once.
+        """
+        fmt = fmt or self.default_format
+        scope = scope or CancelScope()
+        with self.voices.use(voice) as loaded:
+            encoder = self._encoder(loaded, fmt)
+            chunk_bytes = fmt.chunk_bytes(encoder.dst_rate)
+            bytes_per_second = encoder.dst_rate * fmt.bytes_per_sample
+
+            # The cache holds native PCM, so one entry serves every output format
+            key = None
+            if self.cache is not None and text.strip():
+                key = self._cache_key(loaded, text)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    if not encoder.passthrough:
+                        cached = encoder.encode(cached) + encoder.flush()
+                    yield from self._slice(cached, chunk_bytes, bytes_per_second, pacer)
+                    return
+
+            audio = self._segment_audio(loaded, text, scope)
+            collected = bytearray()
+            if key is not None:
+                audio = self._tee(audio, collected)
+            yield from self._chunk(
+                self._encoded(encoder, audio), chunk_bytes, bytes_per_second, pacer
+            )
+            # Only reached when the whole utterance was synthesized and consumed
+            if key is not None and not scope.cancelled:
+                self.cache.put(key, collected)
+
+    def warmup(self, text: str = "Warmup.") -> int:
+        """
+        Synthesize `text` once on every session of the default voice, bypassing
+        the cache, so no request pays for lazy initialization. Returns the
+        number of sessions warmed.
+        """
+        engine = self.engine
+        with ExitStack() as stack:
+            # Hold all leases at once so every session gets its own run
+            sessions = [
+                stack.enter_context(engine.lease(timeout=self.acquire_timeout))
+                for _ in range(engine.size)
+            ]
+            for session in sessions:
+                for _ in session.synthesize(text):
                     pass
+        return len(sessions)
 
-    def synthesize_stream(self, text: str) -> Iterator[bytes]:
-        return self.stream_text(text)
+    def prewarm(self, phrases: Iterable[str], voice: Optional[str] = None) -> int:
+        """Synthesize `phrases` that are not cached yet; returns how many were added."""
+        if self.cache is None:
+            return 0
+        added = 0
+        with self.voices.use(voice) as loaded:
+            for phrase in phrases:
+                key = self._cache_key(loaded, phrase)
+                if not self.cache.contains(key):
+                    self.cache.put(key, b"".join(self._segment_audio(loaded, phrase)))
+                    added += 1
+        return added
 
-    def synthesize(self, text: str) -> bytes:
+    def synthesize_stream(
+        self,
+        text: str,
+        pacer: Optional[Pacer] = None,
+        voice: Optional[str] = None,
+        fmt: Optional[AudioFormat] = None,
+    ) -> Iterator[AudioBuffer]:
+        return self.stream_text(text, pacer=pacer, voice=voice, fmt=fmt)
+
+    def synthesize(
+        self, text: str, voice: Optional[str] = None, fmt: Optional[AudioFormat] = None
+    ) -> bytes:
         """
         Collect all PCM chunks for given text and return single bytes object.
 
         """
         collected = bytearray()
-        for chunk in self.stream_text(text):
+        for chunk in self.stream_text(text, voice=voice, fmt=fmt):
             collected.extend(chunk)
         return bytes(collected)
+
+    def close(self) -> None:
+        self.voices.close()
@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from app.engines import SynthesisEngine
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownVoiceError(ValueError):
+    pass
+
+
+class Voice:
+    """A loaded voice: its synthesis engine plus bookkeeping for eviction."""
+
+    def __init__(self, name: str, engine: SynthesisEngine):
+        self.name = name
+        self.engine = engine
+        # Renders the segments after the first; one thread per session is enough
+        self.executor = ThreadPoolExecutor(
+            max_workers=engine.size, thread_name_prefix=f"tts-segment-{name}"
+        )
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def memory_bytes(self) -> int:
+        return self.engine.memory_bytes()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.engine.close()
+
+
+class VoiceRegistry:
+    """
+    Voices found in `models_dir`, loaded on first use.
+
+    Each loaded voice gets its own engine, built by `engine_factory` from the
+    model path (e.g. a pool of warm Piper processes, see `app.engines`). When
+    the loaded voices together exceed `memory_budget_bytes`, the least recently
+    used idle voices are unloaded; the default voice is never evicted.
+    """
+
+    def __init__(
+        self,
+        models_dir: str,
+        default_voice: str,
+        engine_factory: Callable[[Path], SynthesisEngine],
+        memory_budget_bytes: int = 0,
+        require_model_files: bool = True,
+    ):
+        self.models_dir = Path(models_dir)
+        self.engine_factory = engine_factory
+        self.memory_budget_bytes = int(memory_budget_bytes)
+        self.require_model_files = require_model_files
+        self.default_voice = self.resolve(default_voice, check=False)
+
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._voices: Dict[str, Voice] = {}
+        self.evictions = 0
+
+    def available(self) -> List[str]:
+        """Voices that have both an .onnx model and its .onnx.json config."""
+        return sorted(
+            p.name
+            for p in self.models_dir.glob("*.onnx")
+            if p.with_name(p.name + ".json").exists()
+        )
+
+    def resolve(self, voice: Optional[str], check: bool = True) -> str:
+        # Comes straight from request JSON, so it may be any type
+        if voice is not None and not isinstance(voice, str):
+            raise UnknownVoiceError(f"unknown voice {voice!r}")
+        if not voice:
+            return self.default_voice
+        name = voice if voice.endswith(".onnx") else f"{voice}.onnx"
+        # Only bare file names: a voice must never point outside models_dir
+        if Path(name).name != name:
+            raise UnknownVoiceError(f"unknown voice {voice!r}")
+        if check and self.require_model_files and not (self.models_dir / name).exists():
+            raise UnknownVoiceError(f"unknown voice {voice!r}")
+        return name
+
+    def model_path(self, voice: str) -> Path:
+        return self.models_dir / voice
+
+    def get(self, voice: Optional[str] = None) -> Voice:
+        """Return a loaded voice, loading it (and evicting others) if needed."""
+        name = self.resolve(voice)
+        with self._lock:
+            loaded = self._voices.get(name)
+            if loaded is not None:
+                loaded.last_used = time.monotonic()
+                return loaded
+            load_lock = self._loading.setdefault(name, threading.Lock())
+
+        # Per-voice lock: concurrent first requests for one voice load it once,
+        # while other voices keep being served
+        with load_lock:
+            with self._lock:
+                loaded = self._voices.get(name)
+            if loaded is not None:
+                return loaded
+
+            started = time.monotonic()
+            engine = self.engine_factory(self.model_path(name))
+            loaded = Voice(name, engine)
+            with self._lock:
+                self._voices[name] = loaded
+            logger.info(
+                "Loaded voice %s in %.2fs (%s engine, %d sessions)",
+                name,
+                time.monotonic() - started,
+                engine.name,
+                engine.size,
+            )
+
+        self._evict_over_budget(keep=name)
+        return loaded
+
+    @contextmanager
+    def use(self, voice: Optional[str] = None) -> Iterator[Voice]:
+        """Lease a voice for one request; a voice in use is never evicted."""
+        while True:
+            loaded = self.get(voice)
+            with self._lock:
+                # It may have been evicted between get() and here
+                if self._voices.get(loaded.name) is loaded:
+                    loaded.active += 1
+                    break
+        try:
+            yield loaded
+        finally:
+            with self._lock:
+                loaded.active -= 1
+                loaded.last_used = time.monotonic()
+
+    def _evict_over_budget(self, keep: str) -> None:
+        if self.memory_budget_bytes <= 0:
+            return
+
+        while True:
+            with self._lock:
+                voices = list(self._voices.values())
+            used = sum(v.memory_bytes() for v in voices)
+            if used <= self.memory_budget_bytes:
+                return
+
+            with self._lock:
+                candidates = [
+                    v
+                    for v in self._voices.values()
+                    if v.active == 0 and v.name not in (keep, self.default_voice)
+                ]
+                if not candidates:
+                    logger.warning(
+                        "Voice memory %d MB over budget %d MB, nothing idle to evict",
+                        used // 2**20,
+                        self.memory_budget_bytes // 2**20,
+                    )
+                    return
+                victim = min(candidates, key=lambda v: v.last_used)
+                del self._voices[victim.name]
+                self.evictions += 1
+
+            logger.info("Evicting idle voice %s to stay within memory budget", victim.name)
+            victim.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            voices = list(self._voices.values())
+            evictions = self.evictions
+        return {
+            "loaded": {
+                v.name: {
+                    "active": v.active,
+                    "memory_bytes": v.memory_bytes(),
+                    "engine": v.engine.stats(),
+                }
+                for v in voices
+            },
+            "evictions": evictions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            voices = list(self._voices.values())
+            self._voices.clear()
+        for v in voices:
+            v.close()
@@ -18,3 +18,546 @@ def test_tts_normal_text(tts_model):
     pcm = tts_model.synthesize("Hello world")
     assert isinstance(pcm, (bytes, bytearray))
     assert len(pcm) > 1000
+
+
+def test_tts_frame_roundtrip():
+    """Проверка: кадры воркера читаются обратно без потерь"""
+    import io
+
+    from app.piper_worker import FRAME_AUDIO, FRAME_END, read_frame, write_frame
+
+    stream = io.BytesIO()
+    write_frame(stream, FRAME_AUDIO, b"\x01\x02\x03\x04")
+    write_frame(stream, FRAME_END)
+    stream.seek(0)
+
+    assert read_frame(stream) == (FRAME_AUDIO, b"\x01\x02\x03\x04")
+    assert read_frame(stream) == (FRAME_END, b"")
+    with pytest.raises(EOFError):
+        read_frame(stream)
+
+
+def test_tts_pool_reuses_workers(tts_model):
+    """Проверка: повторные запросы обслуживаются теми же тёплыми процессами"""
+    pool = tts_model.engine.pool
+    pids = {w.pid for w in pool._workers}
+    for _ in range(3):
+        assert len(tts_model.synthesize("Hello again")) > 1000
+    assert {w.pid for w in pool._workers} == pids
+    assert pool.stats()["restarts"] == 0
+
+
+def test_tts_stream_does_not_block_event_loop():
+    """Проверка: синтез в потоке не блокирует event loop и ограничен очередью"""
+    import asyncio
+    import time
+
+    from app.streaming import iterate_in_thread
+
+    produced = []
+
+    def slow_chunks():
+        for i in range(20):
+            time.sleep(0.01)
+            produced.append(i)
+            yield bytes([i])
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        tick_task = asyncio.create_task(ticker())
+        received = []
+        async for chunk in iterate_in_thread(slow_chunks, maxsize=2):
+            received.append(chunk)
+            if len(received) == 1:
+                # медленный потребитель: производитель должен упереться в очередь
+                await asyncio.sleep(0.2)
+                assert len(produced) <= 4
+        tick_task.cancel()
+        return received, ticks
+
+    received, ticks = asyncio.run(run())
+    assert received == [bytes([i]) for i in range(20)]
+    assert ticks > 10
+
+
+def test_tts_pacer_modes():
+    """Проверка: режимы пейсинга считают задержки от аудио-часов без дрейфа"""
+    from app.pacing import Pacer
+
+    now = [0.0]
+    clock = lambda: now[0]  # noqa: E731
+
+    burst = Pacer(mode="burst", clock=clock)
+    assert [burst.delay(1.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+
+    realtime = Pacer(mode="realtime", speed=2.0, clock=clock)
+    assert realtime.delay(1.0) == 0.0
+    now[0] = 0.1  # отправка заняла время — оно не накапливается
+    assert realtime.delay(1.0) == pytest.approx(0.4)
+    assert realtime.delay(1.0) == pytest.approx(0.9)
+
+    now[0] = 0.0
+    lead = Pacer(mode="lead", lead_ms=1000, clock=clock)
+    assert [lead.delay(0.5) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert lead.delay(0.5) == pytest.approx(0.5)
+
+    with pytest.raises(ValueError):
+        Pacer(mode="warp")
+
+
+def test_tts_split_sentences():
+    """Проверка: текст режется на предложения, длинные — по границам клауз"""
+    from app.text import split_sentences
+
+    assert split_sentences("") == []
+    assert split_sentences("Hello world") == ["Hello world"]
+    assert split_sentences('Hi there! How are you? "Fine." Bye.') == [
+        "Hi there!",
+        "How are you?",
+        '"Fine."',
+        "Bye.",
+    ]
+
+    long_first = "One, " * 30 + "done. Short second."
+    segments = split_sentences(long_first, max_chars=200, first_max_chars=40)
+    assert all(len(s) <= 40 for s in segments[:-1])
+    assert segments[-1] == "Short second."
+    assert " ".join(segments) == long_first
+
+
+def test_tts_parallel_segments_keep_order(tts_model):
+    """Проверка: предложения, синтезированные параллельно, склеиваются по порядку"""
+    text = "First sentence. Second one is here. And the third."
+    parallel = tts_model.synthesize(text)
+    tts_model.parallel_segments, previous = 1, tts_model.parallel_segments
+    try:
+        sentences = ["First sentence.", "Second one is here.", "And the third."]
+        sequential = b"".join(tts_model.synthesize(s) for s in sentences)
+    finally:
+        tts_model.parallel_segments = previous
+    assert len(parallel) == pytest.approx(len(sequential), rel=0.05)
+
+
+def test_tts_audio_cache_tiers(tmp_path):
+    """Проверка: LRU в памяти вытесняет по бюджету, диск отдаёт записи через mmap"""
+    from app.cache import AudioCache
+
+    cache = AudioCache(memory_bytes=10, cache_dir=str(tmp_path), disk_bytes=1024)
+    k1 = AudioCache.make_key("voice.onnx", "Hello  world", "pcm16/16000")
+    k2 = AudioCache.make_key("voice.onnx", "Bye", "pcm16/16000")
+    assert k1 == AudioCache.make_key("voice.onnx", "Hello world", "pcm16/16000")
+    assert k1 != AudioCache.make_key("other.onnx", "Hello world", "pcm16/16000")
+
+    assert cache.get(k1) is None
+    cache.put(k1, b"\x01" * 6)
+    cache.put(k2, b"\x02" * 6)  # не помещается вместе с k1 — k1 вытесняется из памяти
+
+    assert cache.get(k2) == b"\x02" * 6
+    from_disk = cache.get(k1)
+    assert isinstance(from_disk, memoryview)
+    assert bytes(from_disk) == b"\x01" * 6
+
+    stats = cache.stats()
+    assert stats["hits_memory"] == 1
+    assert stats["hits_disk"] == 1
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+
+
+def test_tts_voice_registry_resolve(tmp_path):
+    """Проверка: голоса ищутся только в каталоге моделей и грузятся лениво"""
+    from app.voices import UnknownVoiceError, VoiceRegistry
+
+    for name in ("a.onnx", "a.onnx.json", "b.onnx"):
+        (tmp_path / name).write_bytes(b"")
+    registry = VoiceRegistry(
+        str(tmp_path), default_voice="a.onnx", engine_factory=lambda path: None
+    )
+
+    assert registry.available() == ["a.onnx"]  # у b нет конфига
+    assert registry.resolve(None) == "a.onnx"
+    assert registry.resolve("a") == "a.onnx"
+    assert registry.stats()["loaded"] == {}
+    with pytest.raises(UnknownVoiceError):
+        registry.resolve("missing")
+    with pytest.raises(UnknownVoiceError):
+        registry.resolve("../a.onnx")
+    for bad in (5, ["a"], {"name": "a"}):
+        with pytest.raises(UnknownVoiceError):
+            registry.resolve(bad)
+
+
+def test_tts_voice_registry_evicts_least_recently_used(tmp_path):
+    """Проверка: голос грузится лениво и один раз; сверх бюджета выгружается давний, но не основной"""
+    import threading
+    import time
+
+    from app.engines import FakeEngine
+    from app.voices import VoiceRegistry
+
+    loads, closed = [], []
+
+    class SizedEngine(FakeEngine):
+        def memory_bytes(self):
+            return 100
+
+        def close(self):
+            closed.append(self.voice)
+            super().close()
+
+    def factory(path):
+        loads.append(path.name)
+        # Медленная загрузка, чтобы одновременные запросы пересеклись
+        time.sleep(0.05)
+        engine = SizedEngine()
+        engine.voice = path.name
+        return engine
+
+    for name in ("a", "b", "c"):
+        (tmp_path / f"{name}.onnx").write_bytes(b"")
+    # Помещаются два голоса из трёх
+    registry = VoiceRegistry(
+        str(tmp_path), default_voice="a.onnx", engine_factory=factory, memory_budget_bytes=250
+    )
+    try:
+        assert loads == []  # ничего не грузится до первого запроса
+
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(registry.get("b"))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert loads == ["b.onnx"] and len({id(v) for v in got}) == 1
+
+        registry.get()
+        registry.get("b")  # теперь a — самый давний, но он основной
+        registry.get("c")
+        assert set(registry.stats()["loaded"]) == {"a.onnx", "c.onnx"}
+        assert closed == ["b.onnx"]
+
+        # Выгруженный голос при следующем обращении грузится заново, вытесняя c
+        with registry.use("b") as voice:
+            assert voice.name == "b.onnx"
+        assert loads == ["b.onnx", "a.onnx", "c.onnx", "b.onnx"]
+        assert set(registry.stats()["loaded"]) == {"a.onnx", "b.onnx"}
+        assert closed == ["b.onnx", "c.onnx"]
+        assert registry.stats()["evictions"] == 2
+    finally:
+        registry.close()
+
+
+def test_tts_fake_engine(tmp_path):
+    """Проверка: fake-движок работает без моделей, детерминирован и режет на чанки"""
+    model = TTSModel(
+        models_dir=str(tmp_path),
+        voice="fake.onnx",
+        sample_rate=16000,
+        chunk_ms=20,
+        workers=2,
+        parallel_segments=2,
+        engine="fake",
+    )
+    try:
+        text = "First sentence. Second one."
+        chunks = list(model.stream_text(text))
+        assert all(len(c) == model.chunk_bytes for c in chunks[:-1])
+        audio = b"".join(chunks)
+        assert audio == model.synthesize(text)
+        # 60 мс на символ, 16-bit mono
+        sentences = ["First sentence.", "Second one."]
+        assert len(audio) == sum(int(16000 * 0.06 * len(s)) * 2 for s in sentences)
+        assert model.voices.stats()["loaded"]["fake.onnx"]["engine"]["engine"] == "fake"
+
+        # Движок без lease()/sample_rate не создаётся
+        from app.engines import SynthesisEngine
+
+        class Incomplete(SynthesisEngine):
+            name = "incomplete"
+
+        with pytest.raises(TypeError):
+            Incomplete()
+    finally:
+        model.close()
+
+
+def test_tts_paced_streams_share_one_worker(tmp_path):
+    """Проверка: воркер освобождается по окончании синтеза, а не воспроизведения — два realtime-потока делят один"""
+    import threading
+    import time
+
+    from app.pacing import Pacer
+
+    model = TTSModel(
+        models_dir=str(tmp_path),
+        voice="fake.onnx",
+        sample_rate=16000,
+        chunk_ms=20,
+        workers=1,
+        parallel_segments=1,
+        acquire_timeout=0.3,
+        engine="fake",
+    )
+    try:
+        # 12 символов * 60 мс = 0.72 с аудио в реальном времени, синтез мгновенный
+        text = "Hello world."
+        results, errors = [], []
+
+        def play():
+            try:
+                results.append(b"".join(model.stream_text(text, pacer=Pacer("realtime"))))
+            except Exception as e:
+                errors.append(e)
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=play) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+
+        assert errors == []
+        assert results[0] == results[1] == model.synthesize(text)
+        # Воспроизведение шло параллельно, а не одно за другим (1.44 с)
+        assert 0.7 <= elapsed < 1.2
+        assert model.engine.stats()["idle"] == 1
+    finally:
+        model.close()
+
+
+def test_tts_early_close_stops_following_segments(tmp_path):
+    """Проверка: потребитель ушёл после первого чанка — сессии следующих предложений освобождаются сразу"""
+    import time
+
+    model = TTSModel(
+        models_dir=str(tmp_path),
+        voice="fake.onnx",
+        sample_rate=16000,
+        chunk_ms=20,
+        workers=3,
+        parallel_segments=3,
+        engine="fake",
+        fake_speed=1.0,
+    )
+    try:
+        # Первое предложение короткое, следующие синтезируются ~2 с в реальном времени
+        text = "Hi. " + "This sentence takes two seconds. " * 2
+        stream = model.stream_text(text)
+        next(stream)
+        started = time.monotonic()
+        stream.close()
+        while (engine := model.engine.stats())["idle"] != engine["size"]:
+            assert time.monotonic() - started < 0.5, engine
+            time.sleep(0.01)
+    finally:
+        model.close()
+
+
+def test_tts_output_format(tmp_path):
+    """Проверка: ресемплинг и кодирование под запрошенный формат, в т.ч. из кэша"""
+    import numpy as np
+    from app.audio import (
+        RESAMPLE_TAPS,
+        AudioFormat,
+        StreamResampler,
+        pcm16_to_alaw,
+        pcm16_to_mulaw,
+    )
+    from app.cache import AudioCache
+
+    # Эталонные значения G.711
+    pcm = np.array([0, -1, 1000, -1000, 32767, -32768], dtype=np.int16)
+    assert pcm16_to_mulaw(pcm).tolist() == [0xFF, 0x7E, 0xCE, 0x4E, 0x80, 0x00]
+    assert pcm16_to_alaw(pcm).tolist() == [0xD5, 0x55, 0xFA, 0x7A, 0xAA, 0x2A]
+
+    # Результат ресемплера не зависит от нарезки входа
+    x = np.sin(np.arange(4410) * 0.05).astype(np.float32) * 1000
+    whole = StreamResampler(22050, 8000, RESAMPLE_TAPS)
+    expected = np.concatenate([whole.process(x), whole.flush()])
+    pieces = StreamResampler(22050, 8000, RESAMPLE_TAPS)
+    parts = [pieces.process(p) for p in np.array_split(x, 7)] + [pieces.flush()]
+    assert len(expected) == 1600
+    assert np.allclose(np.concatenate(parts), expected, atol=1e-3)
+
+    model = TTSModel(
+        models_dir=str(tmp_path),
+        voice="fake.onnx",
+        sample_rate=16000,
+        engine="fake",
+        cache=AudioCache(memory_bytes=1 << 20),
+    )
+    try:
+        text = "Telephony leg."
+        native = model.synthesize(text)
+        fmt = AudioFormat(sample_rate=8000, encoding="mulaw", chunk_ms=20)
+        chunks = list(model.stream_text(text, fmt=fmt))  # из кэша
+        assert all(len(c) == 160 for c in chunks[:-1])
+        assert sum(len(c) for c in chunks) == len(native) // 2 // 2
+        assert b"".join(chunks) == model.synthesize(text, fmt=fmt)
+
+        as_float = model.synthesize(text, fmt=AudioFormat(encoding="float32"))
+        assert len(as_float) == len(native) * 2
+    finally:
+        model.close()
+
+
+def test_tts_worker_stderr_is_drained(tmp_path, monkeypatch):
+    """Проверка: болтливый stderr не блокирует воркер, ошибки структурированы"""
+    from app.pool import PiperProcess, PiperWorkerError
+
+    # Подменный пакет piper: пишет в stderr больше, чем вмещает буфер пайпа
+    fake = tmp_path / "piper"
+    fake.mkdir()
+    (fake / "__init__.py").write_text("")
+    (fake / "voice.py").write_text(
+        "import sys\n"
+        "class _Config:\n"
+        "    sample_rate = 16000\n"
+        "class PiperVoice:\n"
+        "    config = _Config()\n"
+        "    @staticmethod\n"
+        "    def load(model_path, config_path=None):\n"
+        "        return PiperVoice()\n"
+        "    def synthesize_stream_raw(self, text):\n"
+        "        for i in range(2000):\n"
+        "            print('warning', i, 'x' * 100, file=sys.stderr)\n"
+        "        if text == 'boom':\n"
+        "            raise ValueError('boom')\n"
+        "        yield b'\\x01\\x00' * 800\n"
+    )
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+
+    worker = PiperProcess(tmp_path / "voice.onnx", start_timeout=30)
+    worker.start()
+    try:
+        assert worker.sample_rate == 16000
+        assert b"".join(worker.synthesize("hello")) == b"\x01\x00" * 800
+        with pytest.raises(PiperWorkerError) as err:
+            list(worker.synthesize("boom"))
+        assert err.value.as_dict() == {"error": "boom", "code": "synthesis_failed"}
+        assert worker.is_alive()
+        assert "warning 1999" in worker.stderr_tail()
+
+        worker.kill()
+        with pytest.raises(PiperWorkerError) as err:
+            list(worker.synthesize("hello"))
+        assert err.value.code == "worker_died"
+    finally:
+        worker.close()
+
+
+
+def test_tts_health_check_keeps_idle_workers_available(tmp_path, monkeypatch):
+    """Проверка: проверка здоровья пингует по одному воркеру и не отнимает остальных у lease"""
+    import threading
+    import time
+
+    from app.pool import PiperProcess, PiperWorkerPool
+
+    fake = tmp_path / "piper"
+    fake.mkdir()
+    (fake / "__init__.py").write_text("")
+    (fake / "voice.py").write_text(
+        "class _Config:\n"
+        "    sample_rate = 16000\n"
+        "class PiperVoice:\n"
+        "    config = _Config()\n"
+        "    @staticmethod\n"
+        "    def load(model_path, config_path=None):\n"
+        "        return PiperVoice()\n"
+    )
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+
+    pinging = threading.Event()
+    ping = PiperProcess.ping
+
+    def slow_ping(self):
+        pinging.set()
+        time.sleep(1.0)
+        return ping(self)
+
+    monkeypatch.setattr(PiperProcess, "ping", slow_ping)
+    pool = PiperWorkerPool(tmp_path / "voice.onnx", size=2, start_timeout=30,
+                           healthcheck_interval=0.05)
+    try:
+        assert pinging.wait(5)
+        started = time.monotonic()
+        with pool.lease(timeout=0.5) as worker:
+            assert worker.is_alive()
+        assert time.monotonic() - started < 0.2
+    finally:
+        pool.close()
+
+def test_tts_ws_multiplexed_cancel(tmp_path, monkeypatch):
+    """Проверка: запросы с id идут параллельно, cancel сразу освобождает движок"""
+    import json
+    import time
+
+    from app.settings import settings
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(settings, "TTS_ENGINE", "fake")
+    monkeypatch.setattr(settings, "TTS_FAKE_SPEED", 1.0)
+    monkeypatch.setattr(settings, "TTS_MODELS_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "TTS_CACHE_DIR", "")
+    monkeypatch.setattr(settings, "TTS_CACHE_PREWARM_FILE", "")
+    from app import main
+
+    with TestClient(main.app) as client:
+        # Модель грузится в фоне: порт открыт, но готовность — только после прогрева
+        deadline = time.monotonic() + 10
+        while (ready := client.get("/readyz")).status_code != 200:
+            assert ready.json()["status"] == "loading"
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert {"load", "warmup"} <= set(ready.json()["phases_s"])
+        assert client.get("/healthz").status_code == 200
+
+        with client.websocket_connect("/ws/tts") as ws:
+            long_text = "This sentence takes a few seconds to say. " * 20
+            ws.send_text(json.dumps({"id": "long", "text": long_text, "pacing": "burst"}))
+            ws.send_text(json.dumps({"id": "s", "text": "Short.", "pacing": "burst"}))
+
+            frames = {"long": 0, "s": 0}
+            while True:
+                msg = ws.receive()
+                if msg.get("bytes"):
+                    data = msg["bytes"]
+                    frames[data[1 : 1 + data[0]].decode()] += 1
+                elif json.loads(msg["text"]) == {"type": "end", "id": "s"}:
+                    break
+            assert frames["s"] > 0
+
+            started = time.monotonic()
+            ws.send_text(json.dumps({"type": "cancel", "id": "long"}))
+            while True:
+                msg = ws.receive()
+                if msg.get("text"):
+                    assert json.loads(msg["text"]) == {"type": "cancelled", "id": "long"}
+                    break
+            assert time.monotonic() - started < 1.0
+
+            # Сегменты, ждавшие сессию в момент отмены, отдают её сразу после получения
+            deadline = time.monotonic() + 1.0
+            while (engine := main.tts_model.engine.stats())["idle"] != engine["size"]:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+
+            ws.send_text(json.dumps({"type": "cancel", "id": "long"}))
+            assert json.loads(ws.receive_text()) == {"error": "unknown id", "id": "long"}
+
+            # Голос не строкой — ошибка этого запроса, соединение продолжает работать
+            ws.send_text(json.dumps({"id": "v", "text": "hi", "voice": 5}))
+            assert json.loads(ws.receive_text()) == {"error": "unknown voice 5", "id": "v"}
+            ws.send_text(json.dumps({"id": "s2", "text": "Short.", "pacing": "burst"}))
+            while not (msg := ws.receive()).get("text"):
+                pass
+            assert json.loads(msg["text"]) == {"type": "end", "id": "s2"}